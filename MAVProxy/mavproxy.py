@@ -31,6 +31,11 @@ from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import dumpstacks
 from MAVProxy.modules.lib import mp_substitute
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import mp_reactor
+from MAVProxy.modules.lib import mp_fanout
+from MAVProxy.modules.lib import mp_dispatch
+from MAVProxy.modules.lib import mp_profile
+from MAVProxy.modules.lib import mp_tlog
 from MAVProxy.modules.mavproxy_link import preferred_ports
 
 # adding all this allows pyinstaller to build a working windows executable
@@ -163,6 +168,11 @@ class MPState(object):
               MPSetting('baudrate', int, opts.baudrate, 'baudrate for new links', range=(0,10000000), increment=1),
               MPSetting('rtscts', bool, opts.rtscts, 'enable flow control'),
               MPSetting('select_timeout', float, 0.01, 'select timeout'),
+              MPSetting('reactor', bool, opts.reactor, 'use epoll/poll event loop'),
+              MPSetting('idle_rate', int, 100, 'idle task rate in reactor mode', range=(1,1000), increment=1),
+              MPSetting('fanout', bool, False, 'batch writes to outputs once per loop'),
+              MPSetting('fanout_udp_pack', int, 1400, 'max bytes per batched UDP datagram', range=(0,65000), increment=100),
+              MPSetting('fanout_maxq', int, 1000, 'max queued packets per output', range=(0,100000), increment=100),
 
               MPSetting('altreadout', int, 10, 'Altitude Readout',
                         range=(0,100), increment=1, tab='Announcements'),
@@ -170,10 +180,19 @@ class MPState(object):
 
               MPSetting('moddebug', int, opts.moddebug, 'Module Debug Level', range=(0,3), increment=1, tab='Debug'),
               MPSetting('script_fatal', bool, False, 'fatal error on bad script', tab='Debug'),
+              MPSetting('profile_stall_ms', int, 0, 'warn on module calls blocking longer than this', range=(0,100000), increment=10),
               MPSetting('compdebug', int, 0, 'Computation Debug Mask', range=(0,3), tab='Debug'),
               MPSetting('flushlogs', bool, False, 'Flush logs on every packet'),
+              MPSetting('log_buffer_kb', int, 256, 'log write threshold in kB', range=(1,65536), increment=64),
+              MPSetting('log_flush_interval', float, 1.0, 'max seconds between log writes', range=(0.01,60)),
+              MPSetting('log_rotate_mb', int, 0, 'rotate telemetry log at this size (0 to disable)', range=(0,100000), increment=100),
+              MPSetting('log_rotate_min', int, 0, 'rotate telemetry log after this many minutes (0 to disable)', range=(0,100000), increment=10),
+              MPSetting('log_compress', str, 'none', 'compress rotated telemetry logs', choice=['none', 'gzip', 'zstd']),
               MPSetting('requireexit', bool, False, 'Require exit command'),
               MPSetting('wpupdates', bool, True, 'Announce waypoint updates'),
+              MPSetting('wp_window', int, 8, 'Mission transfer window', range=(1,100), increment=1),
+              MPSetting('wp_window_max', int, 32, 'Max mission transfer window', range=(1,255), increment=1),
+              MPSetting('wp_int', bool, False, 'Use MISSION_ITEM_INT for missions'),
 
               MPSetting('basealt', int, 0, 'Base Altitude', range=(0,30000), increment=1, tab='Altitude'),
               MPSetting('wpalt', int, 100, 'Default WP Altitude', range=(0,10000), increment=1),
@@ -208,7 +227,9 @@ class MPState(object):
             "script"         : ["(FILENAME)"],
             "set"            : ["(SETTING)"],
             "status"         : ["(VARIABLE)"],
+            "profile"        : ["<show|reset|json|prometheus>"],
             "module"    : ["list",
+                           "stats",
                            "load (AVAILMODULES)",
                            "<unload|reload> (LOADEDMODULES)"]
             }
@@ -228,9 +249,13 @@ class MPState(object):
         self.mav_param_by_sysid = {}
         self.mav_param_by_sysid[(self.settings.target_system,self.settings.target_component)] = mavparm.MAVParmDict()
         self.modules = []
+        self.dispatch = mp_dispatch.ModuleDispatch(self)
+        self.profiler = mp_profile.ModuleProfiler()
         self.public_modules = {}
         self.functions = MAVFunctions()
-        self.select_extra = {}
+        self.reactor = mp_reactor.MPReactor()
+        self.select_extra = mp_reactor.FDMap(self.reactor.invalidate)
+        self.fanout = mp_fanout.FanOut()
         self.continue_mode = False
         self.aliases = {}
         import platform
@@ -299,6 +324,7 @@ def cmd_status(args):
     '''show status'''
     if len(args) == 0:
         mpstate.status.show(sys.stdout, pattern=None)
+        print("Telemetry log %s" % mpstate.logqueue.stats_string())
     else:
         for pattern in args:
             mpstate.status.show(sys.stdout, pattern=pattern)
@@ -351,6 +377,7 @@ def load_module(modname, quiet=False, **kwargs):
             module = m.init(mpstate, **kwargs)
             if isinstance(module, mp_module.MPModule):
                 mpstate.modules.append((module, m))
+                mpstate.dispatch.invalidate()
                 if not quiet:
                     if kwargs:
                         print("Loaded module %s with kwargs = %s" % (modname, kwargs))
@@ -378,6 +405,7 @@ def unload_module(modname):
             if hasattr(m, 'unload'):
                 m.unload()
             mpstate.modules.remove((m,pm))
+            mpstate.dispatch.invalidate()
             print("Unloaded module %s" % modname)
             return True
     print("Unable to find module %s" % modname)
@@ -385,13 +413,20 @@ def unload_module(modname):
 
 def cmd_module(args):
     '''module commands'''
-    usage = "usage: module <list|load|reload|unload>"
+    usage = "usage: module <list|load|reload|unload|stats>"
     if len(args) < 1:
         print(usage)
         return
     if args[0] == "list":
         for (m,pm) in mpstate.modules:
             print("%s: %s" % (m.name, m.description))
+    elif args[0] == "stats":
+        if len(args) > 1 and args[1] == "reset":
+            mpstate.dispatch.reset_stats()
+        elif len(args) > 1:
+            mpstate.dispatch.show_stats(args[1])
+        else:
+            mpstate.dispatch.show_stats()
     elif args[0] == "load":
         if len(args) < 2:
             print("usage: module load <name>")
@@ -437,6 +472,28 @@ def cmd_module(args):
         print(usage)
 
 
+def cmd_profile(args):
+    '''module profiling commands'''
+    usage = "usage: profile <show|reset|json|prometheus> [FILENAME]"
+    if len(args) < 1 or args[0] == "show":
+        mpstate.profiler.show()
+    elif args[0] == "reset":
+        mpstate.profiler.reset()
+    elif args[0] in ["json", "prometheus"]:
+        if args[0] == "json":
+            txt = mpstate.profiler.to_json()
+        else:
+            txt = mpstate.profiler.to_prometheus()
+        if len(args) > 1:
+            f = open(args[1], mode='w')
+            f.write(txt)
+            f.close()
+            print("Saved profile to %s" % args[1])
+        else:
+            print(txt)
+    else:
+        print(usage)
+
 def cmd_alias(args):
     '''alias commands'''
     usage = "usage: alias <add|remove|list>"
@@ -507,6 +564,7 @@ command_map = {
     'set'     : (cmd_set,      'mavproxy settings'),
     'watch'   : (cmd_watch,    'watch a MAVLink pattern'),
     'module'  : (cmd_module,   'module commands'),
+    'profile' : (cmd_profile,  'module profiling'),
     'alias'   : (cmd_alias,    'command aliases')
     }
 
@@ -606,7 +664,7 @@ def process_master(m):
         return
 
     if mpstate.logqueue_raw:
-        mpstate.logqueue_raw.put(bytearray(s))
+        mpstate.logqueue_raw.put(s)
 
     if mpstate.status.setup_mode:
         if mpstate.system == 'Windows':
@@ -674,19 +732,6 @@ def mkdir_p(dir):
     mkdir_p(os.path.dirname(dir))
     os.mkdir(dir)
 
-def log_writer():
-    '''log writing thread'''
-    while True:
-        mpstate.logfile_raw.write(bytearray(mpstate.logqueue_raw.get()))
-        timeout = time.time() + 10
-        while not mpstate.logqueue_raw.empty() and time.time() < timeout:
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty() and time.time() < timeout:
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs or time.time() >= timeout:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
-
 # If state_basedir is NOT set then paths for logs and aircraft
 # directories are relative to mavproxy's cwd
 def log_paths():
@@ -737,8 +782,8 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         mode = 'wb'
 
     try:
-        mpstate.logfile = open(logpath_telem, mode=mode)
-        mpstate.logfile_raw = open(logpath_telem_raw, mode=mode)
+        mpstate.logqueue.open(logpath_telem, mode=mode)
+        mpstate.logqueue_raw.open(logpath_telem_raw, mode=mode)
         print("Log Directory: %s" % mpstate.status.logdir)
         print("Telemetry log: %s" % logpath_telem)
 
@@ -750,13 +795,6 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
                 print("ERROR: Not enough free disk space for logfile")
                 mpstate.status.exit = True
                 return
-
-        # use a separate thread for writing to the logfile to prevent
-        # delays during disk writes (important as delays can be long if camera
-        # app is running)
-        t = threading.Thread(target=log_writer, name='log_writer')
-        t.daemon = True
-        t.start()
     except Exception as e:
         print("ERROR: opening log file for writing: %s" % e)
         mpstate.status.exit = True
@@ -822,9 +860,14 @@ def periodic_tasks():
 
     set_stream_rates()
 
+    if mpstate.settings.profile_stall_ms != mpstate.profiler.stall_ms:
+        mpstate.profiler.start_watchdog(mpstate.settings.profile_stall_ms, mpstate.console.writeln)
+
     # call optional module idle tasks. These are called at several hundred Hz
+    profiler = mpstate.profiler
     for (m,pm) in mpstate.modules:
         if hasattr(m, 'idle_task'):
+            profiler.begin(m.name, 'idle_task')
             try:
                 m.idle_task()
             except Exception as msg:
@@ -834,15 +877,122 @@ def periodic_tasks():
                     exc_type, exc_value, exc_traceback = sys.exc_info()
                     traceback.print_exception(exc_type, exc_value, exc_traceback,
                                               limit=2, file=sys.stdout)
+            profiler.end()
 
         # also see if the module should be unloaded:
         if m.needs_unloading:
             unload_module(m.name)
 
-def main_loop():
-    '''main processing loop'''
+def flush_outputs():
+    '''write out packets queued for outputs during this pass'''
+    mpstate.fanout.flush(mpstate.settings.fanout_udp_pack)
 
+def check_screensaver():
+    '''enable or disable screensaver'''
     global screensaver_cookie
+    if (mpstate.settings.inhibit_screensaver_when_armed and
+        screensaver_interface is not None):
+        if mpstate.status.armed and screensaver_cookie is None:
+            # now we can inhibit the screensaver
+            screensaver_cookie = screensaver_interface.Inhibit("MAVProxy",
+                                                         "Vehicle is armed")
+        elif not mpstate.status.armed and screensaver_cookie is not None:
+            # we can also restore it
+            screensaver_interface.UnInhibit(screensaver_cookie)
+            screensaver_cookie = None
+
+def process_input_queue():
+    '''process any pending command input'''
+    while not mpstate.input_queue.empty():
+        line = mpstate.input_queue.get()
+        mpstate.input_count += 1
+        cmds = line.split(';')
+        if len(cmds) == 1 and cmds[0] == "":
+              mpstate.empty_input_count += 1
+        for c in cmds:
+            process_stdin(c)
+
+def poll_fdless_masters():
+    '''poll masters which have no file descriptor (eg. serial on Windows)'''
+    for master in mpstate.mav_master:
+        if master.fd is None:
+            if master.port.inWaiting() > 0:
+                process_master(master)
+
+def process_select_extra(fd):
+    '''call the read function a module registered for fd'''
+    try:
+        # call the registered read function
+        (fn, args) = mpstate.select_extra[fd]
+        fn(args)
+    except Exception as msg:
+        if mpstate.settings.moddebug == 1:
+            print(msg)
+        # on an exception, remove it from the select list
+        mpstate.select_extra.pop(fd, None)
+
+def reactor_signature():
+    '''cheap summary of master link state that can change without the
+    link module knowing, such as a serial port reconnecting on a new fd.
+    The port object is included as a reconnected TCP link can get a new
+    socket with the same fd number'''
+    return tuple([(master.fd, master.portdead, id(getattr(master, 'port', None)))
+                  for master in mpstate.mav_master])
+
+def reactor_handlers():
+    '''build the fd->handler map for the reactor'''
+    handlers = {}
+    for master in mpstate.mav_master:
+        if master.fd is not None and not master.portdead:
+            handlers[master.fd] = (process_master, master)
+    for m in mpstate.mav_outputs:
+        handlers[m.fd] = (process_mavlink, m)
+    for sysid in mpstate.sysid_outputs:
+        m = mpstate.sysid_outputs[sysid]
+        handlers[m.fd] = (process_mavlink, m)
+    for fd in mpstate.select_extra:
+        handlers[fd] = (process_select_extra, fd)
+    return handlers
+
+def reactor_loop():
+    '''event driven main loop. File descriptors are registered once with
+    the reactor and idle tasks are run on a timer rather than on every
+    wakeup. Returns when the reactor setting is turned off'''
+    reactor = mpstate.reactor
+    next_idle = 0
+    while True:
+        if mpstate is None or mpstate.status.exit:
+            return
+        if not mpstate.settings.reactor:
+            # back to the select loop
+            reactor.invalidate()
+            return
+
+        tnow = time.time()
+        if tnow >= next_idle:
+            check_screensaver()
+            process_input_queue()
+            poll_fdless_masters()
+            periodic_tasks()
+            next_idle = tnow + 1.0/mpstate.settings.idle_rate
+
+        if reactor.needs_update(reactor_signature()):
+            reactor.set_handlers(reactor_handlers())
+
+        timeout = max(next_idle - time.time(), 0)
+        if len(reactor.handlers) == 0:
+            time.sleep(timeout)
+            continue
+
+        for (fd, (fn, arg)) in reactor.poll(timeout):
+            if mpstate is None or mpstate.status.exit:
+                return
+            fn(arg)
+
+        flush_outputs()
+
+def main_loop():
+    '''main processing loop'''
 
     if not mpstate.status.setup_mode and not opts.nowait:
         for master in mpstate.mav_master:
@@ -857,31 +1007,15 @@ def main_loop():
         if mpstate is None or mpstate.status.exit:
             return
 
-        # enable or disable screensaver:
-        if (mpstate.settings.inhibit_screensaver_when_armed and
-            screensaver_interface is not None):
-            if mpstate.status.armed and screensaver_cookie is None:
-                # now we can inhibit the screensaver
-                screensaver_cookie = screensaver_interface.Inhibit("MAVProxy",
-                                                             "Vehicle is armed")
-            elif not mpstate.status.armed and screensaver_cookie is not None:
-                # we can also restore it
-                screensaver_interface.UnInhibit(screensaver_cookie)
-                screensaver_cookie = None
-
-        while not mpstate.input_queue.empty():
-            line = mpstate.input_queue.get()
-            mpstate.input_count += 1
-            cmds = line.split(';')
-            if len(cmds) == 1 and cmds[0] == "":
-                  mpstate.empty_input_count += 1
-            for c in cmds:
-                process_stdin(c)
+        if mpstate.settings.reactor and mpstate.reactor.available():
+            reactor_loop()
+            continue
 
-        for master in mpstate.mav_master:
-            if master.fd is None:
-                if master.port.inWaiting() > 0:
-                    process_master(master)
+        check_screensaver()
+
+        process_input_queue()
+
+        poll_fdless_masters()
 
         periodic_tasks()
 
@@ -900,6 +1034,8 @@ def main_loop():
 
         for fd in mpstate.select_extra:
             rin.append(fd)
+        flush_outputs()
+
         try:
             (rin, win, xin) = select.select(rin, [], [], mpstate.settings.select_timeout)
         except select.error:
@@ -935,15 +1071,7 @@ def main_loop():
             # this allow modules to register their own file descriptors
             # for the main select loop
             if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+                process_select_extra(fd)
 
 
 
@@ -1071,6 +1199,7 @@ if __name__ == '__main__':
     parser.add_option("--daemon", action='store_true', help="run in daemon mode, do not start interactive shell")
     parser.add_option("--non-interactive", action='store_true', help="do not start interactive shell")
     parser.add_option("--profile", action='store_true', help="run the Yappi python profiler")
+    parser.add_option("--reactor", action='store_true', default=False, help="use epoll/poll event driven main loop")
     parser.add_option("--state-basedir", default=None, help="base directory for logs and aircraft directories")
     parser.add_option("--version", action='store_true', help="version information")
     parser.add_option("--default-modules", default="log,signing,wp,rally,fence,param,relay,tuneopt,arm,mode,calibration,rc,auxopt,misc,cmdlong,battery,terrain,output,adsb,layout", help='default module list')
@@ -1110,9 +1239,11 @@ if __name__ == '__main__':
     mpstate.status.exit = False
     mpstate.command_map = command_map
     mpstate.continue_mode = opts.continue_mode
-    # queues for logging
-    mpstate.logqueue = Queue.Queue()
-    mpstate.logqueue_raw = Queue.Queue()
+    # buffered log writers. These use a separate thread for writing
+    # to the logfile to prevent delays during disk writes (important
+    # as delays can be long if camera app is running)
+    mpstate.logqueue = mp_tlog.LogWriter(mpstate.settings)
+    mpstate.logqueue_raw = mp_tlog.LogWriter(mpstate.settings)
 
 
     if opts.speech:
@@ -1297,4 +1428,7 @@ if __name__ == '__main__':
             print("Unloading module %s" % m.name)
             m.unload()
 
+    mpstate.logqueue.close()
+    mpstate.logqueue_raw.close()
+
     sys.exit(1)
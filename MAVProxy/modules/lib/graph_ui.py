@@ -33,7 +33,7 @@ class Graph_UI(object):
         self.mg.set_linestyle(self.mestate.settings.linestyle)
         self.mg.set_show_flightmode(self.mestate.settings.show_flightmode)
         self.mg.set_legend(self.mestate.settings.legend)
-        self.mg.add_mav(self.mestate.mlog)
+        self.mg.add_mav(self.mestate.mlog, getattr(self.mestate, 'index', None))
         for f in graphdef.expression.split():
             self.mg.add_field(f)
         self.mg.process(self.mestate.flightmode_selections, self.mestate.mlog._flightmodes)
@@ -42,6 +42,7 @@ class Graph_UI(object):
         #To avoid slowdowns in Windows (which copies the vars to the new process)
         #We need to empty this var when we're finished with it
         self.mg.mav_list = []
+        self.mg.index_list = []
         child = multiproc.Process(target=self.mg.show, args=[self.lenmavlist,], kwargs={"xlim_pipe" : self.xlim_pipe})
         child.start()
         self.xlim_pipe[1].close()
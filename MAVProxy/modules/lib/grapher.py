@@ -6,13 +6,18 @@
 
 import ast
 import sys, struct, time, os, datetime
-import math, re
+import math
 import matplotlib
 from math import *
 from pymavlink.mavextra import *
 import pylab
 from pymavlink import mavutil
 import threading
+import numpy
+from MAVProxy.modules.lib import mp_logindex
+from MAVProxy.modules.lib import mp_logcolumns
+from MAVProxy.modules.lib import mp_expression
+from MAVProxy.modules.lib import multiproc
 
 colors = [ 'red', 'green', 'blue', 'orange', 'olive', 'black', 'grey', 'yellow', 'brown', 'darkcyan',
            'cornflowerblue', 'darkmagenta', 'deeppink', 'darkred']
@@ -46,6 +51,7 @@ class MavGraph(object):
         self.lowest_x = None
         self.highest_x = None
         self.mav_list = []
+        self.index_list = []
         self.fields = []
         self.condition = None
         self.xaxis = None
@@ -77,14 +83,17 @@ class MavGraph(object):
         self.tday_base = None
         self.tday_basetime = None
         self.title = None
+        self.use_columns = True
+        self.jobs = 1
 
     def add_field(self, field):
         '''add another field to plot'''
         self.fields.append(field)
 
-    def add_mav(self, mav):
-        '''add another data source to plot'''
+    def add_mav(self, mav, index=None):
+        '''add another data source to plot, with an optional mp_logindex.LogIndex'''
         self.mav_list.append(mav)
+        self.index_list.append(index)
 
     def set_condition(self, condition):
         '''set graph condition'''
@@ -126,6 +135,14 @@ class MavGraph(object):
         '''set multiple graph option'''
         self.multi = multi
 
+    def set_use_columns(self, value):
+        '''set to false to disable the columnar field cache'''
+        self.use_columns = value
+
+    def set_jobs(self, jobs):
+        '''set number of processes used to extract data from multiple logs'''
+        self.jobs = max(1, jobs)
+
     def make_format(self, current, other):
         # current and other are axes
         def format_coord(x, y):
@@ -335,20 +352,15 @@ class MavGraph(object):
         '''add some data'''
         mtype = msg.get_type()
         for i in range(0, len(self.fields)):
-            if mtype not in self.field_types[i]:
+            if mtype not in self.field_types[i] or self.vectorised[i]:
                 continue
-            f = self.fields[i]
-            simple = self.simple_field[i]
-            if simple is not None:
-                v = getattr(vars[simple[0]], simple[1])
-            else:
-                v = mavutil.evaluate_expression(f, vars)
+            v = self.expressions[i].evaluate(vars)
             if v is None:
                 continue
-            if self.xaxis is None:
+            if self.xaxis_expression is None:
                 xv = t
             else:
-                xv = mavutil.evaluate_expression(self.xaxis, vars)
+                xv = self.xaxis_expression.evaluate(vars)
                 if xv is None:
                     continue
             try:
@@ -372,15 +384,81 @@ class MavGraph(object):
         sec_to_days = 1.0 / (60*60*24)
         return self.tday_base + (timestamp - self.tday_basetime) * sec_to_days
 
-    def process_mav(self, mlog, flightmode_selections):
-        '''process one file'''
-        self.vars = {}
-        idx = 0
-        all_false = True
-        for s in flightmode_selections:
-            if s:
-                all_false = False
+    def process_columns(self, mlog, index, time_ranges):
+        '''add data for fields which can be evaluated over whole columns
+        of a single message type, marking them in self.vectorised'''
+        if not self.use_columns:
+            return
+        columns = mp_logcolumns.get_columns(getattr(mlog, 'filename', None))
+        if columns is None:
+            return
+        cond = None
+        if self.condition:
+            cond = mp_expression.compile_expression(self.condition).vector()
+            if cond is None:
+                return
+        xexpr = None
+        if self.xaxis:
+            xexpr = self.xaxis_expression.vector()
+            if xexpr is None:
+                return
+        exprs = {}
+        for i in range(0, self.num_fields):
+            e = self.expressions[i].vector()
+            if e is None:
+                continue
+            if cond is not None and cond.mtype != e.mtype:
+                continue
+            if xexpr is not None and xexpr.mtype != e.mtype:
+                continue
+            exprs[i] = e
+        if len(exprs) == 0:
+            return
+        types = set([e.mtype for e in exprs.values()])
+        data = columns.get(mlog, types, index)
+
+        for i in sorted(exprs.keys()):
+            e = exprs[i]
+            cols = data[e.mtype]
+            tstamps = cols['_timestamp']
+            y = e.evaluate(cols)
+            if y is None:
+                # missing field, same as per-message evaluation
+                self.vectorised[i] = True
+                continue
+            mask = numpy.isfinite(y)
+            if cond is not None:
+                c = cond.evaluate(cols)
+                if c is None:
+                    mask[:] = False
+                else:
+                    mask &= (c != 0)
+            if time_ranges is not None:
+                tmask = numpy.zeros(len(tstamps), dtype=bool)
+                for (t0, t1) in time_ranges:
+                    tmask |= (tstamps >= t0) & (tstamps <= t1)
+                mask &= tmask
+            if xexpr is not None:
+                x = xexpr.evaluate(cols)
+                if x is None:
+                    self.vectorised[i] = True
+                    continue
+                mask &= numpy.isfinite(x)
+                x = x[mask]
+            else:
+                t = tstamps[mask]
+                if len(t) > 0:
+                    self.timestamp_to_days(t[0])
+                if self.tday_base is None:
+                    x = numpy.zeros(len(t))
+                else:
+                    x = self.tday_base + (t - self.tday_basetime) * (1.0 / (60*60*24))
+            self.y[i].extend(y[mask].tolist())
+            self.x[i].extend(numpy.asarray(x, dtype=float).tolist())
+            self.vectorised[i] = True
 
+    def setup_fields(self):
+        '''work out axes and simple fields'''
         # pre-calc right/left axes
         self.num_fields = len(self.fields)
         for i in range(0, self.num_fields):
@@ -393,32 +471,78 @@ class MavGraph(object):
                 f = f[:-2]
             self.fields[i] = f
 
-        # see which fields are simple
-        self.simple_field = []
-        for i in range(0, self.num_fields):
-            f = self.fields[i]
-            m = re.match('^([A-Z][A-Z0-9_]*)[.]([A-Za-z_][A-Za-z0-9_]*)$', f)
-            if m is None:
-                self.simple_field.append(None)
-            else:
-                self.simple_field.append((m.group(1),m.group(2)))
+        # compile the expressions once, and work out the message types they use
+        self.expressions = [ mp_expression.compile_expression(f) for f in self.fields ]
+        self.field_types = [ e.msg_types for e in self.expressions ]
+        self.msg_types = set()
+        for types in self.field_types:
+            self.msg_types.update(types)
+        self.xaxis_expression = None
+        if self.xaxis:
+            self.xaxis_expression = mp_expression.compile_expression(self.xaxis)
+        self.condition_expression = None
+        if self.condition:
+            self.condition_expression = mp_expression.compile_expression(self.condition)
+
+    def process_mav(self, mlog, flightmode_selections, index=None):
+        '''process one file'''
+        self.vars = {}
+        idx = 0
+        all_false = True
+        for s in flightmode_selections:
+            if s:
+                all_false = False
 
         if len(self.flightmode_list) > 0:
             # prime the timestamp conversion
             self.timestamp_to_days(self.flightmode_list[0][1])
 
+        time_ranges = None
+        if not all_false and len(flightmode_selections) > 0:
+            time_ranges = []
+            for i in range(min(len(flightmode_selections), len(self.flightmode_list))):
+                if flightmode_selections[i]:
+                    (mode, t0, t1) = self.flightmode_list[i]
+                    time_ranges.append((t0, t1))
+
+        # fields which only use one message type are evaluated over
+        # cached columns, the rest need a pass over the messages
+        self.vectorised = [False] * self.num_fields
+        self.process_columns(mlog, index, time_ranges)
+        msg_types = set()
+        for i in range(0, self.num_fields):
+            if not self.vectorised[i]:
+                msg_types.update(self.field_types[i])
+        if len(msg_types) == 0:
+            return
+
+        reader = None
+        if index is not None:
+            # with an index we only read the types we need, plus
+            # those used by the condition and xaxis, and only for the
+            # selected flight modes
+            state_types = mp_logindex.log_types(self.condition)
+            state_types.update(mp_logindex.log_types(self.xaxis))
+            reader = mp_logindex.IndexedReader(mlog, index, msg_types,
+                                               state_types=state_types, time_ranges=time_ranges)
+        else:
+            time_ranges = None
+
         while True:
-            msg = mlog.recv_match(type=self.msg_types)
+            if reader is not None:
+                msg = reader.recv_match()
+            else:
+                msg = mlog.recv_match(type=msg_types)
             if msg is None:
                 break
-            if msg.get_type() not in self.msg_types:
+            if msg.get_type() not in msg_types:
                 continue
-            if self.condition:
-                if not mavutil.evaluate_condition(self.condition, mlog.messages):
+            if self.condition_expression is not None:
+                if not self.condition_expression.condition(mlog.messages):
                     continue
             tdays = self.timestamp_to_days(msg._timestamp)
 
-            if all_false or len(flightmode_selections) == 0:
+            if all_false or len(flightmode_selections) == 0 or time_ranges is not None:
                 self.add_data(tdays, msg, mlog.messages)
             else:
                 if idx < len(self.flightmode_list) and msg._timestamp >= self.flightmode_list[idx][2]:
@@ -450,9 +574,7 @@ class MavGraph(object):
 
     def process(self, flightmode_selections, _flightmodes, block=True):
         '''process and display graph'''
-        self.msg_types = set()
         self.multiplier = []
-        self.field_types = []
         self.xlim = None
         self.flightmode_list = _flightmodes
 
@@ -462,21 +584,116 @@ class MavGraph(object):
         self.modes = []
         self.axes = []
         self.first_only = []
-        re_caps = re.compile('[A-Z_][A-Z0-9_]+')
         for f in self.fields:
-            caps = set(re.findall(re_caps, f))
-            self.msg_types = self.msg_types.union(caps)
-            self.field_types.append(caps)
             self.y.append([])
             self.x.append([])
             self.axes.append(1)
             self.first_only.append(False)
 
         timeshift = self.timeshift
+        self.setup_fields()
+
+        if self.jobs > 1 and len(self.mav_list) > 1:
+            self.process_parallel(flightmode_selections)
+            return
 
         for fi in range(0, len(self.mav_list)):
             mlog = self.mav_list[fi]
-            self.process_mav(mlog, flightmode_selections)
+            self.process_mav(mlog, flightmode_selections, self.index_list[fi])
+
+    def worker_settings(self, flightmode_selections):
+        '''settings needed to extract data from a log in a worker process'''
+        return { 'fields' : self.fields[:],
+                 'condition' : self.condition,
+                 'xaxis' : self.xaxis,
+                 'use_columns' : self.use_columns,
+                 'flightmode_selections' : flightmode_selections,
+                 'flightmode_list' : self.flightmode_list }
+
+    def process_parallel(self, flightmode_selections):
+        '''extract data from the logs in a pool of worker processes, then
+        merge the results in log order. Workers are handed one log at a
+        time, so a long log doesn't hold up the others'''
+        settings = self.worker_settings(flightmode_selections)
+        work = []
+        results = {}
+        for fi in range(0, len(self.mav_list)):
+            mlog = self.mav_list[fi]
+            filename = getattr(mlog, 'filename', None)
+            if filename is None or not os.path.isfile(filename):
+                # can't be reopened in a worker, process it here
+                results[fi] = None
+                continue
+            work.append((fi, filename, log_options(mlog)))
+
+        # each worker is [process, connection, current job]
+        workers = []
+        for w in range(min(self.jobs, len(work))):
+            (parent_conn, child_conn) = multiproc.Pipe()
+            p = multiproc.Process(target=extract_worker, args=(child_conn, settings))
+            p.start()
+            child_conn.close()
+            workers.append([p, parent_conn, None])
+
+        while len(workers) > 0:
+            for w in workers[:]:
+                (p, conn, job) = w
+                if job is None:
+                    # idle, send the next log or None to finish
+                    if len(work) > 0:
+                        job = work.pop(0)
+                    try:
+                        conn.send(job)
+                    except Exception:
+                        if job is not None:
+                            work.insert(0, job)
+                        job = None
+                    if job is not None:
+                        w[2] = job
+                        continue
+                    conn.close()
+                    p.join()
+                    workers.remove(w)
+                    continue
+                if not conn.poll(0.01):
+                    continue
+                try:
+                    (fi, ret) = conn.recv()
+                except EOFError:
+                    print("Worker failed on %s, processing it here" % job[1])
+                    results[job[0]] = None
+                    conn.close()
+                    p.join()
+                    workers.remove(w)
+                    continue
+                w[2] = None
+                if isinstance(ret, str):
+                    print("Failed to process %s: %s" % (self.mav_list[fi].filename, ret))
+                    ret = []
+                results[fi] = ret
+
+        # logs left over if all the workers failed
+        for (fi, filename, options) in work:
+            results[fi] = None
+
+        if len(self.flightmode_list) > 0:
+            # prime the timestamp conversion
+            self.timestamp_to_days(self.flightmode_list[0][1])
+        for fi in range(0, len(self.mav_list)):
+            ret = results.get(fi, [])
+            if ret is None:
+                self.process_mav(self.mav_list[fi], flightmode_selections, self.index_list[fi])
+                continue
+            for i in range(0, len(ret)):
+                (x, y) = ret[i]
+                if len(x) == 0:
+                    continue
+                if self.xaxis is None:
+                    # workers return times in seconds
+                    self.timestamp_to_days(x[0])
+                    x = self.tday_base + (x - self.tday_basetime) * (1.0 / (60*60*24))
+                self.x[i].extend(x.tolist())
+                self.y[i].extend(y.tolist())
 
 
     def show(self, lenmavlist, block=True, xlim_pipe=None):
@@ -522,6 +739,54 @@ class MavGraph(object):
         pylab.draw()
         pylab.show(block=block)
 
+def log_options(mlog):
+    '''options needed to reopen a log in another process'''
+    return { 'notimestamps' : getattr(mlog, 'notimestamps', False),
+             'planner_format' : getattr(mlog, 'planner_format', None),
+             'zero_time_base' : getattr(mlog, '_zero_time_base', False),
+             'dialect' : mavutil.current_dialect }
+
+def extract_log(filename, options, settings):
+    '''extract graph data from one log, returning a list of (x,y) arrays
+    per field, with x in seconds when there is no xaxis expression'''
+    mlog = mavutil.mavlink_connection(filename, **options)
+    mg = MavGraph()
+    for f in settings['fields']:
+        mg.add_field(f)
+    mg.set_condition(settings['condition'])
+    mg.set_xaxis(settings['xaxis'])
+    mg.set_use_columns(settings['use_columns'])
+    mg.add_mav(mlog, mp_logindex.load_index(mlog, filename))
+    # a zero time base makes the x values seconds/86400
+    mg.tday_base = 0
+    mg.tday_basetime = 0
+    mg.process(settings['flightmode_selections'], settings['flightmode_list'])
+    ret = []
+    for i in range(0, len(mg.fields)):
+        x = numpy.array(mg.x[i], dtype=float)
+        if mg.xaxis is None:
+            x *= 60*60*24
+        ret.append((x, numpy.array(mg.y[i], dtype=float)))
+    return ret
+
+def extract_worker(conn, settings):
+    '''worker process for MavGraph.process_parallel. Extracts the logs
+    it is sent one at a time, until sent None'''
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        (fi, filename, options) = job
+        try:
+            ret = extract_log(filename, options, settings)
+        except Exception as ex:
+            ret = str(ex)
+        conn.send((fi, ret))
+    conn.close()
+
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser(description=__doc__)
@@ -542,6 +807,8 @@ if __name__ == "__main__":
     parser.add_argument("--dialect", default="ardupilotmega", help="MAVLink dialect")
     parser.add_argument("--output", default=None, help="provide an output format")
     parser.add_argument("--timeshift", type=float, default=0, help="shift time on first graph in seconds")
+    parser.add_argument("--no-cache", action='store_true', help="don't use the columnar field cache")
+    parser.add_argument("--jobs", type=int, default=1, help="number of processes used to read logs")
     parser.add_argument("logs_fields", metavar="<LOG or FIELD>", nargs="+")
     args = parser.parse_args()
 
@@ -563,5 +830,7 @@ if __name__ == "__main__":
     mg.set_legend2(args.legend2)
     mg.set_multi(args.multi)
     mg.set_show_flightmode(args.show_flightmode)
-    mg.process([],0)
+    mg.set_use_columns(not args.no_cache)
+    mg.set_jobs(args.jobs)
+    mg.process([],[])
     mg.show(len(mg.mav_list))
@@ -8,7 +8,7 @@
   http://eli.thegreenplace.net/files/prog_code/wx_mpl_dynamic_graph.py.txt
 """
 
-import platform
+import platform, time
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 
@@ -18,7 +18,8 @@ class LiveGraph():
     All of the GUI work is done in a child process to provide some insulation
     from the parent mavproxy instance and prevent instability in the GCS
 
-    New data is sent to the LiveGraph instance via a pipe
+    New data is sent to the LiveGraph instance via a pipe, as batches
+    of timestamped samples at most once per tickresolution
     '''
     def __init__(self,
                  fields,
@@ -32,7 +33,9 @@ class LiveGraph():
         self.title  = title
         self.timespan = timespan
         self.tickresolution = tickresolution
-        self.values = [None]*len(self.fields)
+        self.pending = []
+        self.last_send = 0
+        self.alive = True
         self.parent_pipe,self.child_pipe = multiproc.Pipe()
         self.close_graph = multiproc.Event()
         self.close_graph.clear()
@@ -59,8 +62,20 @@ class LiveGraph():
         
     def add_values(self, values):
         '''add some data to the graph'''
-        if self.child.is_alive():
-            self.parent_pipe.send(values)
+        if not self.alive:
+            return
+        self.pending.append((time.time(), list(values)))
+        if time.time() - self.last_send >= self.tickresolution:
+            self.flush()
+
+    def flush(self):
+        '''send pending samples to the graph'''
+        self.last_send = time.time()
+        if len(self.pending) == 0:
+            return
+        if self.is_alive():
+            self.parent_pipe.send(self.pending)
+        self.pending = []
 
     def close(self):
         '''close the graph'''
@@ -70,13 +85,15 @@ class LiveGraph():
 
     def is_alive(self):
         '''check if graph is still going'''
-        return self.child.is_alive()
+        if self.alive:
+            self.alive = self.child.is_alive()
+        return self.alive
 
 
 if __name__ == "__main__":
     multiproc.freeze_support()
     # test the graph
-    import time, math
+    import math
     import live_graph
     livegraph = live_graph.LiveGraph(['sin(t)', 'cos(t)', 'sin(t+1)',
                            'cos(t+1)', 'sin(t+2)', 'cos(t+2)',
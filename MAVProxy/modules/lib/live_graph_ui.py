@@ -2,6 +2,81 @@ from MAVProxy.modules.lib.wx_loader import wx
 import time
 import numpy, pylab
 
+class RingBuffer(object):
+    '''timestamped rows of values held in numpy arrays, oldest first
+    from start. The arrays grow while the oldest row is still inside
+    the timespan, up to max_rows'''
+    def __init__(self, ncols, rows=1024, max_rows=1000000):
+        self.t = numpy.zeros(rows)
+        self.v = numpy.zeros((rows, ncols))
+        self.start = 0
+        self.count = 0
+        self.max_rows = max_rows
+
+    def capacity(self):
+        return len(self.t)
+
+    def _order(self):
+        '''indexes of the rows, oldest first'''
+        return (self.start + numpy.arange(self.count)) % self.capacity()
+
+    def _resize(self, rows):
+        idx = self._order()
+        t = numpy.zeros(rows)
+        v = numpy.zeros((rows, self.v.shape[1]))
+        t[:self.count] = self.t[idx]
+        v[:self.count] = self.v[idx]
+        self.t = t
+        self.v = v
+        self.start = 0
+
+    def append(self, t, v):
+        '''add rows, with t an array of times and v an array of rows'''
+        n = len(t)
+        if n > self.max_rows:
+            t = t[-self.max_rows:]
+            v = v[-self.max_rows:]
+            n = self.max_rows
+        if self.count + n > self.capacity():
+            if self.capacity() < self.max_rows:
+                self._resize(min(max(self.capacity()*2, self.count+n), self.max_rows))
+            if self.count + n > self.capacity():
+                # full, drop the oldest rows
+                drop = self.count + n - self.capacity()
+                self.start = (self.start + drop) % self.capacity()
+                self.count -= drop
+        idx = (self.start + self.count + numpy.arange(n)) % self.capacity()
+        self.t[idx] = t
+        self.v[idx] = v
+        self.count += n
+
+    def expire(self, tmin):
+        '''drop rows older than tmin'''
+        if self.count == 0:
+            return
+        k = numpy.searchsorted(self.t[self._order()], tmin)
+        self.start = (self.start + k) % self.capacity()
+        self.count -= k
+
+    def data(self):
+        '''return times and rows, oldest first'''
+        idx = self._order()
+        return (self.t[idx], self.v[idx])
+
+
+def decimate(x, y, xmin, xmax, width):
+    '''reduce a series to the min and max of y in each of width buckets
+    between xmin and xmax, keeping the shape of the line on screen'''
+    if len(x) <= 2*width:
+        return (x, y)
+    bucket = ((x - xmin) * (width / (xmax - xmin))).astype(int)
+    starts = numpy.flatnonzero(numpy.diff(bucket)) + 1
+    starts = numpy.concatenate(([0], starts))
+    ymin = numpy.fmin.reduceat(y, starts)
+    ymax = numpy.fmax.reduceat(y, starts)
+    xb = x[starts]
+    return (numpy.repeat(xb, 2), numpy.column_stack((ymin, ymax)).ravel())
+
 class GraphFrame(wx.Frame):
     """ The main frame of the application
     """
@@ -9,9 +84,7 @@ class GraphFrame(wx.Frame):
     def __init__(self, state):
         wx.Frame.__init__(self, None, -1, state.title)
         self.state = state
-        self.data = []
-        for i in range(len(state.fields)):
-            self.data.append([])
+        self.data = RingBuffer(len(state.fields))
         self.paused = False
 
         self.create_main_panel()
@@ -75,49 +148,62 @@ class GraphFrame(wx.Frame):
         # to the plotted line series
         #
         self.plot_data = []
-        if len(self.data[0]) == 0:
-            max_y = min_y = 0
-        else:
-            max_y = min_y = self.data[0][0]
-        for i in range(len(self.data)):
+        for i in range(len(self.state.fields)):
             p = self.axes.plot(
-                self.data[i],
+                [],
                 linewidth=1,
                 color=self.state.colors[i],
                 label=self.state.fields[i],
                 )[0]
             self.plot_data.append(p)
-            if len(self.data[i]) != 0:
-                min_y = min(min_y, min(self.data[i]))
-                max_y = max(max_y, max(self.data[i]))
-
-        # create X data
-        self.xdata = numpy.arange(-self.state.timespan, 0, self.state.tickresolution)
-        self.axes.set_xbound(lower=self.xdata[0], upper=0)
-        if min_y == max_y:
-            self.axes.set_ybound(min_y, max_y+0.1)
+
+        self.axes.set_xbound(lower=-self.state.timespan, upper=0)
+        self.axes.set_ybound(0, 0.1)
         self.axes.legend(self.state.fields, loc='upper left', bbox_to_anchor=(0, 1.1))
 
+    def plot_width(self):
+        '''width of the plot area in pixels'''
+        try:
+            return max(int(self.axes.get_window_extent().width), 100)
+        except Exception:
+            return 600
+
     def draw_plot(self):
         """ Redraws the plot
         """
         state = self.state
 
-        if len(self.data[0]) == 0:
-            print("no data to plot")
+        now = time.time()
+        (t, v) = self.data.data()
+        x = t - now
+        width = self.plot_width()
+        series = []
+        for i in range(len(self.plot_data)):
+            y = v[:,i]
+            # hold the last value up to now, as the values are only
+            # sent when a message arrives
+            valid = numpy.flatnonzero(numpy.isfinite(y))
+            if len(valid) > 0:
+                xi = numpy.append(x, 0)
+                yi = numpy.append(y, y[valid[-1]])
+            else:
+                xi = x
+                yi = y
+            series.append(decimate(xi, yi, -state.timespan, 0, width))
+
+        yvalues = [ y for (x, y) in series if numpy.isfinite(y).any() ]
+        if len(yvalues) == 0:
             return
-        vhigh = max(self.data[0])
-        vlow  = min(self.data[0])
-
-        for i in range(1,len(self.plot_data)):
-            vhigh = max(vhigh, max(self.data[i]))
-            vlow  = min(vlow,  min(self.data[i]))
+        vhigh = max([numpy.nanmax(y) for y in yvalues])
+        vlow  = min([numpy.nanmin(y) for y in yvalues])
         ymin = vlow  - 0.05*(vhigh-vlow)
         ymax = vhigh + 0.05*(vhigh-vlow)
 
         if ymin == ymax:
             ymax = ymin + 0.1 * ymin
             ymin = ymin - 0.1 * ymin
+            if ymin == ymax:
+                ymax = ymin + 0.1
 
         if (ymin, ymax) != self.last_yrange:
             self.last_yrange = (ymin, ymax)
@@ -129,16 +215,27 @@ class GraphFrame(wx.Frame):
             pylab.setp(self.axes.get_legend().get_texts(), fontsize='small')
 
         for i in range(len(self.plot_data)):
-            ydata = numpy.array(self.data[i])
-            xdata = self.xdata
-            if len(ydata) < len(self.xdata):
-                xdata = xdata[-len(ydata):]
+            (xdata, ydata) = series[i]
             self.plot_data[i].set_xdata(xdata)
             self.plot_data[i].set_ydata(ydata)
 
         self.canvas.draw()
         self.canvas.Refresh()
 
+    def add_samples(self, samples):
+        '''add a batch of (time, values) samples from the parent'''
+        nfields = len(self.state.fields)
+        t = numpy.array([s[0] for s in samples], dtype=float)
+        v = numpy.empty((len(samples), nfields))
+        for i in range(len(samples)):
+            values = samples[i][1]
+            for j in range(nfields):
+                try:
+                    v[i,j] = float(values[j])
+                except Exception:
+                    v[i,j] = numpy.nan
+        self.data.append(t, v)
+
     def on_pause_button(self, event):
         self.paused = not self.paused
 
@@ -163,16 +260,12 @@ class GraphFrame(wx.Frame):
             self.Destroy()
             return
         while state.child_pipe.poll():
-            state.values = state.child_pipe.recv()
+            samples = state.child_pipe.recv()
+            if not self.paused:
+                self.add_samples(samples)
         if self.paused:
             return
-        for i in range(len(self.plot_data)):
-            if state.values[i] is not None:
-                self.data[i].append(state.values[i])
-                while len(self.data[i]) > len(self.xdata):
-                    self.data[i].pop(0)
-
-        for i in range(len(self.plot_data)):
-            if state.values[i] is None or len(self.data[i]) < 2:
-                return
+        self.data.expire(time.time() - state.timespan)
+        if self.data.count < 2:
+            return
         self.draw_plot()
@@ -11,6 +11,7 @@ import sys
 import time
 
 from pymavlink import mavutil
+from MAVProxy.modules.lib import mp_logindex
 
 def mavfft_display(logfile, condition=None):
     '''display fft for raw ACC data in logfile'''
@@ -67,8 +68,16 @@ def mavfft_display(logfile, condition=None):
     plotdata = None
     start_time = time.time()
     mlog = mavutil.mavlink_connection(logfile)
+    reader = None
+    index = mp_logindex.load_index(mlog, logfile)
+    if index is not None:
+        reader = mp_logindex.IndexedReader(mlog, index, ['ISBH','ISBD'],
+                                           state_types=mp_logindex.log_types(condition))
     while True:
-        m = mlog.recv_match(type=['ISBH','ISBD'],condition=condition)
+        if reader is not None:
+            m = reader.recv_match(condition=condition)
+        else:
+            m = mlog.recv_match(type=['ISBH','ISBD'],condition=condition)
         if m is None:
             break
         msg_type = m.get_type()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+message type indexed dispatch of MAVLink packets to modules
+
+Modules can call self.subscribe([...]) to say which message types they
+want in mavlink_packet(). The dispatch table maps each message type to
+the list of modules that want it, so each packet only visits interested
+modules. Modules which do not subscribe get every message, and modules
+which do not override mavlink_packet() are never called.
+'''
+
+from MAVProxy.modules.lib import mp_module
+
+_base_mavlink_packet = getattr(mp_module.MPModule.mavlink_packet, '__func__',
+                               mp_module.MPModule.mavlink_packet)
+
+
+def wants_packets(mod):
+    '''return True if a module implements mavlink_packet()'''
+    fn = getattr(mod, 'mavlink_packet', None)
+    if fn is None:
+        return False
+    return getattr(fn, '__func__', fn) is not _base_mavlink_packet
+
+
+class ModuleDispatch(object):
+    '''per message type list of modules, rebuilt lazily'''
+    def __init__(self, mpstate):
+        self.mpstate = mpstate
+        self.table = {}
+        # per module dict of mtype -> [count, seconds]
+        self.stats = {}
+
+    def invalidate(self):
+        '''called when modules are loaded, unloaded or change subscriptions'''
+        self.table = {}
+
+    def modules_for(self, mtype):
+        '''return list of modules which want a message type'''
+        ret = self.table.get(mtype, None)
+        if ret is not None:
+            return ret
+        ret = []
+        for (mod, pm) in self.mpstate.modules:
+            if not wants_packets(mod):
+                continue
+            subs = getattr(mod, 'subscriptions', None)
+            if subs is not None and mtype not in subs:
+                continue
+            ret.append(mod)
+        self.table[mtype] = ret
+        return ret
+
+    def record(self, mod, mtype, dt):
+        '''record a call of mod.mavlink_packet'''
+        s = self.stats.get(mod.name, None)
+        if s is None:
+            s = {}
+            self.stats[mod.name] = s
+        c = s.get(mtype, None)
+        if c is None:
+            s[mtype] = [1, dt]
+        else:
+            c[0] += 1
+            c[1] += dt
+
+    def reset_stats(self):
+        self.stats = {}
+
+    def show_stats(self, modname=None):
+        '''print per module, per message type call counts and times'''
+        for name in sorted(self.stats.keys()):
+            if modname is not None and name != modname:
+                continue
+            s = self.stats[name]
+            total_count = sum([c[0] for c in s.values()])
+            total_time = sum([c[1] for c in s.values()])
+            print("%s: %u calls %.3fs" % (name, total_count, total_time))
+            for mtype in sorted(s.keys(), key=lambda t: s[t][1], reverse=True):
+                (count, dt) = s[mtype]
+                print("    %-28s %8u calls %8.3fs %8.1fus/call" % (mtype, count, dt, 1.0e6*dt/count))
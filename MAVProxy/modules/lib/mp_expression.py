@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+'''
+compiled graph and condition expressions
+
+mavutil.evaluate_expression() passes the expression string to eval(),
+so it is parsed again for every message. An Expression is compiled
+once, and evaluated with the same globals as pymavlink's
+mavexpression module (maths and mavextra functions) so it gives the
+same results, including returning None when a message is missing, on
+division by zero or on an out of range index. A trailing {CONDITION}
+gives None when the condition is false, as in mavexpression.
+
+The message types and fields an expression reads are found from the
+parse tree, so callers only need to evaluate it when one of those
+types arrives. Expressions over the fields of a single message type
+can also be evaluated over whole log columns with numpy, see
+mp_logcolumns.
+'''
+
+import ast, re
+
+from pymavlink import mavexpression
+
+# the namespace mavexpression.evaluate_expression() uses
+expression_globals = vars(mavexpression)
+
+re_caps = re.compile('[A-Z_][A-Z0-9_]+')
+re_simple = re.compile('^([A-Z][A-Z0-9_]*)[.]([A-Za-z_][A-Za-z0-9_]*)$')
+
+
+class Expression(object):
+    '''a compiled expression'''
+    def __init__(self, expression):
+        self.expression = expression
+        self.code = None
+        self.error = None
+        self.simple = None
+        self.msg_types = set()
+        self.fields = {}
+        self._vector = None
+        self._vector_checked = False
+        # EXPRESSION{CONDITION}, parsed the way mavexpression does
+        self.cond = None
+        self.cond_missing = False
+        if expression.endswith('}'):
+            idx = expression.rfind('{')
+            if idx == -1:
+                self.cond_missing = True
+                return
+            self.cond = Expression(expression[idx+1:-1])
+            self.msg_types.update(self.cond.msg_types)
+            for (mtype, fields) in self.cond.fields.items():
+                self.fields.setdefault(mtype, set()).update(fields)
+            expression = expression[:idx]
+        # eval() ignores leading spaces and tabs, compile() doesn't
+        source = expression.lstrip(' \t')
+        try:
+            self.code = compile(source, '<expression>', 'eval')
+            tree = ast.parse(source, mode='eval')
+        except Exception as e:
+            # raised when evaluated, as eval() would
+            self.error = e
+            self.msg_types.update(re.findall(re_caps, expression))
+            return
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Name) and node.id[0].isupper() and
+                node.id not in expression_globals):
+                self.msg_types.add(node.id)
+            elif (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and
+                  node.value.id[0].isupper()):
+                self.fields.setdefault(node.value.id, set()).add(node.attr)
+        m = re_simple.match(source.strip())
+        if m is not None:
+            self.simple = (m.group(1), m.group(2))
+
+    def evaluate(self, vars, nocondition=False):
+        '''evaluate with a dictionary of messages, returning None if a
+        message is missing or the {CONDITION} is false'''
+        if self.cond_missing:
+            return None
+        if self.cond is not None:
+            # any error in the condition gives None
+            if self.cond.error is not None:
+                return None
+            try:
+                v = eval(self.cond.code, expression_globals, vars)
+            except Exception:
+                return None
+            if not nocondition and not v:
+                return None
+        if self.simple is not None:
+            try:
+                m = vars[self.simple[0]]
+            except KeyError:
+                m = None
+            if m is not None:
+                return getattr(m, self.simple[1])
+        if self.error is not None:
+            raise self.error
+        try:
+            return eval(self.code, expression_globals, vars)
+        except NameError:
+            return None
+        except ZeroDivisionError:
+            return None
+        except IndexError:
+            return None
+
+    def condition(self, vars):
+        '''evaluate as a condition, False if a message is missing'''
+        v = self.evaluate(vars)
+        if v is None:
+            return False
+        return v
+
+    def vector(self):
+        '''return a mp_logcolumns.VectorExpression for evaluating over
+        log columns, or None'''
+        if not self._vector_checked:
+            self._vector_checked = True
+            if self.error is None and self.cond is None and len(self.msg_types) == 1:
+                from MAVProxy.modules.lib import mp_logcolumns
+                self._vector = mp_logcolumns.compile_expression(self.expression)
+        return self._vector
+
+
+_cache = {}
+
+def compile_expression(expression):
+    '''return a compiled Expression, shared between callers'''
+    e = _cache.get(expression, None)
+    if e is None:
+        if len(_cache) > 1000:
+            _cache.clear()
+        e = Expression(expression)
+        _cache[expression] = e
+    return e
+
+def evaluate_expression(expression, vars, nocondition=False):
+    '''drop in replacement for mavutil.evaluate_expression()'''
+    return compile_expression(expression).evaluate(vars, nocondition)
+
+def evaluate_condition(condition, vars):
+    '''drop in replacement for mavutil.evaluate_condition()'''
+    if condition is None:
+        return True
+    return compile_expression(condition).condition(vars)
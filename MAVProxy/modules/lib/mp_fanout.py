@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+'''
+batched fan-out of MAVLink packets to output links
+
+Packets from the master are queued per output and written once per
+main loop pass. For stream links (serial, TCP) the queued buffers are
+joined into a single write. For UDP links several MAVLink frames are
+packed into each datagram up to a size limit, which MAVLink receivers
+parse just like a byte stream. This greatly reduces the number of
+system calls when forwarding high rate telemetry to many outputs.
+'''
+
+import socket
+
+
+class OutputQueue(object):
+    '''pending buffers and counters for a single output'''
+    def __init__(self, conn):
+        self.conn = conn
+        self.bufs = []
+        self.nbytes = 0
+        self.high_water = 0
+        self.drops = 0
+        self.packets = 0
+        self.writes = 0
+        self.errors = 0
+        try:
+            self.is_udp = (conn.port.type == socket.SOCK_DGRAM)
+        except Exception:
+            self.is_udp = False
+
+    def depth(self):
+        '''number of queued packets'''
+        return len(self.bufs)
+
+    def put(self, buf, max_depth):
+        '''queue a buffer, dropping it if the queue is full'''
+        if max_depth > 0 and len(self.bufs) >= max_depth:
+            self.drops += 1
+            return False
+        self.bufs.append(buf)
+        self.nbytes += len(buf)
+        if len(self.bufs) > self.high_water:
+            self.high_water = len(self.bufs)
+        return True
+
+    def _write(self, buf):
+        try:
+            self.conn.write(buf)
+            self.writes += 1
+        except Exception:
+            self.errors += 1
+
+    def flush(self, udp_pack):
+        '''write all queued buffers'''
+        if len(self.bufs) == 0:
+            return
+        bufs = self.bufs
+        self.packets += len(bufs)
+        self.bufs = []
+        self.nbytes = 0
+        if not self.is_udp:
+            if len(bufs) == 1:
+                self._write(bufs[0])
+            else:
+                self._write(b''.join(bufs))
+            return
+        if udp_pack <= 0:
+            for b in bufs:
+                self._write(b)
+            return
+        # pack frames into datagrams of at most udp_pack bytes. A single
+        # frame bigger than the limit is sent on its own
+        pending = []
+        size = 0
+        for b in bufs:
+            if size + len(b) > udp_pack and len(pending) > 0:
+                self._write(b''.join(pending))
+                pending = []
+                size = 0
+            pending.append(b)
+            size += len(b)
+        if len(pending) > 0:
+            self._write(b''.join(pending))
+
+
+class FanOut(object):
+    '''per output queues, flushed once per main loop pass'''
+    def __init__(self):
+        self.queues = {}
+        self.pending = False
+
+    def queue(self, conn):
+        '''get (creating if needed) the queue for a connection'''
+        q = self.queues.get(conn, None)
+        if q is None:
+            q = OutputQueue(conn)
+            self.queues[conn] = q
+        return q
+
+    def put(self, conn, buf, max_depth=0):
+        '''queue a buffer for an output'''
+        if self.queue(conn).put(buf, max_depth):
+            self.pending = True
+
+    def flush(self, udp_pack=0):
+        '''write out all pending buffers'''
+        if not self.pending:
+            return
+        self.pending = False
+        for q in list(self.queues.values()):
+            q.flush(udp_pack)
+
+    def remove(self, conn):
+        '''forget about a connection, discarding anything queued'''
+        self.queues.pop(conn, None)
+
+    def stats(self, conn):
+        '''return the queue for a connection if we have one'''
+        return self.queues.get(conn, None)
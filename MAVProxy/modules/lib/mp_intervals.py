@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+set of integers held as sorted, non-overlapping ranges
+
+Used to track which parts of a file transfer have been received, where
+the number of ranges (one more than the number of gaps) is usually
+much smaller than the number of bytes or blocks.
+'''
+
+import bisect
+
+
+class IntervalSet(object):
+    '''a set of integers, held as sorted non-overlapping [start,end) ranges'''
+    def __init__(self, ranges=None):
+        self.starts = []
+        self.ends = []
+        self.size = 0
+        if ranges is not None:
+            for (start, end) in ranges:
+                self.add(start, end)
+
+    def __len__(self):
+        '''number of integers in the set'''
+        return self.size
+
+    def add(self, start, end):
+        '''add the range [start,end), merging with any ranges it touches'''
+        if end <= start:
+            return
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j-1])
+            for k in range(i, j):
+                self.size -= self.ends[k] - self.starts[k]
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+        self.size += end - start
+
+    def covered(self, start, end):
+        '''return how many integers in [start,end) are in the set'''
+        ret = 0
+        i = max(bisect.bisect_right(self.starts, start) - 1, 0)
+        while i < len(self.starts) and self.starts[i] < end:
+            ret += max(0, min(end, self.ends[i]) - max(start, self.starts[i]))
+            i += 1
+        return ret
+
+    def contains(self, start, end):
+        '''return True if all of [start,end) is in the set'''
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def first_gap(self, start, limit):
+        '''return the first (start,end) range not in the set between start
+        and limit, or None'''
+        i = bisect.bisect_right(self.starts, start) - 1
+        if i >= 0 and self.ends[i] > start:
+            start = self.ends[i]
+        if start >= limit:
+            return None
+        i += 1
+        if i < len(self.starts):
+            return (start, min(self.starts[i], limit))
+        return (start, limit)
+
+    def gaps(self, start, limit):
+        '''return a list of (start,end) ranges not in the set between start and limit'''
+        ret = []
+        while True:
+            gap = self.first_gap(start, limit)
+            if gap is None:
+                return ret
+            ret.append(gap)
+            start = gap[1]
+
+    def ranges(self):
+        '''return a list of (start,end) ranges in the set'''
+        return list(zip(self.starts, self.ends))
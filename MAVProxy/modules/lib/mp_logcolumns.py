@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+'''
+columnar cache of decoded log fields for graphing
+
+Each message type is decoded once into one numpy array per numeric
+field (plus a _timestamp column) and the arrays are cached as .npy
+files in a per-log cache directory, next to the log (or under
+~/.mavproxy/logcache if the log directory is not writeable).
+
+Graph expressions which only use fields of a single message type, and
+a known set of maths functions, can then be evaluated over whole
+columns at once. Anything else returns None from compile_expression()
+and must be evaluated one message at a time.
+'''
+
+import os, ast, operator, pickle, hashlib, glob
+import numpy
+
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_logindex
+
+CACHE_VERSION = 1
+
+# functions usable in vectorised expressions
+vector_functions = {
+    'sin' : numpy.sin,
+    'cos' : numpy.cos,
+    'tan' : numpy.tan,
+    'asin' : numpy.arcsin,
+    'acos' : numpy.arccos,
+    'atan' : numpy.arctan,
+    'atan2' : numpy.arctan2,
+    'sqrt' : numpy.sqrt,
+    'exp' : numpy.exp,
+    'log' : numpy.log,
+    'log10' : numpy.log10,
+    'fabs' : numpy.fabs,
+    'abs' : numpy.abs,
+    'floor' : numpy.floor,
+    'ceil' : numpy.ceil,
+    'degrees' : numpy.degrees,
+    'radians' : numpy.radians,
+    'min' : numpy.minimum,
+    'max' : numpy.maximum,
+}
+
+vector_constants = {
+    'pi' : numpy.pi,
+    'e' : numpy.e,
+}
+
+binary_ops = {
+    ast.Add : operator.add,
+    ast.Sub : operator.sub,
+    ast.Mult : operator.mul,
+    ast.Div : numpy.true_divide,
+    ast.FloorDiv : numpy.floor_divide,
+    ast.Mod : numpy.mod,
+    ast.Pow : numpy.power,
+}
+
+unary_ops = {
+    ast.USub : operator.neg,
+    ast.UAdd : operator.pos,
+    ast.Not : numpy.logical_not,
+}
+
+compare_ops = {
+    ast.Eq : operator.eq,
+    ast.NotEq : operator.ne,
+    ast.Lt : operator.lt,
+    ast.LtE : operator.le,
+    ast.Gt : operator.gt,
+    ast.GtE : operator.ge,
+}
+
+def number_value(node):
+    '''return the value of a numeric constant node, or None'''
+    if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+        v = node.value
+    elif hasattr(ast, 'Num') and isinstance(node, ast.Num):
+        v = node.n
+    else:
+        return None
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return None
+    return v
+
+
+class VectorExpression(object):
+    '''an expression over the fields of one message type'''
+    def __init__(self, expression, tree, mtype):
+        self.expression = expression
+        self.tree = tree
+        self.mtype = mtype
+
+    def _eval(self, node, cols):
+        v = number_value(node)
+        if v is not None:
+            return v
+        if isinstance(node, ast.Expression):
+            return self._eval(node.body, cols)
+        if isinstance(node, ast.Attribute):
+            return cols[node.attr]
+        if isinstance(node, ast.Name):
+            return vector_constants[node.id]
+        if isinstance(node, ast.BinOp):
+            return binary_ops[type(node.op)](self._eval(node.left, cols), self._eval(node.right, cols))
+        if isinstance(node, ast.UnaryOp):
+            return unary_ops[type(node.op)](self._eval(node.operand, cols))
+        if isinstance(node, ast.Call):
+            args = [self._eval(a, cols) for a in node.args]
+            return vector_functions[node.func.id](*args)
+        if isinstance(node, ast.Compare):
+            left = self._eval(node.left, cols)
+            ret = True
+            for (op, comparator) in zip(node.ops, node.comparators):
+                right = self._eval(comparator, cols)
+                ret = numpy.logical_and(ret, compare_ops[type(op)](left, right))
+                left = right
+            return ret
+        if isinstance(node, ast.BoolOp):
+            values = [self._eval(v, cols) for v in node.values]
+            if isinstance(node.op, ast.And):
+                return numpy.logical_and.reduce(values)
+            return numpy.logical_or.reduce(values)
+        raise ValueError("unsupported expression")
+
+    def evaluate(self, cols):
+        '''evaluate over a dictionary of columns, returning a float
+        array with one element per message, or None if a field is
+        missing'''
+        try:
+            with numpy.errstate(all='ignore'):
+                ret = self._eval(self.tree, cols)
+        except KeyError:
+            return None
+        n = len(cols['_timestamp'])
+        return numpy.broadcast_to(numpy.asarray(ret, dtype=float), (n,))
+
+
+def _check_node(node, types):
+    '''check a node can be vectorised, adding message types used to types'''
+    if number_value(node) is not None:
+        return True
+    if isinstance(node, ast.Expression):
+        return _check_node(node.body, types)
+    if isinstance(node, ast.Attribute):
+        if not isinstance(node.value, ast.Name) or not node.value.id[0].isupper():
+            return False
+        types.add(node.value.id)
+        return True
+    if isinstance(node, ast.Name):
+        return node.id in vector_constants
+    if isinstance(node, ast.BinOp):
+        return (type(node.op) in binary_ops and
+                _check_node(node.left, types) and _check_node(node.right, types))
+    if isinstance(node, ast.UnaryOp):
+        return type(node.op) in unary_ops and _check_node(node.operand, types)
+    if isinstance(node, ast.Call):
+        if (not isinstance(node.func, ast.Name) or node.func.id not in vector_functions or
+            len(node.keywords) != 0 or getattr(node, 'starargs', None) is not None or
+            getattr(node, 'kwargs', None) is not None):
+            return False
+        # numpy takes extra arguments as outputs, so calls such as
+        # min(a,b,c) or log(x,10) are left to per-message evaluation
+        if len(node.args) != vector_functions[node.func.id].nin:
+            return False
+        return all([_check_node(a, types) for a in node.args])
+    if isinstance(node, ast.Compare):
+        for op in node.ops:
+            if type(op) not in compare_ops:
+                return False
+        return _check_node(node.left, types) and all([_check_node(c, types) for c in node.comparators])
+    if isinstance(node, ast.BoolOp):
+        return all([_check_node(v, types) for v in node.values])
+    return False
+
+def compile_expression(expression):
+    '''return a VectorExpression, or None if the expression can't be
+    evaluated over columns'''
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except Exception:
+        return None
+    types = set()
+    if not _check_node(tree, types) or len(types) != 1:
+        return None
+    return VectorExpression(expression, tree, types.pop())
+
+
+def to_array(values):
+    '''convert a list of field values to a typed array, or None if not numeric'''
+    try:
+        a = numpy.array(values)
+    except Exception:
+        return None
+    if a.ndim != 1 or a.dtype.kind not in 'biuf':
+        return None
+    return a
+
+
+def cache_paths(filename):
+    '''possible cache directories for a log'''
+    ret = [filename + '.cache']
+    h = hashlib.md5(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    ret.append(os.path.join(mp_util.dot_mavproxy('logcache'), h))
+    return ret
+
+
+class LogColumns(object):
+    '''column cache for one log file'''
+    def __init__(self, filename):
+        self.filename = filename
+        st = os.stat(filename)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.types = {}
+        self.columns = {}
+        self.cache_dir = None
+        for path in cache_paths(filename):
+            if self._load_meta(path):
+                self.cache_dir = path
+                break
+
+    def _load_meta(self, path):
+        try:
+            f = open(os.path.join(path, 'meta.pkl'), 'rb')
+            d = pickle.load(f)
+            f.close()
+        except Exception:
+            return False
+        if (d.get('version', None) != CACHE_VERSION or
+            d['size'] != self.size or d['mtime'] != self.mtime):
+            return False
+        self.types = d['types']
+        return True
+
+    def _save_meta(self):
+        tmp = os.path.join(self.cache_dir, 'meta.pkl.tmp')
+        f = open(tmp, 'wb')
+        pickle.dump({ 'version' : CACHE_VERSION,
+                      'size' : self.size,
+                      'mtime' : self.mtime,
+                      'types' : self.types }, f, 2)
+        f.close()
+        os.rename(tmp, os.path.join(self.cache_dir, 'meta.pkl'))
+
+    def _create_cache_dir(self):
+        '''find a writeable cache directory, removing any stale columns'''
+        for path in cache_paths(self.filename):
+            try:
+                mp_util.mkdir_p(path)
+                for old in glob.glob(os.path.join(path, '*.npy')):
+                    os.unlink(old)
+                self.cache_dir = path
+                self._save_meta()
+                return True
+            except Exception:
+                continue
+        self.cache_dir = None
+        return False
+
+    def column_path(self, mtype, field):
+        return os.path.join(self.cache_dir, '%s.%s.npy' % (mtype, field))
+
+    def _load_type(self, mtype):
+        cols = {}
+        for field in self.types[mtype]:
+            cols[field] = numpy.load(self.column_path(mtype, field), mmap_mode='r')
+        self.columns[mtype] = cols
+
+    def extract(self, mlog, types, index=None):
+        '''decode all numeric fields of some message types in one pass over the log'''
+        lists = {}
+        fieldnames = {}
+        for mtype in types:
+            lists[mtype] = None
+        if index is not None:
+            reader = mp_logindex.IndexedReader(mlog, index, types)
+        else:
+            mlog.rewind()
+            reader = None
+        while True:
+            if reader is not None:
+                m = reader.recv_match()
+            else:
+                m = mlog.recv_match(type=types)
+            if m is None:
+                break
+            mtype = m.get_type()
+            if mtype not in lists:
+                continue
+            cols = lists[mtype]
+            if cols is None:
+                fieldnames[mtype] = list(m.get_fieldnames())
+                cols = { '_timestamp' : [] }
+                for field in fieldnames[mtype]:
+                    cols[field] = []
+                lists[mtype] = cols
+            cols['_timestamp'].append(m._timestamp)
+            for field in fieldnames[mtype]:
+                cols[field].append(getattr(m, field, None))
+        mlog.rewind()
+
+        if self.cache_dir is None:
+            self._create_cache_dir()
+        for mtype in types:
+            cols = {}
+            if lists[mtype] is None:
+                cols['_timestamp'] = numpy.zeros(0)
+            else:
+                for field in lists[mtype]:
+                    a = to_array(lists[mtype][field])
+                    if a is not None:
+                        cols[field] = a
+            lists[mtype] = None
+            self.columns[mtype] = cols
+            if self.cache_dir is None:
+                continue
+            try:
+                for field in cols:
+                    numpy.save(self.column_path(mtype, field), cols[field])
+                self.types[mtype] = list(cols.keys())
+            except Exception:
+                pass
+        if self.cache_dir is not None:
+            try:
+                self._save_meta()
+            except Exception:
+                pass
+
+    def get(self, mlog, types, index=None):
+        '''return a dictionary of columns for each message type, decoding
+        any types not already cached'''
+        missing = []
+        for mtype in types:
+            if mtype in self.columns:
+                continue
+            if mtype in self.types:
+                try:
+                    self._load_type(mtype)
+                    continue
+                except Exception:
+                    pass
+            missing.append(mtype)
+        if len(missing) > 0:
+            self.extract(mlog, missing, index)
+        ret = {}
+        for mtype in types:
+            ret[mtype] = self.columns[mtype]
+        return ret
+
+
+# LogColumns objects by filename, so decoded columns are shared between graphs
+column_cache = {}
+
+def get_columns(filename):
+    '''return a LogColumns object for a log file, or None if it is not a file'''
+    if filename is None or not os.path.isfile(filename):
+        return None
+    try:
+        st = os.stat(filename)
+        ret = column_cache.get(filename, None)
+        if ret is None or ret.size != st.st_size or ret.mtime != st.st_mtime:
+            ret = LogColumns(filename)
+            column_cache[filename] = ret
+        return ret
+    except OSError:
+        return None
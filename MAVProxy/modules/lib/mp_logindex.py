@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+'''
+persistent index of message offsets in telemetry and dataflash logs
+
+The index maps each message type to the file offsets and timestamps
+of every message of that type, plus a coarse time to offset index. It
+is built with one pass over the log and saved in a sidecar file next
+to the log (or under ~/.mavproxy/logindex if the log directory is not
+writeable). The sidecar is invalidated when the log size or mtime
+changes.
+
+IndexedReader uses the index to read just the message types (and time
+ranges) a graph or map needs, seeking straight to each message.
+'''
+
+import os, array, bisect, heapq, pickle, hashlib
+
+from pymavlink import mavutil
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_expression
+
+INDEX_VERSION = 1
+
+try:
+    array.array('q')
+    OFFSET_TYPE = 'q'
+except ValueError:
+    OFFSET_TYPE = 'l'
+
+# message types needed to keep flightmode and vehicle type tracking
+# working in the log readers when only some types are read
+STATE_TYPES = set(['HEARTBEAT', 'MODE', 'MSG', 'STAT'])
+
+
+def supported(mlog):
+    '''return True if we know how to seek in this log reader'''
+    if isinstance(mlog, mavutil.mavlogfile):
+        return not mlog.planner_format and not mlog.notimestamps
+    return hasattr(mlog, 'offset') and hasattr(mlog, 'data_len')
+
+def log_tell(mlog):
+    '''return the offset of the next message in a log'''
+    if isinstance(mlog, mavutil.mavlogfile):
+        return mlog.f.tell()
+    return mlog.offset
+
+def log_seek(mlog, ofs):
+    '''position a log so the next recv_msg() returns the message at ofs'''
+    if isinstance(mlog, mavutil.mavlogfile):
+        mlog.f.seek(ofs)
+        mav = mlog.mav
+        if mav.buf_len() != 0:
+            # throw away any partial packet from before the seek
+            mav.buf = bytearray()
+            mav.buf_index = 0
+            mav.expected_length = getattr(mavutil.mavlink, 'HEADER_LEN_V1', 6) + 2
+    else:
+        mlog.offset = ofs
+        mlog.remaining = mlog.data_len - ofs
+
+def log_rewind(mlog):
+    '''rewind a log to the start'''
+    if hasattr(mlog, 'rewind'):
+        mlog.rewind()
+    else:
+        log_seek(mlog, 0)
+
+def log_types(expression):
+    '''return the set of message types used in an expression'''
+    if expression is None:
+        return set()
+    return set(mp_expression.compile_expression(expression).msg_types)
+
+
+class LogIndex(object):
+    '''message type and time index for one log file'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.types = {}
+        self.time_index = (array.array('d'), array.array(OFFSET_TYPE))
+        self.count = 0
+        st = os.stat(filename)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+
+    def build(self, mlog, progress_callback=None):
+        '''scan the whole log, recording the offset and timestamp of each message'''
+        log_rewind(mlog)
+        pct = 0
+        last_second = None
+        (tarray, oarray) = self.time_index
+        while True:
+            ofs = log_tell(mlog)
+            m = mlog.recv_msg()
+            if m is None:
+                break
+            mtype = m.get_type()
+            if mtype == 'BAD_DATA':
+                continue
+            t = m._timestamp
+            if mtype not in self.types:
+                self.types[mtype] = (array.array(OFFSET_TYPE), array.array('d'))
+            (offsets, stamps) = self.types[mtype]
+            offsets.append(ofs)
+            stamps.append(t)
+            self.count += 1
+            second = int(t)
+            if second != last_second:
+                tarray.append(t)
+                oarray.append(ofs)
+                last_second = second
+            if progress_callback is not None:
+                new_pct = (100 * ofs) // max(self.size, 1)
+                if new_pct != pct:
+                    progress_callback(new_pct)
+                    pct = new_pct
+        log_rewind(mlog)
+
+    def valid(self):
+        '''check the log has not changed since the index was built'''
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        return st.st_size == self.size and st.st_mtime == self.mtime
+
+    def type_count(self, mtype):
+        if mtype not in self.types:
+            return 0
+        return len(self.types[mtype][0])
+
+    def time_offset(self, t):
+        '''return file offset to start reading at to get messages from time t'''
+        (tarray, oarray) = self.time_index
+        i = bisect.bisect_right(tarray, t) - 1
+        if i < 0:
+            return 0
+        return oarray[i]
+
+    def entries(self, types, time_ranges=None):
+        '''return a list of (offset, timestamp) for the given message
+        types, in file order, optionally limited to a list of (t0,t1)
+        time ranges'''
+        lists = []
+        for mtype in types:
+            if mtype not in self.types:
+                continue
+            (offsets, stamps) = self.types[mtype]
+            if time_ranges is None:
+                lists.append(zip(offsets, stamps))
+                continue
+            for (t0, t1) in time_ranges:
+                i0 = bisect.bisect_left(stamps, t0)
+                i1 = bisect.bisect_right(stamps, t1)
+                lists.append(zip(offsets[i0:i1], stamps[i0:i1]))
+        return list(heapq.merge(*lists))
+
+    def save(self, path):
+        '''save the index to a file'''
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        pickle.dump({ 'version' : INDEX_VERSION,
+                      'size' : self.size,
+                      'mtime' : self.mtime,
+                      'count' : self.count,
+                      'types' : self.types,
+                      'time_index' : self.time_index }, f, 2)
+        f.close()
+        os.rename(tmp, path)
+
+    def load(self, path):
+        '''load an index from a file, returning False if it is missing or stale'''
+        try:
+            f = open(path, 'rb')
+            d = pickle.load(f)
+            f.close()
+        except Exception:
+            return False
+        if (d.get('version', None) != INDEX_VERSION or
+            d['size'] != self.size or d['mtime'] != self.mtime):
+            return False
+        self.count = d['count']
+        self.types = d['types']
+        self.time_index = d['time_index']
+        return True
+
+
+def index_paths(filename):
+    '''possible sidecar index paths for a log'''
+    ret = [filename + '.idx']
+    h = hashlib.md5(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    ret.append(os.path.join(mp_util.dot_mavproxy('logindex'), h + '.idx'))
+    return ret
+
+def load_index(mlog, filename):
+    '''load a saved index for a log, returning None if there is no valid index'''
+    if not supported(mlog):
+        return None
+    index = LogIndex(filename)
+    for path in index_paths(filename):
+        if index.load(path):
+            return index
+    return None
+
+def get_index(mlog, filename, progress_callback=None):
+    '''load the index for a log, building and saving it if needed'''
+    if not supported(mlog):
+        return None
+    index = load_index(mlog, filename)
+    if index is not None:
+        return index
+    index = LogIndex(filename)
+    index.build(mlog, progress_callback=progress_callback)
+    for path in index_paths(filename):
+        try:
+            mp_util.mkdir_p(os.path.dirname(path))
+            index.save(path)
+            break
+        except Exception:
+            continue
+    return index
+
+
+class IndexedReader(object):
+    '''read selected message types from a log using an index. Messages of
+    state_types are also read (in file order) so that mlog.messages, the
+    flightmode and anything used by a condition is kept up to date, but
+    only messages of the wanted types are returned'''
+    def __init__(self, mlog, index, types, state_types=None, time_ranges=None):
+        self.mlog = mlog
+        self.types = set(types)
+        read_types = set(self.types)
+        if state_types is not None:
+            read_types.update(state_types)
+        self.entries = index.entries(read_types, time_ranges)
+        self.pos = 0
+
+    def recv_match(self, condition=None):
+        '''return the next wanted message that passes the condition'''
+        mlog = self.mlog
+        while self.pos < len(self.entries):
+            (ofs, tstamp) = self.entries[self.pos]
+            self.pos += 1
+            log_seek(mlog, ofs)
+            m = mlog.recv_msg()
+            if m is None:
+                continue
+            # use the timestamp from the sequential scan, as some
+            # dataflash clocks depend on reading every message
+            m._timestamp = tstamp
+            if m.get_type() not in self.types:
+                continue
+            if condition is not None and not mp_expression.evaluate_condition(condition, mlog.messages):
+                continue
+            return m
+        return None
@@ -16,6 +16,8 @@ class MPModule(object):
         self.needs_unloading = False
         self.multi_instance = multi_instance
         self.multi_vehicle = multi_vehicle
+        # message types wanted by mavlink_packet(), None for all
+        self.subscriptions = None
 
         if description is None:
             self.description = name + " handling"
@@ -60,6 +62,16 @@ class MPModule(object):
         '''Find a public module (most modules are private)'''
         return self.mpstate.module(name)
 
+    def subscribe(self, msg_types):
+        '''only pass the listed message types to mavlink_packet(). Modules
+        which never subscribe get all message types'''
+        if self.subscriptions is None:
+            self.subscriptions = set()
+        self.subscriptions.update(msg_types)
+        dispatch = getattr(self.mpstate, 'dispatch', None)
+        if dispatch is not None:
+            dispatch.invalidate()
+
     def module_matching(self, name):
         '''Find a list of modules matching a wildcard pattern'''
         import fnmatch
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+'''
+low overhead profiling of module hooks
+
+Each call of a module mavlink_packet() or idle_task() is timed. For
+each module and hook we keep the call count, total time, worst case
+time and a ring of recent call times used for p50/p99 estimates.
+
+An optional watchdog thread warns when a single module call has been
+blocking the main loop for longer than a threshold.
+'''
+
+import time, threading, json
+
+class HookStats(object):
+    '''timing statistics for one module hook'''
+    def __init__(self, nsamples):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.samples = [0.0] * nsamples
+        self.idx = 0
+
+    def add(self, dt):
+        self.count += 1
+        self.total += dt
+        if dt > self.worst:
+            self.worst = dt
+        self.samples[self.idx] = dt
+        self.idx = (self.idx + 1) % len(self.samples)
+
+    def percentile(self, pct):
+        '''return a percentile of the recent call times'''
+        n = min(self.count, len(self.samples))
+        if n == 0:
+            return 0.0
+        s = sorted(self.samples[:n])
+        i = int(round((pct/100.0) * (n-1)))
+        return s[i]
+
+    def to_dict(self):
+        return { 'count' : self.count,
+                 'total_s' : self.total,
+                 'p50_s' : self.percentile(50),
+                 'p99_s' : self.percentile(99),
+                 'worst_s' : self.worst }
+
+
+class ModuleProfiler(object):
+    '''time module hook calls'''
+    def __init__(self, nsamples=1024):
+        self.nsamples = nsamples
+        self.stats = {}
+        # stack of (modname, hook, start_time) for calls in progress
+        self.active = []
+        self.stall_ms = 0
+        self.last_warning = {}
+        self.warn_fn = None
+        self.watchdog = None
+
+    def begin(self, modname, hook):
+        '''mark the start of a module call'''
+        self.active.append((modname, hook, time.time()))
+
+    def end(self):
+        '''mark the end of a module call, returning the time it took'''
+        (modname, hook, t0) = self.active.pop()
+        dt = time.time() - t0
+        key = (modname, hook)
+        s = self.stats.get(key, None)
+        if s is None:
+            s = HookStats(self.nsamples)
+            self.stats[key] = s
+        s.add(dt)
+        return dt
+
+    def reset(self):
+        self.stats = {}
+
+    def start_watchdog(self, stall_ms, warn_fn=None):
+        '''warn whenever a module call blocks for more than stall_ms'''
+        self.stall_ms = stall_ms
+        self.warn_fn = warn_fn
+        if stall_ms <= 0 or self.watchdog is not None:
+            return
+        self.watchdog = threading.Thread(target=self.watchdog_thread, name='profile_watchdog')
+        self.watchdog.daemon = True
+        self.watchdog.start()
+
+    def watchdog_thread(self):
+        '''check for stalled module calls'''
+        warned = None
+        while self.stall_ms > 0:
+            time.sleep(max(self.stall_ms * 0.5e-3, 0.01))
+            try:
+                (modname, hook, t0) = self.active[-1]
+            except IndexError:
+                continue
+            blocked = time.time() - t0
+            if blocked * 1000 < self.stall_ms or warned == (modname, hook, t0):
+                continue
+            warned = (modname, hook, t0)
+            msg = "WARNING: module %s %s blocking for %.0fms" % (modname, hook, blocked*1000)
+            if self.warn_fn is not None:
+                self.warn_fn(msg)
+            else:
+                print(msg)
+        self.watchdog = None
+
+    def sorted_keys(self):
+        '''keys sorted by total time, biggest first'''
+        return sorted(self.stats.keys(), key=lambda k: self.stats[k].total, reverse=True)
+
+    def show(self):
+        '''print a profile table'''
+        print("%-20s %-15s %9s %9s %9s %9s %9s" % ("module", "hook", "calls", "total(s)",
+                                                 "p50(ms)", "p99(ms)", "worst(ms)"))
+        for key in self.sorted_keys():
+            s = self.stats[key]
+            print("%-20s %-15s %9u %9.3f %9.3f %9.3f %9.3f" % (key[0], key[1], s.count, s.total,
+                                                           s.percentile(50)*1000,
+                                                           s.percentile(99)*1000,
+                                                           s.worst*1000))
+
+    def to_json(self):
+        '''return profile as a JSON string'''
+        ret = {}
+        for (modname, hook) in self.sorted_keys():
+            if modname not in ret:
+                ret[modname] = {}
+            ret[modname][hook] = self.stats[(modname, hook)].to_dict()
+        return json.dumps(ret, indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        '''return profile in the Prometheus text exposition format'''
+        lines = []
+        lines.append('# HELP mavproxy_module_calls_total Number of module hook calls')
+        lines.append('# TYPE mavproxy_module_calls_total counter')
+        for (modname, hook) in self.sorted_keys():
+            lines.append('mavproxy_module_calls_total{module="%s",hook="%s"} %u' % (
+                modname, hook, self.stats[(modname, hook)].count))
+        lines.append('# HELP mavproxy_module_seconds_total Time spent in module hooks')
+        lines.append('# TYPE mavproxy_module_seconds_total counter')
+        for (modname, hook) in self.sorted_keys():
+            lines.append('mavproxy_module_seconds_total{module="%s",hook="%s"} %.9f' % (
+                modname, hook, self.stats[(modname, hook)].total))
+        lines.append('# HELP mavproxy_module_latency_seconds Recent module hook call latency')
+        lines.append('# TYPE mavproxy_module_latency_seconds gauge')
+        for (modname, hook) in self.sorted_keys():
+            s = self.stats[(modname, hook)]
+            for q in [50, 99]:
+                lines.append('mavproxy_module_latency_seconds{module="%s",hook="%s",quantile="0.%02u"} %.9f' % (
+                    modname, hook, q, s.percentile(q)))
+        lines.append('# HELP mavproxy_module_worst_seconds Worst case module hook call time')
+        lines.append('# TYPE mavproxy_module_worst_seconds gauge')
+        for (modname, hook) in self.sorted_keys():
+            lines.append('mavproxy_module_worst_seconds{module="%s",hook="%s"} %.9f' % (
+                modname, hook, self.stats[(modname, hook)].worst))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+'''
+event driven file descriptor reactor for the MAVProxy main loop
+
+Instead of rebuilding a list of file descriptors and calling select()
+on every pass of the main loop, the reactor registers each descriptor
+once with epoll (or poll where epoll is not available) and keeps a
+map from descriptor to handler. The map is only rebuilt when the set
+of links, outputs or extra descriptors changes.
+'''
+
+import select, errno
+
+
+class FDMap(dict):
+    '''a dictionary which calls a function whenever it is modified. This
+    is used for mpstate.select_extra so that modules which register their
+    own file descriptors cause the reactor to refresh its handler map'''
+    def __init__(self, on_change=None, *args, **kwargs):
+        super(FDMap, self).__init__(*args, **kwargs)
+        self.on_change = on_change
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def __setitem__(self, key, value):
+        super(FDMap, self).__setitem__(key, value)
+        self.changed()
+
+    def __delitem__(self, key):
+        super(FDMap, self).__delitem__(key)
+        self.changed()
+
+    def pop(self, *args):
+        ret = super(FDMap, self).pop(*args)
+        self.changed()
+        return ret
+
+    def popitem(self):
+        ret = super(FDMap, self).popitem()
+        self.changed()
+        return ret
+
+    def clear(self):
+        super(FDMap, self).clear()
+        self.changed()
+
+    def update(self, *args, **kwargs):
+        super(FDMap, self).update(*args, **kwargs)
+        self.changed()
+
+    def setdefault(self, key, default=None):
+        ret = super(FDMap, self).setdefault(key, default)
+        self.changed()
+        return ret
+
+
+class MPReactor(object):
+    '''keep a set of file descriptors registered with epoll/poll and
+    dispatch ready descriptors to their handlers'''
+    def __init__(self):
+        self.handlers = {}
+        self.dirty = True
+        self.signature = None
+        self.poller = None
+        self.use_epoll = False
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.use_epoll = True
+            self.events = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+        elif hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.events = select.POLLIN | select.POLLERR | select.POLLHUP
+        self.wakeups = 0
+        self.rebuilds = 0
+
+    def available(self):
+        '''return True if this platform supports the reactor'''
+        return self.poller is not None
+
+    def invalidate(self):
+        '''mark the handler map as needing a rebuild'''
+        self.dirty = True
+
+    def needs_update(self, signature=None):
+        '''return True if the handler map needs rebuilding. The signature
+        is a cheap summary of state that can change without an explicit
+        invalidate(), such as a reconnected serial port getting a new fd'''
+        if signature != self.signature:
+            self.signature = signature
+            self.dirty = True
+        return self.dirty
+
+    def _unregister(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except Exception:
+            pass
+
+    def _register(self, fd):
+        try:
+            self.poller.register(fd, self.events)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EEXIST:
+                return False
+            self.poller.modify(fd, self.events)
+        except ValueError:
+            # closed or invalid descriptor
+            return False
+        return True
+
+    def set_handlers(self, handlers):
+        '''set the full fd->handler map. Every descriptor is registered
+        again, as epoll drops a registration when its file is closed and
+        a new file can be opened with the same fd number'''
+        for fd in list(self.handlers.keys()):
+            if fd not in handlers:
+                self._unregister(fd)
+                self.handlers.pop(fd)
+        for fd in handlers:
+            if self._register(fd):
+                self.handlers[fd] = handlers[fd]
+            else:
+                self.handlers.pop(fd, None)
+        self.dirty = False
+        self.rebuilds += 1
+
+    def remove(self, fd):
+        '''remove a single descriptor, for example after a handler error'''
+        if fd in self.handlers:
+            self._unregister(fd)
+            self.handlers.pop(fd)
+
+    def poll(self, timeout):
+        '''wait up to timeout seconds, returning a list of (fd, handler)
+        for the ready descriptors'''
+        if len(self.handlers) == 0:
+            return []
+        try:
+            if self.use_epoll:
+                events = self.poller.poll(timeout)
+            else:
+                events = self.poller.poll(int(timeout*1000))
+        except (IOError, OSError, select.error):
+            # interrupted system call
+            return []
+        self.wakeups += 1
+        ret = []
+        for (fd, event) in events:
+            h = self.handlers.get(fd, None)
+            if h is not None:
+                ret.append((fd, h))
+        return ret
+
+    def close(self):
+        '''close the poller'''
+        if self.use_epoll:
+            self.poller.close()
+        self.poller = None
+        self.handlers = {}
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+'''
+buffered telemetry log writer
+
+Packets are appended into a preallocated buffer by the main thread and
+written out in large chunks by a writer thread, either when the buffer
+passes a size threshold or on a timer. The writer thread swaps between
+two buffers so the main thread never waits for the disk.
+
+Logs can optionally be rotated by size or age. Closed segments are
+renamed to NAME-NNNN.tlog and can be compressed with gzip (or zstd if
+the zstandard module is installed) in a background thread. Segments
+always end on a packet boundary, so each one is a valid tlog.
+'''
+
+import os, time, struct, threading, shutil
+
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+
+class LogWriter(object):
+    '''double buffered log file writer. settings is an MPSettings object
+    providing flushlogs, log_buffer_kb, log_flush_interval, log_rotate_mb,
+    log_rotate_min and log_compress'''
+    def __init__(self, settings, bufsize=1024*1024):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.buf = bytearray(bufsize)
+        self.spare = bytearray(bufsize)
+        self.used = 0
+        self.event = threading.Event()
+        self.file = None
+        self.filename = None
+        self.file_size = 0
+        self.open_time = 0
+        self.thread = None
+        self.compress_queue = None
+        self.closing = False
+        self.bytes_written = 0
+        self.writes = 0
+        self.grows = 0
+        self.segments = []
+
+    def _grow(self, needed):
+        '''grow the active buffer. This only happens if the writer thread
+        falls a long way behind'''
+        newbuf = bytearray(max(needed, 2*len(self.buf)))
+        newbuf[:self.used] = self.buf[:self.used]
+        self.buf = newbuf
+        self.grows += 1
+
+    def _queued(self):
+        if self.settings.flushlogs or self.used >= self.settings.log_buffer_kb*1024:
+            self.event.set()
+
+    def put(self, data):
+        '''append raw data to the log'''
+        n = len(data)
+        with self.lock:
+            end = self.used + n
+            if end > len(self.buf):
+                self._grow(end)
+            self.buf[self.used:end] = data
+            self.used = end
+        self._queued()
+
+    def put_tlog(self, usec, msgbuf):
+        '''append a packet with a tlog timestamp header'''
+        n = 8 + len(msgbuf)
+        with self.lock:
+            end = self.used + n
+            if end > len(self.buf):
+                self._grow(end)
+            struct.pack_into('>Q', self.buf, self.used, usec)
+            self.buf[self.used+8:end] = msgbuf
+            self.used = end
+        self._queued()
+
+    def open(self, filename, mode='wb'):
+        '''open the log file and start the writer thread. Data queued
+        before the file is opened is kept'''
+        self.filename = filename
+        self.file = open(filename, mode=mode)
+        self.file_size = self.file.tell() if 'a' in mode else 0
+        self.open_time = time.time()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.writer_thread, name='log_writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def writer_thread(self):
+        '''flush the buffer periodically'''
+        while not self.closing:
+            self.event.wait(self.settings.log_flush_interval)
+            self.event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("ERROR: writing log %s: %s" % (self.filename, e))
+                time.sleep(1)
+
+    def flush(self):
+        '''write out the buffered data'''
+        with self.flush_lock:
+            if self.file is None:
+                return
+            with self.lock:
+                if self.used == 0:
+                    return
+                (buf, n) = (self.buf, self.used)
+                (self.buf, self.spare) = (self.spare, buf)
+                self.used = 0
+            self.file.write(memoryview(buf)[:n])
+            self.file.flush()
+            self.file_size += n
+            self.bytes_written += n
+            self.writes += 1
+            if self.rotate_due():
+                self.rotate()
+
+    def rotate_due(self):
+        '''see if the current segment should be closed'''
+        rotate_mb = self.settings.log_rotate_mb
+        rotate_min = self.settings.log_rotate_min
+        if rotate_mb > 0 and self.file_size >= rotate_mb * 1024 * 1024:
+            return True
+        if rotate_min > 0 and time.time() - self.open_time >= rotate_min * 60:
+            return True
+        return False
+
+    def segment_name(self):
+        '''return the name for the next closed segment'''
+        (base, ext) = os.path.splitext(self.filename)
+        i = len(self.segments) + 1
+        while True:
+            name = "%s-%04u%s" % (base, i, ext)
+            if not any([os.path.exists(name + x) for x in ['', '.gz', '.zst']]):
+                return name
+            i += 1
+
+    def rotate(self):
+        '''close the current segment and start a new one'''
+        self.file.close()
+        segname = self.segment_name()
+        os.rename(self.filename, segname)
+        self.segments.append(segname)
+        self.file = open(self.filename, mode='wb')
+        self.file_size = 0
+        self.open_time = time.time()
+        if self.settings.log_compress != 'none':
+            self.compress(segname, self.settings.log_compress)
+
+    def compress(self, filename, method):
+        '''queue a closed segment for compression'''
+        if self.compress_queue is None:
+            self.compress_queue = Queue.Queue()
+            t = threading.Thread(target=self.compress_thread, name='log_compress')
+            t.daemon = True
+            t.start()
+        self.compress_queue.put((filename, method))
+
+    def compress_thread(self):
+        '''compress closed segments in the background'''
+        while True:
+            (filename, method) = self.compress_queue.get()
+            try:
+                compress_file(filename, method)
+            except Exception as e:
+                print("ERROR: compressing %s: %s" % (filename, e))
+
+    def close(self):
+        '''flush remaining data and close the log'''
+        self.closing = True
+        self.event.set()
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats_string(self):
+        return "%s: %u bytes in %u writes, %u queued, %u segments" % (
+            self.filename, self.bytes_written, self.writes, self.used, len(self.segments))
+
+
+def compress_file(filename, method):
+    '''compress a file with gzip or zstd, removing the original'''
+    if method == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            print("zstandard not installed, using gzip")
+            method = 'gzip'
+    fin = open(filename, 'rb')
+    if method == 'zstd':
+        outname = filename + '.zst'
+        fout = open(outname, 'wb')
+        zstandard.ZstdCompressor().copy_stream(fin, fout)
+    else:
+        import gzip
+        outname = filename + '.gz'
+        fout = gzip.open(outname, 'wb')
+        shutil.copyfileobj(fin, fout, 1024*1024)
+    fout.close()
+    fin.close()
+    os.unlink(filename)
+    return outname
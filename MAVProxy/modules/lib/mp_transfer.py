@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+'''
+windowed transfer of numbered items (mission items, fence and rally points)
+
+An ItemTransfer fetches items 0..count-1 by keeping a window of
+requests outstanding. The window grows by one for each reply and is
+halved when a request times out, so a clean link is kept busy while
+a lossy one isn't flooded with requests that will be lost. The request
+timeout follows the measured round trip time.
+
+An ItemUpload keeps the statistics for an upload, where the vehicle
+requests each item in turn.
+'''
+
+import time
+
+MISSING = 0
+REQUESTED = 1
+RECEIVED = 2
+
+
+def format_eta(eta):
+    if eta is None:
+        return "?"
+    return "%.0fs" % eta
+
+
+class ItemTransfer(object):
+    '''fetch a numbered list of items, calling request(seq) to ask for each item'''
+    def __init__(self, count, request, window=8, window_max=32, timeout=2.0):
+        self.count = count
+        self.request = request
+        self.state = bytearray(count)
+        self.items = [None] * count
+        self.requested = {}
+        self.window = max(window, 1)
+        self.window_max = max(window_max, self.window)
+        self.timeout_max = timeout
+        self.rtt = None
+        self.start_time = time.time()
+        self.last_receive = self.start_time
+        self.received_count = 0
+        self.requests = 0
+        self.retries = 0
+        self.duplicates = 0
+        self.next_seq = 0
+
+    def complete(self):
+        return self.received_count == self.count
+
+    def timeout(self):
+        '''time to wait for a reply to a request'''
+        if self.rtt is None:
+            return self.timeout_max
+        return min(self.timeout_max, max(0.2, 3 * self.rtt))
+
+    def received(self, seq, item):
+        '''handle a received item, returning True if it is new'''
+        if seq < 0 or seq >= self.count:
+            return False
+        if self.state[seq] == RECEIVED:
+            self.duplicates += 1
+            return False
+        now = time.time()
+        t = self.requested.pop(seq, None)
+        if t is not None:
+            rtt = now - t
+            if self.rtt is None:
+                self.rtt = rtt
+            else:
+                self.rtt = 0.875 * self.rtt + 0.125 * rtt
+            self.window = min(self.window + 1, self.window_max)
+        self.state[seq] = RECEIVED
+        self.items[seq] = item
+        self.received_count += 1
+        self.last_receive = now
+        while self.next_seq < self.count and self.state[self.next_seq] == RECEIVED:
+            self.next_seq += 1
+        return True
+
+    def check(self):
+        '''time out lost requests and send new ones to fill the window'''
+        now = time.time()
+        timeout = self.timeout()
+        lost = [ seq for (seq, t) in self.requested.items() if now - t > timeout ]
+        if len(lost) > 0:
+            for seq in lost:
+                self.requested.pop(seq)
+                self.state[seq] = MISSING
+            self.retries += len(lost)
+            self.window = max(self.window // 2, 1)
+        seq = self.next_seq
+        while len(self.requested) < self.window and seq < self.count:
+            if self.state[seq] == MISSING:
+                self.state[seq] = REQUESTED
+                self.requested[seq] = now
+                self.requests += 1
+                self.request(seq)
+            seq += 1
+
+    def rate(self):
+        '''items per second'''
+        dt = time.time() - self.start_time
+        if dt <= 0:
+            return 0
+        return self.received_count / dt
+
+    def eta(self):
+        rate = self.rate()
+        if rate <= 0:
+            return None
+        return (self.count - self.received_count) / rate
+
+    def status_string(self):
+        if self.rtt is None:
+            rtt = "?"
+        else:
+            rtt = "%.0fms" % (self.rtt * 1000)
+        return "%u/%u items %.1f/s ETA %s window %u rtt %s (%u retries)" % (
+            self.received_count, self.count, self.rate(), format_eta(self.eta()),
+            self.window, rtt, self.retries)
+
+
+def fetch_blocking(master, transfer, msgtype, timeout=3):
+    '''run a transfer to completion, reading the replies with recv_match.
+    The item sequence number is taken from the idx field of the reply.
+    Returns the list of items, or None if the transfer stalls'''
+    while not transfer.complete():
+        transfer.check()
+        m = master.recv_match(type=msgtype, blocking=False)
+        if m is None:
+            if time.time() - transfer.last_receive > timeout:
+                return None
+            time.sleep(0.01)
+            continue
+        transfer.received(m.idx, m)
+    return transfer.items
+
+
+class ItemUpload(object):
+    '''statistics for an upload driven by the vehicle requesting items'''
+    def __init__(self, count):
+        self.count = count
+        self.sent = bytearray(count)
+        self.sent_count = 0
+        self.resends = 0
+        self.start_time = time.time()
+
+    def item_sent(self, seq):
+        if seq < 0 or seq >= self.count:
+            return
+        if self.sent[seq]:
+            self.resends += 1
+        else:
+            self.sent[seq] = 1
+            self.sent_count += 1
+
+    def complete(self):
+        return self.sent_count == self.count
+
+    def rate(self):
+        dt = time.time() - self.start_time
+        if dt <= 0:
+            return 0
+        return self.sent_count / dt
+
+    def eta(self):
+        rate = self.rate()
+        if rate <= 0:
+            return None
+        return (self.count - self.sent_count) / rate
+
+    def status_string(self):
+        return "%u/%u items %.1f/s ETA %s (%u resent)" % (
+            self.sent_count, self.count, self.rate(), format_eta(self.eta()), self.resends)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+'''
+UDP receive helpers for modules which listen for datagrams
+
+A UDPReceiver is registered in mpstate.select_extra so the module is
+woken when data arrives, and each wakeup drains every queued datagram
+(up to max_burst) rather than reading one per main loop pass. Python
+has no recvmmsg(), so the socket is read with recvmsg() in a loop
+until it would block.
+
+On Linux the kernel is asked for the receive time of each datagram
+(SO_TIMESTAMP) and a count of datagrams dropped because the socket
+buffer was full (SO_RXQ_OVFL), giving queue latency and drop counters.
+'''
+
+import socket, errno, struct, sys, time
+
+SO_TIMESTAMP = getattr(socket, 'SO_TIMESTAMP', 29)
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+
+
+class UDPReceiver(object):
+    '''drain a non-blocking UDP socket, keeping receive statistics'''
+    def __init__(self, sock, bufsize=65536, max_burst=256):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.max_burst = max_burst
+        sock.setblocking(False)
+        self.ancillary = False
+        if sys.platform.startswith('linux') and hasattr(sock, 'recvmsg'):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+                sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self.cmsg_size = socket.CMSG_SPACE(struct.calcsize('@ll')) + socket.CMSG_SPACE(4)
+                self.ancillary = True
+            except Exception:
+                pass
+        self.packets = 0
+        self.bytes = 0
+        self.wakeups = 0
+        self.burst_max = 0
+        self.drops = 0
+        self.latency_total = 0.0
+        self.latency_count = 0
+        self.latency_max = 0.0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _ancillary(self, ancdata, now):
+        '''handle timestamp and drop count control messages'''
+        for (level, ctype, cdata) in ancdata:
+            if level != socket.SOL_SOCKET:
+                continue
+            if ctype == SO_TIMESTAMP and len(cdata) >= struct.calcsize('@ll'):
+                (sec, usec) = struct.unpack_from('@ll', cdata)
+                latency = max(now - (sec + usec*1.0e-6), 0)
+                self.latency_total += latency
+                self.latency_count += 1
+                self.latency_max = max(self.latency_max, latency)
+            elif ctype == SO_RXQ_OVFL and len(cdata) >= 4:
+                # cumulative count of datagrams dropped on this socket
+                self.drops = max(self.drops, struct.unpack_from('@I', cdata)[0])
+
+    def drain(self):
+        '''return a list of all datagrams waiting on the socket'''
+        ret = []
+        now = time.time()
+        while len(ret) < self.max_burst:
+            try:
+                if self.ancillary:
+                    (data, ancdata, flags, addr) = self.sock.recvmsg(self.bufsize, self.cmsg_size)
+                    self._ancillary(ancdata, now)
+                else:
+                    data = self.sock.recv(self.bufsize)
+            except socket.error as e:
+                if e.errno in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                    break
+                raise
+            ret.append(data)
+            self.bytes += len(data)
+        self.packets += len(ret)
+        self.wakeups += 1
+        self.burst_max = max(self.burst_max, len(ret))
+        return ret
+
+    def latency_avg(self):
+        if self.latency_count == 0:
+            return 0.0
+        return self.latency_total / self.latency_count
+
+    def stats_string(self):
+        return "%u packets %u bytes %u drops, %u wakeups (burst max %u), latency avg %.1fms max %.1fms" % (
+            self.packets, self.bytes, self.drops, self.wakeups, self.burst_max,
+            self.latency_avg()*1000, self.latency_max*1000)
+
+
+class BurstWriter(object):
+    '''stand-in for a link file which collects writes'''
+    def __init__(self):
+        self.bufs = []
+
+    def write(self, buf):
+        self.bufs.append(buf)
+
+
+def send_burst(master, msgs):
+    '''send a list of encoded MAVLink messages on a link with a single
+    write. The messages still go through mav.send() so sequence
+    numbers, signing and the send callback work as usual'''
+    mav = master.mav
+    burst = BurstWriter()
+    saved = mav.file
+    mav.file = burst
+    try:
+        for m in msgs:
+            mav.send(m)
+    finally:
+        mav.file = saved
+    if len(burst.bufs) > 0:
+        master.write(b''.join(burst.bufs))
@@ -4,7 +4,7 @@ readline handling for mavproxy
 
 import sys, glob, os, platform
 import re
-from pymavlink import mavutil
+from MAVProxy.modules.lib import mp_expression
 
 rline_mpstate = None
 redisplay = None
@@ -103,7 +103,7 @@ def complete_variable(text):
         suffix = ''
 
     try:
-        if mavutil.evaluate_expression(text, rline_mpstate.status.msgs) is not None:
+        if mp_expression.evaluate_expression(text, rline_mpstate.status.msgs) is not None:
             return [text+suffix]
     except Exception as ex:
         pass
@@ -5,8 +5,9 @@
 """
 import threading
 import sys, time
+from collections import OrderedDict
 
-from MAVProxy.modules.lib.wxconsole_util import Value, Text
+from MAVProxy.modules.lib.wxconsole_util import Value, Text, ValueBatch
 from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import win_layout
 from MAVProxy.modules.lib import multiproc
@@ -16,9 +17,11 @@ class MessageConsole(textconsole.SimpleConsole):
     a message console for MAVProxy
     '''
     def __init__(self,
-                 title='MAVProxy: console'):
+                 title='MAVProxy: console',
+                 status_rate=10):
         textconsole.SimpleConsole.__init__(self)
         self.title  = title
+        self.status_rate = status_rate
         self.menu_callback = None
         self.parent_pipe_recv,self.child_pipe_send = multiproc.Pipe(duplex=False)
         self.child_pipe_recv,self.parent_pipe_send = multiproc.Pipe(duplex=False)
@@ -28,9 +31,22 @@ class MessageConsole(textconsole.SimpleConsole):
         self.child.start()
         self.child_pipe_send.close()
         self.child_pipe_recv.close()
+
+        # status values are sent to the child in batches at up to
+        # status_rate Hz, skipping values which have not changed
+        self.send_lock = threading.Lock()
+        self.status_lock = threading.Lock()
+        self.status_event = threading.Event()
+        self.status_sent = {}
+        self.status_pending = OrderedDict()
+        self.last_status_send = 0
+
         t = threading.Thread(target=self.watch_thread)
         t.daemon = True
         t.start()
+        t = threading.Thread(target=self.status_thread)
+        t.daemon = True
+        t.start()
 
     def child_task(self):
         '''child process - this holds all the GUI elements'''
@@ -60,30 +76,71 @@ class MessageConsole(textconsole.SimpleConsole):
         except EOFError:
             pass
 
+    def status_thread(self):
+        '''send status values which have been held back'''
+        while not self.close_event.is_set():
+            self.status_event.wait()
+            self.status_event.clear()
+            delay = self.last_status_send + 1.0/self.status_rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.flush_status()
+
+    def send(self, obj):
+        '''send an object to the child. This is called from more than one thread'''
+        with self.send_lock:
+            self.parent_pipe_send.send(obj)
+
     def set_layout(self, layout):
         '''set window layout'''
-        self.parent_pipe_send.send(layout)
+        self.send(layout)
         
     def write(self, text, fg='black', bg='white'):
         '''write to the console'''
         try:
-            self.parent_pipe_send.send(Text(text, fg, bg))
+            self.send(Text(text, fg, bg))
         except Exception:
             pass
 
     def set_status(self, name, text='', row=0, fg='black', bg='white'):
         '''set a status value'''
+        value = Value(name, text, row, fg, bg)
+        with self.status_lock:
+            if self.status_sent.get(name, None) == (text, row, fg, bg):
+                self.status_pending.pop(name, None)
+                return
+            self.status_pending[name] = value
+            due = time.time() - self.last_status_send >= 1.0/self.status_rate
+        if due:
+            self.flush_status()
+        else:
+            self.status_event.set()
+
+    def flush_status(self):
+        '''send all pending status values as one message'''
+        with self.status_lock:
+            if len(self.status_pending) == 0:
+                return
+            values = list(self.status_pending.values())
+            self.status_pending = OrderedDict()
+            for v in values:
+                self.status_sent[v.name] = (v.text, v.row, v.fg, v.bg)
+            self.last_status_send = time.time()
         if self.is_alive():
-            self.parent_pipe_send.send(Value(name, text, row, fg, bg))
+            try:
+                self.send(ValueBatch(values))
+            except Exception:
+                pass
 
     def set_menu(self, menu, callback):
         if self.is_alive():
-            self.parent_pipe_send.send(menu)
+            self.send(menu)
             self.menu_callback = callback
 
     def close(self):
         '''close the console'''
         self.close_event.set()
+        self.status_event.set()
         if self.is_alive():
             self.child.join(2)
 
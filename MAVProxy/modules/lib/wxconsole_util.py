@@ -12,4 +12,9 @@ class Value():
         self.text = text
         self.row = row
         self.fg = fg
-        self.bg = bg
\ No newline at end of file
+        self.bg = bg
+
+class ValueBatch():
+    '''a set of status bar values, sent as one message'''
+    def __init__(self, values):
+        self.values = values
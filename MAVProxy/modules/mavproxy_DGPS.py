@@ -3,9 +3,10 @@
 support for a GCS attached DGPS system
 '''
 
-import socket, errno
+import socket
 from pymavlink import mavutil
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_udp
 
 class DGPSModule(mp_module.MPModule):
     def __init__(self, mpstate):
@@ -15,24 +16,35 @@ class DGPSModule(mp_module.MPModule):
         self.port.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.port.bind(("127.0.0.1", self.portnum))
         mavutil.set_close_on_exec(self.port.fileno())
-        self.port.setblocking(0)
+        self.receiver = mp_udp.UDPReceiver(self.port)
         self.inject_seq_nr = 0
+        self.inject_count = 0
+        self.inject_errors = 0
+        # ask mavproxy to call us when RTCM data arrives
+        self.mpstate.select_extra[self.port.fileno()] = (self.read_rtcm, self.port.fileno())
+        self.add_command('dgps', self.cmd_dgps, "DGPS control", ["status"])
         print("DGPS: Listening for RTCM packets on UDP://%s:%s" % ("127.0.0.1", self.portnum))
-    
-    def send_rtcm_msg(self, data):
+
+    def cmd_dgps(self, args):
+        '''dgps command parser'''
+        if len(args) == 0 or args[0] != "status":
+            print("usage: dgps status")
+            return
+        print("DGPS: %u injected %u errors" % (self.inject_count, self.inject_errors))
+        print("DGPS: %s" % self.receiver.stats_string())
+
+    def rtcm_msgs(self, data):
+        '''return a list of GPS_RTCM_DATA messages carrying data'''
         msglen = 180;
         
         if (len(data) > msglen * 4):
             print("DGPS: Message too large", len(data))
-            return
+            return []
         
         # How many messages will we send?
-        msgs = 0
-        if (len(data) % msglen == 0):
-            msgs = len(data) / msglen
-        else:
-            msgs = (len(data) / msglen) + 1
-        
+        msgs = (len(data) + msglen - 1) // msglen
+
+        ret = []
         for a in range(0, msgs):
             
             flags = 0
@@ -51,38 +63,48 @@ class DGPSModule(mp_module.MPModule):
             amount = min(len(data) - a * msglen, msglen)
             datachunk = data[a*msglen : a*msglen + amount]
             
-            self.master.mav.gps_rtcm_data_send(
+            ret.append(self.master.mav.gps_rtcm_data_encode(
                 flags,
                 len(datachunk),
-                bytearray(datachunk.ljust(180, '\0')))
+                bytearray(datachunk.ljust(180, b'\0'))))
         
         # Send a terminal 0-length message if we sent 2 or 3 exactly-full messages.     
         if (msgs < 4) and (len(data) % msglen == 0) and (len(data) > msglen):
             flags = 1 | (msgs & 0x3)  << 1 | (self.inject_seq_nr & 0x1f) << 3
-            self.master.mav.gps_rtcm_data_send(
+            ret.append(self.master.mav.gps_rtcm_data_encode(
                 flags,
                 0,
-                bytearray("".ljust(180, '\0')))
+                bytearray(b"".ljust(180, b'\0'))))
             
         self.inject_seq_nr += 1
+        return ret
 
+    def send_rtcm_msg(self, data):
+        '''send one RTCM message, as a burst of fragments'''
+        mp_udp.send_burst(self.master, self.rtcm_msgs(data))
 
-
-    def idle_task(self):
-        '''called in idle time'''
-        try:
-            data = self.port.recv(1024) # Attempt to read up to 1024 bytes.
-        except socket.error as e:
-            if e.errno in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
-                return
-            raise
+    def read_rtcm(self, fd):
+        '''called when RTCM data is waiting. All waiting packets are sent
+        to the vehicle in one burst'''
+        msgs = []
+        for data in self.receiver.drain():
+            try:
+                msgs.extend(self.rtcm_msgs(data))
+                self.inject_count += 1
+            except Exception as e:
+                self.inject_errors += 1
+                print("DGPS: GPS Inject Failed:", e)
         try:
-            self.send_rtcm_msg(data)
-
+            mp_udp.send_burst(self.master, msgs)
         except Exception as e:
+            self.inject_errors += 1
             print("DGPS: GPS Inject Failed:", e)
 
+    def unload(self):
+        '''unload module'''
+        self.mpstate.select_extra.pop(self.port.fileno(), None)
+        self.port.close()
+
 def init(mpstate):
     '''initialise module'''
     return DGPSModule(mpstate)
-
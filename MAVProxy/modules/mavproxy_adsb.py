@@ -5,6 +5,7 @@ Dec 2015
 '''
 
 from math import *
+import numpy
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
@@ -41,23 +42,185 @@ class ADSBVehicle(object):
         self.vehicle_colour = 'green'  # use plane icon for now
         self.vehicle_type = 'plane'
         self.icon = self.vehicle_colour + self.vehicle_type + '.png'
-        self.update_time = 0
-        self.is_evading_threat = False
-        self.v_distance = None
-        self.h_distance = None
-        self.distance = None
 
-    def update(self, state, tnow):
+    def update(self, state):
         '''update the threat state'''
         self.state = state
-        self.update_time = tnow
+
+
+class ADSBTracks(object):
+    '''position, velocity and threat state of all ADS-B tracks, held as
+    numpy arrays with one element per track so that distances and
+    closest approach can be computed for every track at once. A grid
+    index of cell_size degrees gives the tracks near a point'''
+
+    fields = ['lat', 'lon', 'alt', 'vn', 've', 'vd', 'update_time',
+              'h_distance', 'v_distance', 'distance', 'cpa_time', 'cpa_distance',
+              'conflict_time']
+
+    def __init__(self, capacity=64, cell_size=0.05):
+        self.n = 0
+        self.ids = []
+        self.index = {}
+        self.cell_size = cell_size
+        self.cells = {}
+        self.track_cell = {}
+        for f in self.fields:
+            setattr(self, f, numpy.zeros(capacity))
+        self.evading = numpy.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self):
+        '''double the size of the arrays'''
+        for f in self.fields + ['evading']:
+            a = getattr(self, f)
+            b = numpy.zeros(2*len(a), dtype=a.dtype)
+            b[:self.n] = a[:self.n]
+            setattr(self, f, b)
+
+    def cell(self, lat, lon):
+        return (int(floor(lat / self.cell_size)), int(floor(lon / self.cell_size)))
+
+    def update(self, id, lat, lon, alt, vn, ve, vd, tnow):
+        '''add or update a track. Positions are in degrees and metres AMSL,
+        velocities in m/s NED'''
+        i = self.index.get(id, None)
+        if i is None:
+            if self.n == len(self.lat):
+                self._grow()
+            i = self.n
+            self.n += 1
+            self.ids.append(id)
+            self.index[id] = i
+            self.h_distance[i] = self.v_distance[i] = self.distance[i] = numpy.nan
+            self.cpa_time[i] = self.cpa_distance[i] = self.conflict_time[i] = numpy.nan
+            self.evading[i] = False
+        self.lat[i] = lat
+        self.lon[i] = lon
+        self.alt[i] = alt
+        self.vn[i] = vn
+        self.ve[i] = ve
+        self.vd[i] = vd
+        self.update_time[i] = tnow
+        c = self.cell(lat, lon)
+        old = self.track_cell.get(id, None)
+        if old != c:
+            if old is not None:
+                self.cells[old].discard(id)
+                if len(self.cells[old]) == 0:
+                    del self.cells[old]
+            self.cells.setdefault(c, set()).add(id)
+            self.track_cell[id] = c
+
+    def expire(self, tnow, timeout):
+        '''remove all tracks not updated for timeout seconds, returning
+        a list of the ids removed'''
+        n = self.n
+        stale = (tnow - self.update_time[:n]) > timeout
+        if not stale.any():
+            return []
+        removed = [self.ids[i] for i in numpy.flatnonzero(stale)]
+        keep = ~stale
+        m = int(keep.sum())
+        for f in self.fields + ['evading']:
+            a = getattr(self, f)
+            a[:m] = a[:n][keep]
+        self.ids = [self.ids[i] for i in numpy.flatnonzero(keep)]
+        self.index = dict([(id, i) for (i, id) in enumerate(self.ids)])
+        self.n = m
+        for id in removed:
+            c = self.track_cell.pop(id)
+            self.cells[c].discard(id)
+            if len(self.cells[c]) == 0:
+                del self.cells[c]
+        return removed
+
+    def nearby(self, lat, lon, radius):
+        '''return an array of indexes of tracks which may be within
+        radius metres of a point'''
+        dlat = radius / 111319.5
+        dlon = dlat / max(cos(radians(lat)), 0.01)
+        (c0lat, c0lon) = self.cell(lat - dlat, lon - dlon)
+        (c1lat, c1lon) = self.cell(lat + dlat, lon + dlon)
+        if (c1lat - c0lat + 1) * (c1lon - c0lon + 1) > len(self.cells):
+            return numpy.arange(self.n)
+        ret = []
+        for clat in range(c0lat, c1lat+1):
+            for clon in range(c0lon, c1lon+1):
+                for id in self.cells.get((clat, clon), []):
+                    ret.append(self.index[id])
+        return numpy.array(sorted(ret), dtype=int)
+
+    def update_threats(self, lat, lon, alt, vn, ve, vd, radius, idx=None):
+        '''compute distance, closest point of approach and time to conflict
+        (time until the track is within radius metres, assuming both keep
+        their current velocity) for tracks idx, or all tracks. Other
+        tracks are taken to be too far away to matter'''
+        n = self.n
+        if idx is None:
+            idx = numpy.arange(n)
+        for f in ['h_distance', 'distance', 'cpa_distance', 'conflict_time']:
+            getattr(self, f)[:n] = numpy.inf
+        for f in ['v_distance', 'cpa_time']:
+            getattr(self, f)[:n] = numpy.nan
+        if len(idx) == 0:
+            return
+        lat2 = self.lat[idx]
+        lon2 = self.lon[idx]
+
+        # horizontal distance, as per mavextra.distance_two()
+        rlat1 = radians(lat)
+        rlat2 = numpy.radians(lat2)
+        dLat = rlat2 - rlat1
+        dLon = numpy.radians(lon2 - lon)
+        a = numpy.sin(0.5 * dLat)**2 + numpy.sin(0.5 * dLon)**2 * cos(rlat1) * numpy.cos(rlat2)
+        a = numpy.clip(a, 0.0, 1.0)
+        h_distance = 6371 * 1000 * 2.0 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1.0 - a))
+        v_distance = self.alt[idx] - alt
+        self.h_distance[idx] = h_distance
+        self.v_distance[idx] = v_distance
+        self.distance[idx] = numpy.sqrt(h_distance**2 + v_distance**2)
+
+        # relative position and velocity in a local NED frame
+        pn = dLat * 6371000.0
+        pe = dLon * 6371000.0 * cos(rlat1)
+        pd = -v_distance
+        wn = self.vn[idx] - vn
+        we = self.ve[idx] - ve
+        wd = self.vd[idx] - vd
+        vv = wn*wn + we*we + wd*wd
+        pv = pn*wn + pe*we + pd*wd
+        pp = pn*pn + pe*pe + pd*pd
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t = numpy.where(vv > 0, -pv / vv, 0.0)
+            t = numpy.maximum(t, 0.0)
+            self.cpa_time[idx] = t
+            self.cpa_distance[idx] = numpy.sqrt(numpy.maximum(pp + 2*pv*t + vv*t*t, 0.0))
+
+            # first time |p + w*t| == radius
+            c = pp - radius*radius
+            disc = pv*pv - vv*c
+            tc = (-pv - numpy.sqrt(numpy.maximum(disc, 0.0))) / vv
+            tc = numpy.where((disc < 0) | (vv <= 0) | (tc < 0), numpy.inf, tc)
+            self.conflict_time[idx] = numpy.where(c <= 0, 0.0, tc)
+
+    def max_speed(self):
+        '''return the highest ground speed of any track'''
+        if self.n == 0:
+            return 0.0
+        n = self.n
+        return float(numpy.sqrt(self.vn[:n]**2 + self.ve[:n]**2 + self.vd[:n]**2).max())
 
 
 class ADSBModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(ADSBModule, self).__init__(mpstate, "adsb", "ADS-B data support", public = True)
+        self.subscribe(['ADSB_VEHICLE'])
         self.threat_vehicles = {}
+        self.tracks = ADSBTracks()
         self.active_threat_ids = []  # holds all threat ids the vehicle is evading
 
         self.add_command('adsb', self.cmd_ADSB, "adsb control",
@@ -68,7 +231,9 @@ class ADSBModule(mp_module.MPModule):
                                                      ("show_threat_radius", bool, False),
                                                      # threat_radius_clear = threat_radius*threat_radius_clear_multiplier
                                                      ("threat_radius_clear_multiplier", int, 2),
-                                                     ("show_threat_radius_clear", bool, False)])
+                                                     ("show_threat_radius_clear", bool, False),
+                                                     # seconds ahead to predict conflicts, 0 to disable
+                                                     ("threat_time", int, 30)])
         self.add_completion_function('(ADSBSETTING)',
                                      self.ADSB_settings.completion)
         
@@ -86,99 +251,103 @@ class ADSBModule(mp_module.MPModule):
             print("total threat count: %u  active threat count: %u" %
                   (len(self.threat_vehicles), len(self.active_threat_ids)))
 
+            tracks = self.tracks
             for id in self.threat_vehicles.keys():
-                print("id: %s  distance: %.2f m callsign: %s  alt: %.2f" % (id,
-                                                                            self.threat_vehicles[id].distance,
-                                                                            self.threat_vehicles[id].state['callsign'],
-                                                                            self.threat_vehicles[id].state['altitude']))
+                i = tracks.index[id]
+                print("id: %s  distance: %.2f m callsign: %s  alt: %.2f  cpa: %.0f m in %.0f s  conflict: %.0f s" % (
+                    id,
+                    tracks.distance[i],
+                    self.threat_vehicles[id].state['callsign'],
+                    self.threat_vehicles[id].state['altitude'],
+                    tracks.cpa_distance[i], tracks.cpa_time[i],
+                    tracks.conflict_time[i]))
         elif args[0] == "set":
             self.ADSB_settings.command(args[1:])
         else:
             print(usage)
 
     def perform_threat_detection(self):
-        '''determine threats'''
-        # TODO: perform more advanced threat detection
-        threat_radius_clear = self.ADSB_settings.threat_radius * \
+        '''determine threats. A track becomes a threat when it is within
+        threat_radius, or is predicted to come within threat_radius in
+        the next threat_time seconds'''
+        threat_radius = self.ADSB_settings.threat_radius
+        threat_radius_clear = threat_radius * \
             self.ADSB_settings.threat_radius_clear_multiplier
-
-        for id in self.threat_vehicles.keys():
-            if self.threat_vehicles[id].distance is not None:
-                if self.threat_vehicles[id].distance <= self.ADSB_settings.threat_radius and not self.threat_vehicles[id].is_evading_threat:
-                    # if the threat is in the threat radius and not currently
-                    # known to the module...
-                    # set flag to action threat
-                    self.threat_vehicles[id].is_evading_threat = True
-
-                if self.threat_vehicles[id].distance > threat_radius_clear and self.threat_vehicles[id].is_evading_threat:
-                    # if the threat is known to the module and outside the
-                    # threat clear radius...
-                    # clear flag to action threat
-                    self.threat_vehicles[id].is_evading_threat = False
-
-        self.active_threat_ids = [id for id in self.threat_vehicles.keys(
-        ) if self.threat_vehicles[id].is_evading_threat]
-
-    def update_threat_distances(self, latlonalt):
-        '''update the distance between threats and vehicle'''
-        for id in self.threat_vehicles.keys():
-            threat_latlonalt = (self.threat_vehicles[id].state['lat'] * 1e-7,
-                                self.threat_vehicles[id].state['lon'] * 1e-7,
-                                self.threat_vehicles[id].state['altitude'])
-
-            self.threat_vehicles[id].h_distance = self.get_h_distance(latlonalt, threat_latlonalt)
-            self.threat_vehicles[id].v_distance = self.get_v_distance(latlonalt, threat_latlonalt)
-
-            # calculate and set the total distance between threat and vehicle
-            self.threat_vehicles[id].distance = sqrt(
-                self.threat_vehicles[id].h_distance**2 + (self.threat_vehicles[id].v_distance)**2)
-
-    def get_h_distance(self, latlonalt1, latlonalt2):
-        '''get the horizontal distance between threat and vehicle'''
-        (lat1, lon1, alt1) = latlonalt1
-        (lat2, lon2, alt2) = latlonalt2
-
-        lat1 = radians(lat1)
-        lon1 = radians(lon1)
-        lat2 = radians(lat2)
-        lon2 = radians(lon2)
-
-        dLat = lat2 - lat1
-        dLon = lon2 - lon1
-
-        # math as per mavextra.distance_two()
-        a = sin(0.5 * dLat)**2 + sin(0.5 * dLon)**2 * cos(lat1) * cos(lat2)
-        c = 2.0 * atan2(sqrt(a), sqrt(1.0 - a))
-        return 6371 * 1000 * c
-
-    def get_v_distance(self, latlonalt1, latlonalt2):
-        '''get the horizontal distance between threat and vehicle'''
-        (lat1, lon1, alt1) = latlonalt1
-        (lat2, lon2, alt2) = latlonalt2
-        return alt2 - alt1
+        threat_time = self.ADSB_settings.threat_time
+
+        tracks = self.tracks
+        n = len(tracks)
+        distance = tracks.distance[:n]
+        conflict = tracks.conflict_time[:n] <= threat_time
+        with numpy.errstate(invalid='ignore'):
+            # if the threat is in the threat radius, or will be soon, set
+            # flag to action threat
+            start = (distance <= threat_radius) | conflict
+            # if the threat is outside the threat clear radius and not
+            # heading for us, clear flag to action threat
+            clear = (distance > threat_radius_clear) & ~conflict
+        evading = tracks.evading[:n]
+        evading[start] = True
+        evading[clear] = False
+
+        self.active_threat_ids = [tracks.ids[i] for i in numpy.flatnonzero(evading)]
+
+    def update_threat_distances(self, latlonalt, velocity=(0,0,0)):
+        '''update the distance, closest approach and time to conflict
+        between threats and vehicle. velocity is the vehicle velocity in
+        m/s NED'''
+        (lat, lon, alt) = latlonalt
+        (vn, ve, vd) = velocity
+        tracks = self.tracks
+        threat_radius = self.ADSB_settings.threat_radius
+        threat_radius_clear = threat_radius * \
+            self.ADSB_settings.threat_radius_clear_multiplier
+        # only tracks which could reach us within threat_time need checking
+        own_speed = sqrt(vn**2 + ve**2 + vd**2)
+        search_radius = threat_radius_clear + self.ADSB_settings.threat_time * (own_speed + tracks.max_speed())
+        idx = tracks.nearby(lat, lon, search_radius)
+        tracks.update_threats(lat, lon, alt, vn, ve, vd, threat_radius, idx)
+
+    def vehicle_latlonalt(self):
+        '''return ((lat,lon,alt), (vn,ve,vd)) for our vehicle, or None'''
+        if not 'GLOBAL_POSITION_INT' in self.master.messages:
+            return None
+        m = self.master.messages['GLOBAL_POSITION_INT']
+        if m.lat == 0 and m.lon == 0:
+            return None
+        return ((m.lat*1.0e-7, m.lon*1.0e-7, m.alt*0.001),
+                (m.vx*0.01, m.vy*0.01, m.vz*0.01))
 
     def check_threat_timeout(self):
         '''check and handle threat time out'''
-        for id in self.threat_vehicles.keys():
-            if self.threat_vehicles[id].update_time == 0:
-                self.threat_vehicles[id].update_time = self.get_time()
-            dt = self.get_time() - self.threat_vehicles[id].update_time
-            if dt > self.ADSB_settings.timeout:
-                # if the threat has timed out...
-                del self.threat_vehicles[id]  # remove the threat from the dict
-                for mp in self.module_matching('map*'):
-                    # remove the threat from the map
-                    mp.map.remove_object(id)
-                    mp.map.remove_object(id+":circle")
-                # we've modified the dict we're iterating over, so
-                # we'll get any more timed-out threats next time we're
-                # called:
-                return
+        for id in self.tracks.expire(self.get_time(), self.ADSB_settings.timeout):
+            # if the threat has timed out...
+            del self.threat_vehicles[id]  # remove the threat from the dict
+            for mp in self.module_matching('map*'):
+                # remove the threat from the map
+                mp.map.remove_object(id)
+                mp.map.remove_object(id+":circle")
+
+    def update_track(self, id, m):
+        '''update the track arrays from an ADSB_VEHICLE message'''
+        flags = m.flags
+        vn = ve = vd = 0
+        if flags & mavutil.mavlink.ADSB_FLAGS_VALID_VELOCITY:
+            vd = -m.ver_velocity * 0.01
+            # the horizontal velocity needs a valid heading as well
+            if flags & mavutil.mavlink.ADSB_FLAGS_VALID_HEADING:
+                speed = m.hor_velocity * 0.01
+                heading = radians(m.heading * 0.01)
+                vn = speed * cos(heading)
+                ve = speed * sin(heading)
+        self.tracks.update(id, m.lat * 1e-7, m.lon * 1e-7, m.altitude * 0.001,
+                           vn, ve, vd, self.get_time())
 
     def mavlink_packet(self, m):
         '''handle an incoming mavlink packet'''
         if m.get_type() == "ADSB_VEHICLE":
             id = 'ADSB-' + str(m.ICAO_address)
+            self.update_track(id, m)
             if id not in self.threat_vehicles.keys():  # check to see if the vehicle is in the dict
                 # if not then add it
                 self.threat_vehicles[id] = ADSBVehicle(id=id, state=m.to_dict())
@@ -204,7 +373,7 @@ class ADSBModule(mp_module.MPModule):
                                                     threat_radius, (0, 255, 255), linewidth=1))
             else:  # the vehicle is in the dict
                 # update the dict entry
-                self.threat_vehicles[id].update(m.to_dict(), self.get_time())
+                self.threat_vehicles[id].update(m.to_dict())
                 for mp in self.module_matching('map*'):
                     # update the map
                     ground_alt = mp.ElevationMap.GetElevation(m.lat*1e-7, m.lon*1e-7)
@@ -223,6 +392,9 @@ class ADSBModule(mp_module.MPModule):
             self.check_threat_timeout()
 
         if self.threat_detection_timer.trigger():
+            pos = self.vehicle_latlonalt()
+            if pos is not None:
+                self.update_threat_distances(pos[0], pos[1])
             self.perform_threat_detection()
             # TODO: possibly evade detected threats with ids in
             # self.active_threat_ids
@@ -10,6 +10,7 @@ from math import *
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_udp
 from pymavlink import mavutil
 
 import asterix, socket, time, os, struct
@@ -71,6 +72,7 @@ class AsterixModule(mp_module.MPModule):
         self.add_completion_function('(ASTERIXSETTING)',
                                      self.asterix_settings.completion)
         self.sock = None
+        self.receiver = None
         self.tracks = {}
         self.start_listener()
 
@@ -95,6 +97,8 @@ class AsterixModule(mp_module.MPModule):
         print("ADSB packets sent: %u" % self.adsb_packets_sent)
         print("ADSB packets not sent: %u" % self.adsb_packets_not_sent)
         print("ADSB bitrate: %u bytes/s" % int(self.adsb_byterate))
+        if self.receiver is not None:
+            print("SDPS: %s" % self.receiver.stats_string())
 
     def cmd_asterix(self, args):
         '''asterix command parser'''
@@ -119,16 +123,19 @@ class AsterixModule(mp_module.MPModule):
     def start_listener(self):
         '''start listening for packets'''
         if self.sock is not None:
-            self.sock.close()
+            self.stop_listener()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind(('', self.asterix_settings.port))
-        self.sock.setblocking(False)
+        self.receiver = mp_udp.UDPReceiver(self.sock, bufsize=10240)
+        # ask mavproxy to call us when packets arrive
+        self.mpstate.select_extra[self.sock.fileno()] = (self.read_packets, self.sock.fileno())
         print("Started on port %u" % self.asterix_settings.port)
 
     def stop_listener(self):
         '''stop listening for packets'''
         if self.sock is not None:
+            self.mpstate.select_extra.pop(self.sock.fileno(), None)
             self.sock.close()
             self.sock = None
         self.tracks = {}
@@ -190,14 +197,25 @@ class AsterixModule(mp_module.MPModule):
 
         return False
 
-    def idle_task(self):
-        '''called on idle'''
-        if self.sock is None:
+    def read_packets(self, fd):
+        '''called when SDPS packets are waiting. All waiting packets are
+        processed'''
+        if self.receiver is None:
             return
         try:
-            pkt = self.sock.recv(10240)
+            pkts = self.receiver.drain()
         except Exception:
             return
+        for pkt in pkts:
+            try:
+                self.process_packet(pkt)
+            except Exception as e:
+                # don't let one bad packet unregister the socket
+                print("asterix: error processing packet: %s" % e)
+        self.console.set_status('ASTX', 'ASTX %u/%u' % (self.pkt_count, self.adsb_packets_sent), row=6)
+
+    def process_packet(self, pkt):
+        '''handle one SDPS packet'''
         try:
             if pkt.startswith(b'PICKLED:'):
                 pkt = pkt[8:]
@@ -209,7 +227,6 @@ class AsterixModule(mp_module.MPModule):
             else:
                 amsg = asterix.parse(pkt)
             self.pkt_count += 1
-            self.console.set_status('ASTX', 'ASTX %u/%u' % (self.pkt_count, self.adsb_packets_sent), row=6)
         except Exception:
             print("bad packet")
             return
@@ -288,7 +305,9 @@ class AsterixModule(mp_module.MPModule):
                     self.mpstate.sysid_outputs[sysid].write(adsb_pkt.get_msgbuf())
             except Exception:
                 pass
-                
+
+    def idle_task(self):
+        '''called on idle'''
         now = time.time()
         delta = now - self.adsb_byterate_update_timestamp
         if delta > 5:
@@ -304,6 +323,10 @@ class AsterixModule(mp_module.MPModule):
                 return
             self.vehicle_pos = VehiclePos(m)
 
+    def unload(self):
+        '''unload module'''
+        self.stop_listener()
+
 def init(mpstate):
     '''initialise module'''
     return AsterixModule(mpstate)
@@ -19,10 +19,12 @@ import os
 import os.path
 from pymavlink import mavutil
 import errno
+from collections import OrderedDict, deque
 
 from MAVProxy.modules.lib import mp_module
 import time
 from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib import mp_udp
 
 
 class dataflash_logger(mp_module.MPModule):
@@ -43,15 +45,15 @@ class dataflash_logger(mp_module.MPModule):
         self.prev_download = 0
         self.last_status_time = time.time()
         self.last_seqno = 0
-        self.missing_blocks = {}
-        self.acking_blocks = {}
-        self.blocks_to_ack_and_nack = []
-        self.missing_found = 0
-        self.abandoned = 0
-        self.dropped = 0
+        self.logfile = None
+        self.reset_blocks()
 
         self.log_settings = mp_settings.MPSettings(
             [('verbose', bool, False),
+             # maximum ACK/NACK packets sent per idle call
+             ('max_acks', int, 32),
+             # bytes of sequential blocks buffered before writing
+             ('write_buffer', int, 65536),
              ('df_target_system', int, 0),
              ('df_target_component', int, mavutil.mavlink.MAV_COMP_ID_LOG)]
         )
@@ -75,6 +77,7 @@ class dataflash_logger(mp_module.MPModule):
         elif args[0] == "stop":
             self.sender = None
             self.stopped = True
+            self.flush_log()
         elif args[0] == "start":
             self.stopped = False
         elif args[0] == "set":
@@ -108,6 +111,7 @@ class dataflash_logger(mp_module.MPModule):
         filename = self.new_log_filepath()
 
         self.last_seqno = 0
+        self.close_log()
         self.logfile = open(filename, 'w+b')
         print("DFLogger: logging started (%s)" % (filename))
         self.prev_cnt = 0
@@ -115,12 +119,59 @@ class dataflash_logger(mp_module.MPModule):
         self.prev_download = 0
         self.last_idle_status_printed_time = time.time()
         self.last_status_time = time.time()
-        self.missing_blocks = {}
-        self.acking_blocks = {}
-        self.blocks_to_ack_and_nack = []
+        self.start_time = time.time()
+        self.reset_blocks()
+
+    def reset_blocks(self):
+        '''reset block tracking state'''
+        # missing block number -> time first NACKed, in block order
+        self.missing_blocks = OrderedDict()
+        # blocks waiting to be ACKed, and a set of the same blocks
+        self.ack_queue = deque()
+        self.acking_blocks = set()
+        # (time due, block) of missing blocks to NACK, in time order
+        self.nack_queue = deque()
         self.missing_found = 0
         self.abandoned = 0
         self.dropped = 0
+        self.duplicates = 0
+        self.start_time = time.time()
+        # sequential blocks are gathered here and written in one go
+        self.write_buf = bytearray()
+        self.write_ofs = 0
+        self.write_time = 0
+        self.writes = 0
+
+    def flush_log(self):
+        '''write out buffered blocks'''
+        if len(self.write_buf) == 0 or self.logfile is None:
+            return
+        self.logfile.seek(self.write_ofs)
+        self.logfile.write(self.write_buf)
+        self.writes += 1
+        self.write_buf = bytearray()
+
+    def close_log(self):
+        '''flush and close the current log'''
+        if self.logfile is None:
+            return
+        self.flush_log()
+        self.logfile.close()
+        self.logfile = None
+
+    def write_block(self, ofs, data):
+        '''write a block to the log. Blocks which follow on from the
+        buffered data are appended to the buffer, anything else (usually
+        a resent missing block) is written straight to the file'''
+        if len(self.write_buf) > 0 and ofs == self.write_ofs + len(self.write_buf):
+            self.write_buf.extend(data)
+        else:
+            self.flush_log()
+            self.write_buf.extend(data)
+            self.write_ofs = ofs
+            self.write_time = time.time()
+        if len(self.write_buf) >= self.log_settings.write_buffer:
+            self.flush_log()
 
     def status(self):
         '''returns information about module'''
@@ -133,14 +184,20 @@ class dataflash_logger(mp_module.MPModule):
         interval = now - self.last_status_time
         self.last_status_time = now
         return("DFLogger: %(state)s Rate(%(interval)ds):%(rate).3fkB/s "
+               "Sustained:%(sustained).3fkB/s "
                "Block:%(block_cnt)d Missing:%(missing)d Fixed:%(fixed)d "
-               "Abandoned:%(abandoned)d" %
+               "Abandoned:%(abandoned)d Duplicate:%(duplicates)d "
+               "AckQueue:%(acks)d Writes:%(writes)d" %
                {"interval": interval,
                 "rate": transferred/(interval*1000),
+                "sustained": self.download/(max(now - self.start_time, 0.001)*1000),
                 "block_cnt": self.last_seqno,
                 "missing": len(self.missing_blocks),
                 "fixed": self.missing_found,
                 "abandoned": self.abandoned,
+                "duplicates": self.duplicates,
+                "acks": len(self.ack_queue),
+                "writes": self.writes,
                 "state": "Inactive" if self.stopped else "Active"})
 
     def idle_print_status(self):
@@ -151,62 +208,57 @@ class dataflash_logger(mp_module.MPModule):
             self.last_idle_status_printed_time = now
 
     def idle_send_acks_and_nacks(self):
-        '''Send packets to UAV in idle loop'''
-        max_blocks_to_send = 10
-        blocks_sent = 0
-        i = 0
+        '''Send packets to UAV in idle loop. ACKs are sent first, then NACKs
+        for missing blocks which are due, all in a single write'''
+        max_blocks_to_send = self.log_settings.max_acks
         now = time.time()
-        while (i < len(self.blocks_to_ack_and_nack) and
-               blocks_sent < max_blocks_to_send):
-            # print("ACKLIST: %s" %
-            # ([x[1] for x in self.blocks_to_ack_and_nack],))
-            stuff = self.blocks_to_ack_and_nack[i]
-
-            [master, block, status, first_sent, last_sent] = stuff
-            if status == 1:
-                # print("DFLogger: ACKing block (%d)" % (block,))
-                mavstatus = mavutil.mavlink.MAV_REMOTE_LOG_DATA_BLOCK_ACK
-                (target_sys, target_comp) = self.sender
-                self.master.mav.remote_log_block_status_send(target_sys,
-                                                             target_comp,
-                                                             block,
-                                                             mavstatus)
-                blocks_sent += 1
-                del self.acking_blocks[block]
-                del self.blocks_to_ack_and_nack[i]
-                continue
+        (target_sys, target_comp) = self.sender
+        msgs = []
+        mav = self.master.mav
+
+        while len(self.ack_queue) > 0 and len(msgs) < max_blocks_to_send:
+            block = self.ack_queue.popleft()
+            self.acking_blocks.discard(block)
+            msgs.append(mav.remote_log_block_status_encode(target_sys,
+                                                           target_comp,
+                                                           block,
+                                                           mavutil.mavlink.MAV_REMOTE_LOG_DATA_BLOCK_ACK))
+
+        # give up on packets if we have seen one with a much higher
+        # number (or after 60 seconds). missing_blocks is in block
+        # order, which is also the order they went missing
+        while len(self.missing_blocks) > 0:
+            (block, first_sent) = next(iter(self.missing_blocks.items()))
+            if not ((self.last_seqno - block > 200) or (now - first_sent > 60)):
+                break
+            if self.log_settings.verbose:
+                print("DFLogger: Abandoning block (%d)" % (block,))
+            del self.missing_blocks[block]
+            self.abandoned += 1
 
+        # only send each nack every-so-often:
+        while len(self.nack_queue) > 0 and len(msgs) < max_blocks_to_send:
+            (due, block) = self.nack_queue[0]
             if block not in self.missing_blocks:
-                # we've received this block now
-                del self.blocks_to_ack_and_nack[i]
-                continue
-
-            # give up on packet if we have seen one with a much higher
-            # number (or after 60 seconds):
-            if (self.last_seqno - block > 200) or (now - first_sent > 60):
-                if self.log_settings.verbose:
-                    print("DFLogger: Abandoning block (%d)" % (block,))
-                del self.blocks_to_ack_and_nack[i]
-                del self.missing_blocks[block]
-                self.abandoned += 1
+                # we've received this block now, or abandoned it
+                self.nack_queue.popleft()
                 continue
-
-            i += 1
-            # only send each nack every-so-often:
-            if last_sent is not None:
-                if now - last_sent < 0.1:
-                    continue
-
+            if due > now:
+                break
+            self.nack_queue.popleft()
             if self.log_settings.verbose:
                 print("DFLogger: Asking for block (%d)" % (block,))
-            mavstatus = mavutil.mavlink.MAV_REMOTE_LOG_DATA_BLOCK_NACK
-            (target_sys, target_comp) = self.sender
-            self.master.mav.remote_log_block_status_send(target_sys,
-                                                         target_comp,
-                                                         block,
-                                                         mavstatus)
-            blocks_sent += 1
-            stuff[4] = now
+            msgs.append(mav.remote_log_block_status_encode(target_sys,
+                                                           target_comp,
+                                                           block,
+                                                           mavutil.mavlink.MAV_REMOTE_LOG_DATA_BLOCK_NACK))
+            self.nack_queue.append((now+0.1, block))
+
+        if len(msgs) > 0:
+            mp_udp.send_burst(self.master, msgs)
+
+        if len(self.write_buf) > 0 and now - self.write_time > 0.5:
+            self.flush_log()
 
     def idle_task_started(self):
         '''called in idle task only when logging is started'''
@@ -270,30 +322,28 @@ class dataflash_logger(mp_module.MPModule):
                 return False
         return True
 
-    def do_ack_block(self, seqno):
+    def ack_block(self, seqno):
+        '''queue an ACK for a block'''
         if seqno in self.acking_blocks:
             # already acking this one; we probably sent
             # multiple nacks and received this one
             # multiple times
             return
+        self.ack_queue.append(seqno)
+        self.acking_blocks.add(seqno)
 
-        now = time.time()
-
-        # ACK the block we just got:
-        self.blocks_to_ack_and_nack.append([self.master, seqno, 1, now, None])
-        self.acking_blocks[seqno] = 1
+    def do_ack_block(self, seqno):
+        self.ack_block(seqno)
 
         # NACK any blocks we haven't seen and should have:
         if(seqno - self.last_seqno > 1):
+            now = time.time()
             for block in range(self.last_seqno+1, seqno):
-                if block not in self.missing_blocks and \
-                   block not in self.acking_blocks:
-                    self.missing_blocks[block] = 1
+                if block not in self.missing_blocks:
+                    self.missing_blocks[block] = now
                     if self.log_settings.verbose:
                         print("DFLogger: setting %d for nacking" % (block,))
-                    self.blocks_to_ack_and_nack.append(
-                        [self.master, block, 0, now, None]
-                    )
+                    self.nack_queue.append((now, block))
         # print("\nmissed blocks: ",self.missing_blocks)
 
     def mavlink_packet(self, m):
@@ -319,28 +369,29 @@ class dataflash_logger(mp_module.MPModule):
                 return
 
             if self.sender is not None:
-                size = len(m.data)
-                data = ''.join(str(chr(x)) for x in m.data[:size])
-                ofs = size*(m.seqno)
-                self.logfile.seek(ofs)
-                self.logfile.write(data)
-
-                if m.seqno in self.missing_blocks:
+                seqno = m.seqno
+                if seqno in self.missing_blocks:
                     if self.log_settings.verbose:
-                        print("DFLogger: Got missing block: %d" % (m.seqno,))
-                    del self.missing_blocks[m.seqno]
+                        print("DFLogger: Got missing block: %d" % (seqno,))
+                    del self.missing_blocks[seqno]
                     self.missing_found += 1
-                    self.blocks_to_ack_and_nack.append(
-                        [self.master, m.seqno, 1, time.time(), None]
-                    )
-                    self.acking_blocks[m.seqno] = 1
-                    # print("DFLogger: missing: %s" %
-                    # (str(self.missing_blocks),))
+                    self.ack_block(seqno)
+                elif seqno <= self.last_seqno and seqno != 0:
+                    # a block we already have, or have abandoned. ACK it
+                    # again so the sender stops resending it
+                    self.duplicates += 1
+                    self.ack_block(seqno)
                 else:
-                    self.do_ack_block(m.seqno)
-                    if self.last_seqno < m.seqno:
-                        self.last_seqno = m.seqno
-                self.download += size
+                    self.do_ack_block(seqno)
+                    if self.last_seqno < seqno:
+                        self.last_seqno = seqno
+                data = bytearray(m.data)
+                self.write_block(len(data)*seqno, data)
+                self.download += len(data)
+
+    def unload(self):
+        '''unload module'''
+        self.close_log()
 
 
 def init(mpstate):
@@ -1,10 +1,11 @@
 """
     MAVProxy geofence module
 """
-import os, time, platform
+import os, platform
 from pymavlink import mavwp, mavutil
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_transfer
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
 
@@ -223,38 +224,45 @@ class FenceModule(mp_module.MPModule):
         action = self.get_mav_param('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE)
         self.param_set('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE, 3)
         self.param_set('FENCE_TOTAL', self.fenceloader.count(), 3)
-        for i in range(self.fenceloader.count()):
-            p = self.fenceloader.point(i)
-            self.master.mav.send(p)
-            p2 = self.fetch_fence_point(i)
-            if p2 is None:
-                self.param_set('FENCE_ACTION', action, 3)
-                return False
-            if (p.idx != p2.idx or
-                abs(p.lat - p2.lat) >= 0.00003 or
-                abs(p.lng - p2.lng) >= 0.00003):
-                print("Failed to send fence point %u" % i)
+        # send all the points, then read them back to check them,
+        # resending any which didn't arrive
+        to_send = list(range(self.fenceloader.count()))
+        for attempt in range(3):
+            for i in to_send:
+                self.master.mav.send(self.fenceloader.point(i))
+            points = self.fetch_fence_points(self.fenceloader.count())
+            if points is None:
                 self.param_set('FENCE_ACTION', action, 3)
                 return False
+            to_send = []
+            for i in range(self.fenceloader.count()):
+                p = self.fenceloader.point(i)
+                p2 = points[i]
+                if (p.idx != p2.idx or
+                    abs(p.lat - p2.lat) >= 0.00003 or
+                    abs(p.lng - p2.lng) >= 0.00003):
+                    to_send.append(i)
+            if len(to_send) == 0:
+                break
+        if len(to_send) > 0:
+            print("Failed to send fence point %u" % to_send[0])
+            self.param_set('FENCE_ACTION', action, 3)
+            return False
         self.param_set('FENCE_ACTION', action, 3)
         return True
 
-    def fetch_fence_point(self ,i):
-        '''fetch one fence point'''
-        self.master.mav.fence_fetch_point_send(self.target_system,
-                                                    self.target_component, i)
-        tstart = time.time()
-        p = None
-        while time.time() - tstart < 3:
-            p = self.master.recv_match(type='FENCE_POINT', blocking=False)
-            if p is not None:
-                break
-            time.sleep(0.1)
-            continue
-        if p is None:
-            self.console.error("Failed to fetch point %u" % i)
-            return None
-        return p
+    def fetch_fence_points(self, count):
+        '''fetch count fence points, keeping several requests in flight'''
+        def request(i):
+            self.master.mav.fence_fetch_point_send(self.target_system,
+                                                   self.target_component, i)
+        transfer = mp_transfer.ItemTransfer(count, request,
+                                            window=self.settings.wp_window,
+                                            window_max=self.settings.wp_window_max)
+        points = mp_transfer.fetch_blocking(self.master, transfer, 'FENCE_POINT')
+        if points is None:
+            self.console.error("Failed to fetch fence points (%s)" % transfer.status_string())
+        return points
 
     def fence_draw_callback(self, points):
         '''callback from drawing a fence'''
@@ -281,10 +289,10 @@ class FenceModule(mp_module.MPModule):
         if count == 0:
             print("No geo-fence points")
             return
-        for i in range(int(count)):
-            p = self.fetch_fence_point(i)
-            if p is None:
-                return
+        points = self.fetch_fence_points(int(count))
+        if points is None:
+            return
+        for p in points:
             self.fenceloader.add(p)
 
         if filename is not None:
@@ -5,9 +5,10 @@
 """
 
 from pymavlink import mavutil
-import re, os, sys
+import os, sys, time
 
 from MAVProxy.modules.lib import live_graph
+from MAVProxy.modules.lib import mp_expression
 
 from MAVProxy.modules.lib import mp_module
 
@@ -17,6 +18,7 @@ class GraphModule(mp_module.MPModule):
         self.timespan = 20
         self.tickresolution = 0.2
         self.graphs = []
+        self.check_period = mavutil.periodic_event(1)
         self.add_command('graph', self.cmd_graph, "[expression...] add a live graph",
                          ['(VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE) (VARIABLE)',
                           'legend',
@@ -76,17 +78,19 @@ class GraphModule(mp_module.MPModule):
 
     def mavlink_packet(self, msg):
         '''handle an incoming mavlink packet'''
-
-        # check for any closed graphs
-        for i in range(len(self.graphs) - 1, -1, -1):
-            if not self.graphs[i].is_alive():
-                self.graphs[i].close()
-                self.graphs.pop(i)
-
-        # add data to the rest
         for g in self.graphs:
             g.add_mavlink_packet(msg)
 
+    def idle_task(self):
+        '''send data which arrived since the last packet, and check for closed graphs'''
+        for g in self.graphs:
+            g.flush()
+        if self.check_period.trigger():
+            for i in range(len(self.graphs) - 1, -1, -1):
+                if not self.graphs[i].is_alive():
+                    self.graphs[i].close()
+                    self.graphs.pop(i)
+
 
 def init(mpstate):
     '''initialise module'''
@@ -100,11 +104,10 @@ class Graph():
         self.msg_types = set()
         self.state = state
 
-        re_caps = re.compile('[A-Z_][A-Z0-9_]+')
-        for f in self.fields:
-            caps = set(re.findall(re_caps, f))
-            self.msg_types = self.msg_types.union(caps)
-            self.field_types.append(caps)
+        self.expressions = [ mp_expression.compile_expression(f) for f in self.fields ]
+        for e in self.expressions:
+            self.msg_types = self.msg_types.union(e.msg_types)
+            self.field_types.append(e.msg_types)
         print("Adding graph: %s" % self.fields)
 
         fields = [ self.pretty_print_fieldname(x) for x in fields ]
@@ -132,6 +135,11 @@ class Graph():
             self.livegraph.close()
         self.livegraph = None
 
+    def flush(self):
+        '''send any buffered values to the graph'''
+        if self.livegraph is not None and time.time() - self.livegraph.last_send >= self.livegraph.tickresolution:
+            self.livegraph.flush()
+
     def add_mavlink_packet(self, msg):
         '''add data to the graph'''
         mtype = msg.get_type()
@@ -140,7 +148,6 @@ class Graph():
         for i in range(len(self.fields)):
             if mtype not in self.field_types[i]:
                 continue
-            f = self.fields[i]
-            self.values[i] = mavutil.evaluate_expression(f, self.state.master.messages)
+            self.values[i] = self.expressions[i].evaluate(self.state.master.messages)
         if self.livegraph is not None:
             self.livegraph.add_values(self.values)
@@ -7,7 +7,7 @@
 '''
 
 from pymavlink import mavutil
-import time, struct, math, sys, fnmatch, traceback, json
+import time, math, sys, fnmatch, traceback, json
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
@@ -218,6 +218,7 @@ class LinkModule(mp_module.MPModule):
         self.apply_link_attributes(conn, optional_attributes)
         self.mpstate.mav_master.append(conn)
         self.status.counters['MasterIn'].append(0)
+        self.mpstate.reactor.invalidate()
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
@@ -284,6 +285,7 @@ class LinkModule(mp_module.MPModule):
             pass
         self.mpstate.mav_master.pop(i)
         self.status.counters['MasterIn'].pop(i)
+        self.mpstate.reactor.invalidate()
         # renumber the links
         for j in range(len(self.mpstate.mav_master)):
             conn = self.mpstate.mav_master[j]
@@ -305,7 +307,7 @@ class LinkModule(mp_module.MPModule):
         if mtype != 'BAD_DATA' and self.mpstate.logqueue:
             usec = self.get_usec()
             usec = (usec & ~3) | 3 # linknum 3
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put_tlog(usec, m.get_msgbuf())
 
     def handle_msec_timestamp(self, m, master):
         '''special handling for MAVLink packets with a time_boot_ms field'''
@@ -536,14 +538,22 @@ class LinkModule(mp_module.MPModule):
 
 
 
+    def forward(self, conn, buf):
+        '''send a packet buffer to an output, batching if enabled'''
+        if self.settings.fanout:
+            self.mpstate.fanout.put(conn, buf, self.settings.fanout_maxq)
+        else:
+            conn.write(buf)
+
     def master_callback(self, m, master):
         '''process mavlink message m on master, sending any messages to recipients'''
 
         # see if it is handled by a specialised sysid connection
         sysid = m.get_srcSystem()
         mtype = m.get_type()
+        msgbuf = m.get_msgbuf()
         if sysid in self.mpstate.sysid_outputs:
-            self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+            self.forward(self.mpstate.sysid_outputs[sysid], msgbuf)
             if mtype == "GLOBAL_POSITION_INT":
                 for modname in 'map', 'asterix', 'NMEA', 'NMEA2':
                     mod = self.module(modname)
@@ -558,12 +568,12 @@ class LinkModule(mp_module.MPModule):
         if mtype == 'GLOBAL_POSITION_INT':
             # send GLOBAL_POSITION_INT to 2nd GCS for 2nd vehicle display
             for sysid in self.mpstate.sysid_outputs:
-                self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+                self.forward(self.mpstate.sysid_outputs[sysid], msgbuf)
 
             if self.mpstate.settings.fwdpos:
                 for link in self.mpstate.mav_master:
                     if link != master:
-                        link.write(m.get_msgbuf())
+                        link.write(msgbuf)
 
         # and log them
         if mtype not in dataPackets and self.mpstate.logqueue:
@@ -571,7 +581,7 @@ class LinkModule(mp_module.MPModule):
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(bytearray(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put_tlog(usec, msgbuf)
 
         # keep the last message of each type around
         self.status.msgs[mtype] = m
@@ -609,19 +619,20 @@ class LinkModule(mp_module.MPModule):
             if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
                 if mtype not in self.no_fwd_types:
                     for r in self.mpstate.mav_outputs:
-                        r.write(m.get_msgbuf())
+                        self.forward(r, msgbuf)
 
             sysid = m.get_srcSystem()
             target_sysid = self.target_system
 
-            # pass to modules
-            for (mod,pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
+            # pass to modules which want this message type
+            dispatch = self.mpstate.dispatch
+            profiler = self.mpstate.profiler
+            for mod in dispatch.modules_for(mtype):
                 if not mod.multi_vehicle and sysid != target_sysid:
                     # only pass packets not from our target to modules that
                     # have marked themselves as being multi-vehicle capable
                     continue
+                profiler.begin(mod.name, 'mavlink_packet')
                 try:
                     mod.mavlink_packet(m)
                 except Exception as msg:
@@ -631,6 +642,7 @@ class LinkModule(mp_module.MPModule):
                         exc_type, exc_value, exc_traceback = sys.exc_info()
                         traceback.print_exception(exc_type, exc_value, exc_traceback,
                                                   limit=2, file=sys.stdout)
+                dispatch.record(mod, mtype, profiler.end())
 
     def cmd_vehicle(self, args):
         '''handle vehicle commands'''
@@ -1,24 +1,58 @@
 #!/usr/bin/env python
 '''log command handling'''
 
-import time, os
+import time, os, json
 
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_settings
+from MAVProxy.modules.lib.mp_intervals import IntervalSet
+
+# largest offset a LOG_REQUEST_DATA can ask for
+LOG_MAX_OFS = 0xFFFFFFFF
+
+class LogRequest(object):
+    '''an outstanding LOG_REQUEST_DATA for [start,end)'''
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.sent = time.time()
+        self.first_data = None
+        self.last_data = None
 
 class LogModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(LogModule, self).__init__(mpstate, "log", "log transfer")
-        self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>'])
+        self.subscribe(['LOG_ENTRY', 'LOG_DATA'])
+        self.add_command('log', self.cmd_log, "log file handling", ['<download|status|erase|resume|cancel|list>',
+                                                                      'set (LOGDOWNLOADSETTING)'])
+        self.log_settings = mp_settings.MPSettings(
+            [ ('window_min', int, 4096),       # bytes per request when the link is lossy
+              ('window_max', int, 1048576),    # bytes per request when the link is good
+              ('inflight', int, 1),            # requests outstanding at once
+              ('resume', bool, True) ])        # resume partial downloads
+        self.add_completion_function('(LOGDOWNLOADSETTING)', self.log_settings.completion)
         self.reset()
 
     def reset(self):
-        self.download_set = set()
+        self.received = IntervalSet()
         self.download_file = None
         self.download_lognum = None
         self.download_filename = None
         self.download_start = None
         self.download_last_timestamp = None
         self.download_ofs = 0
+        self.download_size = None
+        self.download_eof = None
+        self.download_bytes = 0
+        self.download_requested = 0
+        self.last_state_save = 0
+        self.requests = []
+        self.window = 16384
+        self.srtt = None
+        self.loss = 0
+        self.rate = 0
+        self.rate_bytes = 0
+        self.rate_time = None
         self.retries = 0
         self.entries = {}
         self.download_queue = []
@@ -39,92 +73,230 @@ class LogModule(mp_module.MPModule):
         self.entries[m.id] = m
         print("Log %u  numLogs %u lastLog %u size %u %s" % (m.id, m.num_logs, m.last_log_num, m.size, tstring))
 
+    def download_limit(self):
+        '''return the size of the log being downloaded, if known'''
+        if self.download_eof is not None:
+            if self.download_size is not None:
+                return min(self.download_size, self.download_eof)
+            return self.download_eof
+        return self.download_size
 
     def handle_log_data(self, m):
         '''handling incoming log data'''
-        if self.download_file is None:
+        if self.download_file is None or m.id != self.download_lognum:
             return
         # lose some data
         # import random
         # if random.uniform(0,1) < 0.05:
         #    print('dropping ', str(m))
         #    return
-        if m.ofs != self.download_ofs:
-            self.download_file.seek(m.ofs)
-            self.download_ofs = m.ofs
+        now = time.time()
         if m.count != 0:
-            s = bytearray(m.data[:m.count])
-            self.download_file.write(s)
-            self.download_set.add(m.ofs // 90)
+            if m.ofs != self.download_ofs:
+                self.download_file.seek(m.ofs)
+                self.download_ofs = m.ofs
+            self.download_file.write(bytearray(m.data[:m.count]))
             self.download_ofs += m.count
-        self.download_last_timestamp = time.time()
-        if m.count == 0 or (m.count < 90 and len(self.download_set) == 1 + (m.ofs // 90)):
-            dt = time.time() - self.download_start
-            self.download_file.close()
-            size = os.path.getsize(self.download_filename)
-            speed = size / (1000.0 * dt)
-            print("Finished downloading %s (%u bytes %u seconds, %.1f kbyte/sec %u retries)" % (
-                self.download_filename,
-                size,
-                dt, speed,
-                self.retries))
-            self.download_file = None
-            self.download_filename = None
-            self.download_set = set()
-            self.master.mav.log_request_end_send(self.target_system,
-                                                 self.target_component)
-            if len(self.download_queue):
-                self.log_download_next()
+            if not self.received.contains(m.ofs, m.ofs+m.count):
+                self.download_bytes += m.count
+                self.rate_bytes += m.count
+            self.received.add(m.ofs, m.ofs+m.count)
+        self.download_last_timestamp = now
 
-    def handle_log_data_missing(self):
-        '''handling missing incoming log data'''
-        if len(self.download_set) == 0:
-            return
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        if len(diff) == 0:
-            self.master.mav.log_request_data_send(self.target_system,
-                                                       self.target_component,
-                                                       self.download_lognum, (1 + highest) * 90, 0xffffffff)
-            self.retries += 1
+        for r in self.requests[:]:
+            if m.ofs < r.start or m.ofs > r.end:
+                continue
+            if r.first_data is None:
+                self.update_rtt(now - r.sent)
+                r.first_data = now
+            r.last_data = now
+            if m.count < 90 and m.ofs + m.count < r.end:
+                # the last packet of a request may be short, but one
+                # ending inside the request marks the end of the log
+                if self.download_eof is None or self.download_eof > m.ofs + m.count:
+                    self.download_eof = m.ofs + m.count
+                self.request_done(r)
+            elif m.ofs + m.count >= r.end:
+                self.request_done(r)
+
+        if self.download_complete():
+            self.download_finished()
         else:
-            num_requests = 0
-            while num_requests < 20:
-                start = min(diff)
-                diff.remove(start)
-                end = start
-                while end + 1 in diff:
-                    end += 1
-                    diff.remove(end)
-                self.master.mav.log_request_data_send(self.target_system,
-                                                           self.target_component,
-                                                           self.download_lognum, start * 90, (end + 1 - start) * 90)
-                num_requests += 1
+            self.send_requests()
+
+    def update_rtt(self, rtt):
+        '''update the smoothed round trip time'''
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def request_timeout(self, r):
+        '''time without data after which a request is treated as finished'''
+        if self.srtt is None:
+            return 1.0
+        if r.first_data is None:
+            return max(0.5, 3*self.srtt)
+        return max(0.2, 2*self.srtt)
+
+    def request_done(self, r):
+        '''a request has finished, adjust the window to the loss seen'''
+        self.requests.remove(r)
+        end = r.end
+        limit = self.download_limit()
+        if limit is not None:
+            end = min(end, limit)
+        if end <= r.start:
+            return
+        loss = 1.0 - self.received.covered(r.start, end) / float(end - r.start)
+        self.loss = 0.7 * self.loss + 0.3 * loss
+        if loss < 0.02:
+            self.window = min(self.window * 2, self.log_settings.window_max)
+        elif loss > 0.1:
+            self.window = max(self.window // 2, self.log_settings.window_min)
+
+    def next_range(self):
+        '''return the next (start,end) range to request, or None'''
+        limit = self.download_limit()
+        if limit is None:
+            limit = LOG_MAX_OFS
+        pos = 0
+        while True:
+            gap = self.received.first_gap(pos, limit)
+            if gap is None:
+                return None
+            (start, end) = gap
+            for r in self.requests:
+                if r.start <= start < r.end:
+                    # already asked for
+                    start = r.end
+                elif start < r.start < end:
+                    end = r.start
+            if start < end:
+                return (start, min(end, start + self.window))
+            pos = max(start, end)
+
+    def send_requests(self):
+        '''keep inflight requests outstanding'''
+        while len(self.requests) < max(self.log_settings.inflight, 1):
+            rng = self.next_range()
+            if rng is None:
+                return
+            (start, end) = rng
+            if start < self.download_requested:
                 self.retries += 1
-                if len(diff) == 0:
-                    break
+            self.download_requested = max(self.download_requested, end)
+            self.requests.append(LogRequest(start, end))
+            self.master.mav.log_request_data_send(self.target_system,
+                                                  self.target_component,
+                                                  self.download_lognum, start, end - start)
 
+    def download_complete(self):
+        '''see if we have the whole log'''
+        limit = self.download_limit()
+        if limit is None:
+            return False
+        return self.received.contains(0, limit) or limit == 0
+
+    def download_finished(self):
+        '''finish a download'''
+        dt = max(time.time() - self.download_start, 0.001)
+        self.download_file.close()
+        size = os.path.getsize(self.download_filename)
+        speed = self.download_bytes / (1000.0 * dt)
+        print("Finished downloading %s (%u bytes %u seconds, %.1f kbyte/sec %u retries)" % (
+            self.download_filename,
+            size,
+            dt, speed,
+            self.retries))
+        try:
+            os.unlink(self.state_filename(self.download_filename))
+        except OSError:
+            pass
+        self.download_file = None
+        self.download_filename = None
+        self.download_last_timestamp = None
+        self.requests = []
+        self.master.mav.log_request_end_send(self.target_system,
+                                             self.target_component)
+        if len(self.download_queue):
+            self.log_download_next()
+
+    def state_filename(self, filename):
+        '''sidecar file holding the state of a partial download'''
+        return filename + '.state'
+
+    def save_state(self):
+        '''save the received ranges so the download can be resumed'''
+        if self.download_file is None:
+            return
+        self.download_file.flush()
+        state = { 'lognum' : self.download_lognum,
+                  'size' : self.download_size,
+                  'eof' : self.download_eof,
+                  'ranges' : self.received.ranges() }
+        path = self.state_filename(self.download_filename)
+        try:
+            f = open(path + '.tmp', 'w')
+            json.dump(state, f)
+            f.close()
+            os.rename(path + '.tmp', path)
+        except Exception as e:
+            print("Failed to save %s: %s" % (path, e))
+        self.last_state_save = time.time()
+
+    def load_state(self, log_num, filename):
+        '''load the state of a partial download, returning None if the
+        download can't be resumed'''
+        path = self.state_filename(filename)
+        if not self.log_settings.resume or not os.path.exists(path) or not os.path.exists(filename):
+            return None
+        try:
+            f = open(path, 'r')
+            state = json.load(f)
+            f.close()
+        except Exception:
+            return None
+        if state.get('lognum', None) != log_num:
+            return None
+        if (self.download_size is not None and state.get('size', None) is not None and
+            state['size'] != self.download_size):
+            return None
+        return state
 
     def log_status(self):
         '''show download status'''
         if self.download_filename is None:
             print("No download")
             return
-        dt = time.time() - self.download_start
-        speed = os.path.getsize(self.download_filename) / (1000.0 * dt)
-        m = self.entries.get(self.download_lognum, None)
-        if m is None:
-            size = 0
+        dt = max(time.time() - self.download_start, 0.001)
+        speed = self.download_bytes / (1000.0 * dt)
+        limit = self.download_limit()
+        received = len(self.received)
+        if limit is None:
+            size_str = "?"
+            eta_str = "?"
+            missing = 0
         else:
-            size = m.size
-        highest = max(self.download_set)
-        diff = set(range(highest)).difference(self.download_set)
-        print("Downloading %s - %u/%u bytes %.1f kbyte/s (%u retries %u missing)" % (self.download_filename,
-                                                                                     os.path.getsize(self.download_filename),
-                                                                                     size,
-                                                                                     speed,
-                                                                                     self.retries,
-                                                                                     len(diff)))
+            size_str = "%u" % limit
+            missing = len(self.received.gaps(0, limit))
+            remaining = limit - self.received.covered(0, limit)
+            if self.rate > 0:
+                eta_str = "%us" % (remaining / self.rate)
+            else:
+                eta_str = "?"
+        print("Downloading %s - %u/%s bytes %.1f kbyte/s (now %.1f kbyte/s) ETA %s (%u retries %u gaps) window %u loss %.0f%% rtt %s" % (
+            self.download_filename,
+            received,
+            size_str,
+            speed,
+            self.rate/1000.0,
+            eta_str,
+            self.retries,
+            missing,
+            self.window,
+            self.loss*100,
+            "%.0fms" % (self.srtt*1000) if self.srtt is not None else "?"))
 
     def log_download_next(self):
         latest = self.download_queue.pop()
@@ -140,25 +312,51 @@ class LogModule(mp_module.MPModule):
 
     def log_download(self, log_num, filename):
         '''download a log file'''
-        print("Downloading log %u as %s" % (log_num, filename))
+        m = self.entries.get(log_num, None)
+        if m is not None:
+            self.download_size = m.size
+        else:
+            self.download_size = None
+        self.download_eof = None
+        self.received = IntervalSet()
+        state = self.load_state(log_num, filename)
+        if state is not None:
+            self.received = IntervalSet(state['ranges'])
+            self.download_eof = state.get('eof', None)
+            if self.download_size is None:
+                self.download_size = state.get('size', None)
+            print("Resuming log %u as %s (%u bytes already received)" % (log_num, filename, len(self.received)))
+            self.download_file = open(filename, "r+b")
+        else:
+            print("Downloading log %u as %s" % (log_num, filename))
+            self.download_file = open(filename, "wb")
         self.download_lognum = log_num
-        self.download_file = open(filename, "wb")
-        self.master.mav.log_request_data_send(self.target_system,
-                                                   self.target_component,
-                                                   log_num, 0, 0xFFFFFFFF)
         self.download_filename = filename
-        self.download_set = set()
         self.download_start = time.time()
         self.download_last_timestamp = time.time()
         self.download_ofs = 0
+        self.download_bytes = 0
+        self.download_requested = 0
+        self.requests = []
+        self.window = self.log_settings.window_min * 4
+        self.srtt = None
+        self.loss = 0
+        self.rate = 0
+        self.rate_bytes = 0
+        self.rate_time = time.time()
         self.retries = 0
+        if self.download_complete():
+            self.download_finished()
+            return
+        self.send_requests()
+        self.save_state()
 
     def default_log_filename(self, log_num):
         return "log%u.bin" % log_num
 
     def cmd_log(self, args):
         '''log commands'''
-        usage = "usage: log <list|download|erase|resume|status|cancel>"
+        usage = "usage: log <list|download|erase|resume|status|cancel|set>"
         if len(args) < 1:
             print(usage)
             return
@@ -167,7 +365,6 @@ class LogModule(mp_module.MPModule):
             self.log_status()
         elif args[0] == "list":
             print("Requesting log list")
-            self.download_set = set()
             self.master.mav.log_request_list_send(self.target_system,
                                                        self.target_component,
                                                        0, 0xffff)
@@ -182,9 +379,15 @@ class LogModule(mp_module.MPModule):
 
         elif args[0] == "cancel":
             if self.download_file is not None:
+                self.save_state()
                 self.download_file.close()
+                self.master.mav.log_request_end_send(self.target_system,
+                                                     self.target_component)
             self.reset()
 
+        elif args[0] == "set":
+            self.log_settings.command(args[1:])
+
         elif args[0] == "download":
             if len(args) < 2:
                 print("usage: log download <lognumber> <filename>")
@@ -209,10 +412,28 @@ class LogModule(mp_module.MPModule):
 
 
     def idle_task(self):
-        '''handle missing log data'''
-        if self.download_last_timestamp is not None and time.time() - self.download_last_timestamp > 0.7:
-            self.download_last_timestamp = time.time()
-            self.handle_log_data_missing()
+        '''handle requests which have stopped getting data'''
+        if self.download_file is None:
+            return
+        now = time.time()
+        for r in self.requests[:]:
+            last = r.last_data
+            if last is None:
+                last = r.sent
+            if now - last > self.request_timeout(r):
+                self.request_done(r)
+        self.send_requests()
+        if len(self.requests) == 0 and self.download_complete():
+            self.download_finished()
+            return
+        if now - self.rate_time >= 1:
+            # throughput over the last second or so, for the ETA
+            rate = self.rate_bytes / (now - self.rate_time)
+            self.rate = rate if self.rate == 0 else 0.7 * self.rate + 0.3 * rate
+            self.rate_bytes = 0
+            self.rate_time = now
+        if now - self.last_state_save > 2:
+            self.save_state()
 
 def init(mpstate):
     '''initialise module'''
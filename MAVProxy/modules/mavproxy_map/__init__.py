@@ -53,7 +53,8 @@ class MapModule(mp_module.MPModule):
               ('brightness', float, 1),
               ('rallycircle', bool, False),
               ('loitercircle',bool, False),
-              ('showdirection', bool, False)])
+              ('showdirection', bool, False),
+              ('max_fps', float, 5)])
         
         service='MicrosoftHyb'
         if 'MAP_SERVICE' in os.environ:
@@ -155,6 +156,7 @@ class MapModule(mp_module.MPModule):
         elif args[0] == "set":
             self.map_settings.command(args[1:])
             self.map.add_object(mp_slipmap.SlipBrightness(self.map_settings.brightness))
+            self.map.set_max_fps(self.map_settings.max_fps)
         elif args[0] == "sethome":
             self.cmd_set_home(args)
         elif args[0] == "sethomepos":
@@ -491,6 +493,8 @@ class MapModule(mp_module.MPModule):
             self.last_unload_check_time = now
             if not self.map.is_alive():
                 self.needs_unloading = True
+        # send any object moves held back for batching
+        self.map.flush(force=False)
 
     def create_vehicle_icon(self, name, colour, follow=False, vehicle_type=None):
         '''add a vehicle to the map'''
@@ -16,14 +16,14 @@ from MAVProxy.modules.mavproxy_map import srtm
 class ElevationModel():
     '''Elevation Model. Only SRTM for now'''
 
-    def __init__(self, database='srtm', offline=0, debug=False):
+    def __init__(self, database='srtm', offline=0, debug=False, max_tiles=16):
         '''Use offline=1 to disable any downloading of tiles, regardless of whether the
-        tile exists'''
+        tile exists. At most max_tiles tiles are kept open'''
         self.database = database
         if self.database == 'srtm':
-            self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug)
+            self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug, max_tiles=max_tiles)
             self.downloader.loadFileList()
-            self.tileDict = dict()
+            self.tileDict = srtm.SRTMTileCache(max_tiles)
 
         '''Use the Geoscience Australia database instead - watch for the correct database path'''
         if self.database == 'geoscience':
@@ -31,31 +31,62 @@ class ElevationModel():
             self.mappy = GAreader.ERMap()
             self.mappy.read_ermapper(os.path.join(os.environ['HOME'], './Documents/Elevation/Canberra/GSNSW_P756demg'))
 
+    def GetTile(self, tile_lat, tile_lon, timeout=0):
+        '''Returns the SRTM tile with its corner at an integer lat/long, or None if unavailable'''
+        TileID = (tile_lat, tile_lon)
+        if TileID in self.tileDict:
+            return self.tileDict[TileID]
+        tile = self.downloader.getTile(tile_lat, tile_lon)
+        if tile == 0:
+            if timeout > 0:
+                t0 = time.time()
+                while time.time() < t0+timeout and tile == 0:
+                    tile = self.downloader.getTile(tile_lat, tile_lon)
+                    if tile == 0:
+                        time.sleep(0.1)
+        if tile == 0:
+            return None
+        self.tileDict[TileID] = tile
+        return tile
+
     def GetElevation(self, latitude, longitude, timeout=0):
         '''Returns the altitude (m ASL) of a given lat/long pair, or None if unknown'''
         if latitude is None or longitude is None:
             return None
         if self.database == 'srtm':
-            TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
-                if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
+            tile = self.GetTile(numpy.floor(latitude), numpy.floor(longitude), timeout)
+            if tile is None:
+                return None
+            alt = tile.getAltitudeFromLatLon(latitude, longitude)
         if self.database == 'geoscience':
              alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
         return alt
 
+    def GetElevationArray(self, latitudes, longitudes, timeout=0):
+        '''Returns an array of altitudes (m ASL) for arrays of lat/long,
+        with NaN where unknown. Points are grouped by SRTM tile and
+        interpolated a tile at a time'''
+        lats = numpy.asarray(latitudes, dtype=numpy.float64)
+        lons = numpy.asarray(longitudes, dtype=numpy.float64)
+        ret = numpy.full(lats.shape, numpy.nan)
+        if self.database == 'srtm':
+            tile_lats = numpy.floor(lats)
+            tile_lons = numpy.floor(lons)
+            tile_keys = (tile_lats + 90) * 360 + (tile_lons + 180)
+            for key in numpy.unique(tile_keys):
+                mask = (tile_keys == key)
+                i = numpy.argmax(mask)
+                tile = self.GetTile(tile_lats.flat[i], tile_lons.flat[i], timeout)
+                if tile is None:
+                    continue
+                ret[mask] = tile.getAltitudeArray(lats[mask], lons[mask])
+        if self.database == 'geoscience':
+            for i in range(lats.size):
+                alt = self.mappy.getAltitudeAtPoint(lats.flat[i], lons.flat[i])
+                if alt is not None:
+                    ret.flat[i] = alt
+        return ret
+
 
 if __name__ == "__main__":
 
@@ -39,7 +39,9 @@ class MPSlipMap():
                  brightness=0,
                  elevation=False,
                  download=True,
-                 show_flightmode_legend=True):
+                 show_flightmode_legend=True,
+                 max_fps=5,
+                 position_interval=0.1):
 
         self.lat = lat
         self.lon = lon
@@ -55,6 +57,13 @@ class MPSlipMap():
         self.oldtext = None
         self.brightness = brightness
         self.legend = show_flightmode_legend
+        self.max_fps = max_fps
+
+        # object moves are coalesced, keeping only the latest position
+        # for each object, and sent as one batch every position_interval
+        self.position_interval = position_interval
+        self.pending_positions = {}
+        self.last_position_flush = 0
 
         self.drag_step = 10
 
@@ -86,6 +95,13 @@ class MPSlipMap():
         state.layers = {}
         state.info = {}
         state.need_redraw = True
+        # objects which have moved or been replaced since they were added
+        # are drawn every frame, the rest are kept in a cached overlay
+        # which is rebuilt when static_version changes
+        state.dynamic_keys = set()
+        state.static_version = 0
+        # key -> list of layers holding an object with that key
+        state.object_layers = {}
 
         self.app = wx.App(False)
         self.app.SetExitOnFrameDelete(True)
@@ -112,35 +128,67 @@ class MPSlipMap():
 
     def add_object(self, obj):
         '''add or update an object on the map'''
-        self.object_queue.put(obj)
+        self.send(obj)
 
     def remove_object(self, key):
         '''remove an object on the map by key'''
-        self.object_queue.put(SlipRemoveObject(key))
+        self.send(SlipRemoveObject(key))
 
     def set_zoom(self, ground_width):
         '''set ground width of view'''
-        self.object_queue.put(SlipZoom(ground_width))
+        self.send(SlipZoom(ground_width))
 
     def set_center(self, lat, lon):
         '''set center of view'''
-        self.object_queue.put(SlipCenter((lat,lon)))
+        self.send(SlipCenter((lat,lon)))
 
     def set_follow(self, enable):
         '''set follow on/off'''
-        self.object_queue.put(SlipFollow(enable))
+        self.send(SlipFollow(enable))
+
+    def set_max_fps(self, max_fps):
+        '''set the maximum redraw rate'''
+        self.send(SlipFrameRate(max_fps))
 
     def set_follow_object(self, key, enable):
         '''set follow on/off on an object'''
-        self.object_queue.put(SlipFollowObject(key, enable))
+        self.send(SlipFollowObject(key, enable))
         
     def hide_object(self, key, hide=True):
         '''hide an object on the map by key'''
-        self.object_queue.put(SlipHideObject(key, hide))
+        self.send(SlipHideObject(key, hide))
 
     def set_position(self, key, latlon, layer='', rotation=0, label=None, colour=None):
         '''move an object on the map'''
-        self.object_queue.put(SlipPosition(key, latlon, layer, rotation, label, colour))
+        pos = SlipPosition(key, latlon, layer, rotation, label, colour)
+        old = self.pending_positions.get((pos.layer, key), None)
+        if old is not None:
+            # keep a label or colour change from an update we are dropping
+            if pos.label is None:
+                pos.label = old.label
+            if pos.colour is None:
+                pos.colour = old.colour
+        self.pending_positions[(pos.layer, key)] = pos
+        self.flush(force=False)
+
+    def flush(self, force=True):
+        '''send any pending object moves. If force is False they are only
+        sent once position_interval has passed since the last batch'''
+        if len(self.pending_positions) == 0:
+            return
+        now = time.time()
+        if not force and now - self.last_position_flush < self.position_interval:
+            return
+        self.last_position_flush = now
+        positions = list(self.pending_positions.values())
+        self.pending_positions = {}
+        self.object_queue.put(SlipPositionBatch(positions))
+
+    def send(self, obj):
+        '''send an object to the map, after any pending moves so that
+        changes arrive in the order they were made'''
+        self.flush()
+        self.object_queue.put(obj)
 
     def event_count(self):
         '''return number of events waiting to be processed'''
@@ -148,7 +196,7 @@ class MPSlipMap():
 
     def set_layout(self, layout):
         '''set window layout'''
-        self.object_queue.put(layout)
+        self.send(layout)
     
     def get_event(self):
         '''return next event or None'''
@@ -168,6 +216,7 @@ class MPSlipMap():
 
     def check_events(self):
         '''check for events, calling registered callbacks as needed'''
+        self.flush(force=False)
         while self.event_count() > 0:
             event = self.get_event()
             for callback in self._callbacks:
@@ -22,11 +22,13 @@ from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipMouseEvent
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipObjectSelection
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipPosition
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipPositionBatch
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipRemoveObject
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipThumbnail
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipZoom
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFollow
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFollowObject
+from MAVProxy.modules.mavproxy_map.mp_slipmap_util import SlipFrameRate
 
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import win_layout
@@ -39,6 +41,18 @@ from MAVProxy.modules.lib.mp_menu import MPMenuSubMenu
 from MAVProxy.modules.lib.mp_menu import MPMenuTop
 
 
+def index_remove(state, layer, key):
+    '''remove an object from the key index'''
+    layers = state.object_layers.get(key, None)
+    if layers is None:
+        return
+    if layer in layers:
+        layers.remove(layer)
+    if len(layers) == 0:
+        state.object_layers.pop(key)
+    state.dynamic_keys.discard((layer, key))
+
+
 class MPSlipMapFrame(wx.Frame):
     """ The main frame of the viewer
     """
@@ -137,16 +151,21 @@ class MPSlipMapFrame(wx.Frame):
                 state.brightness = -255
         state.need_redraw = True
 
-    def find_object(self, key, layers):
-        '''find an object to be modified'''
+    def find_object(self, key, layer):
+        '''find an object to be modified, using the key index'''
         state = self.state
 
-        if layers is None or layers == '':
-            layers = state.layers.keys()
-        for layer in layers:
-            if key in state.layers[layer]:
-                return state.layers[layer][key]
-        return None
+        if layer is None or layer == '':
+            layers = state.object_layers.get(key, None)
+            if not layers:
+                return None
+            layer = layers[0]
+        return state.layers.get(layer, {}).get(key, None)
+
+    def objects_with_key(self, key):
+        '''return all objects with a key, in any layer'''
+        state = self.state
+        return [state.layers[layer][key] for layer in state.object_layers.get(key, [])]
 
     def follow(self, object):
         '''follow an object on the map'''
@@ -174,14 +193,28 @@ class MPSlipMapFrame(wx.Frame):
                                                          checked=self.state.legend)
         ])
 
+    def object_changed(self, obj, dynamic=False):
+        '''note a change to an object. Objects which change after being
+        added are moved out of the cached static overlay'''
+        state = self.state
+        key = (obj.layer, obj.key)
+        if key not in state.dynamic_keys:
+            state.static_version += 1
+            if dynamic:
+                state.dynamic_keys.add(key)
+        state.need_redraw = True
+
     def add_object(self, obj):
         '''add an object to a layer'''
         state = self.state
         if not obj.layer in state.layers:
             # its a new layer
             state.layers[obj.layer] = {}
+        replaced = obj.key in state.layers[obj.layer]
         state.layers[obj.layer][obj.key] = obj
-        state.need_redraw = True
+        if not replaced:
+            state.object_layers.setdefault(obj.key, []).append(obj.layer)
+        self.object_changed(obj, dynamic=replaced)
         if (not self.legend_checkbox_menuitem_added and
             isinstance(obj, SlipFlightModeLegend)):
             self.add_legend_checkbox_menuitem()
@@ -191,10 +224,37 @@ class MPSlipMapFrame(wx.Frame):
     def remove_object(self, key):
         '''remove an object by key from all layers'''
         state = self.state
-        for layer in state.layers:
+        for layer in state.object_layers.pop(key, []):
             state.layers[layer].pop(key, None)
+            state.dynamic_keys.discard((layer, key))
+        state.static_version += 1
         state.need_redraw = True
 
+    def clear_layer(self, layer):
+        '''remove all objects from a layer'''
+        state = self.state
+        objects = state.layers.pop(layer, None)
+        if objects is None:
+            return
+        for key in objects:
+            index_remove(state, layer, key)
+        state.static_version += 1
+        state.need_redraw = True
+
+    def move_object(self, pos):
+        '''apply a SlipPosition to an existing object'''
+        object = self.find_object(pos.key, pos.layer)
+        if object is None:
+            return
+        object.update_position(pos)
+        if getattr(object, 'follow', False):
+            self.follow(object)
+        if pos.label is not None:
+            object.label = pos.label
+        if pos.colour is not None:
+            object.colour = pos.colour
+        self.object_changed(object, dynamic=True)
+
     def on_idle(self, event):
         '''prevent the main loop spinning too fast'''
         state = self.state
@@ -221,16 +281,12 @@ class MPSlipMapFrame(wx.Frame):
 
             if isinstance(obj, SlipPosition):
                 # move an object
-                object = self.find_object(obj.key, obj.layer)
-                if object is not None:
-                    object.update_position(obj)
-                    if getattr(object, 'follow', False):
-                        self.follow(object)
-                    if obj.label is not None:
-                        object.label = obj.label
-                    if obj.colour is not None:
-                        object.colour = obj.colour
-                    state.need_redraw = True
+                self.move_object(obj)
+
+            if isinstance(obj, SlipPositionBatch):
+                # move a set of objects
+                for pos in obj.positions:
+                    self.move_object(pos)
 
             if isinstance(obj, SlipDefaultPopup):
                 state.default_popup = obj
@@ -262,34 +318,33 @@ class MPSlipMapFrame(wx.Frame):
 
             if isinstance(obj, SlipFollowObject):
                 # enable/disable follow on an object
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        if hasattr(state.layers[layer][obj.key], 'follow'):
-                            state.layers[layer][obj.key].follow = obj.enable
+                for object in self.objects_with_key(obj.key):
+                    if hasattr(object, 'follow'):
+                        object.follow = obj.enable
                 
             if isinstance(obj, SlipBrightness):
                 # set map brightness
                 state.brightness = obj.brightness
                 state.need_redraw = True
 
+            if isinstance(obj, SlipFrameRate):
+                # set maximum redraw rate
+                state.max_fps = obj.max_fps
+                state.panel.start_redraw_timer()
+
             if isinstance(obj, SlipClearLayer):
                 # remove all objects from a layer
-                if obj.layer in state.layers:
-                    state.layers.pop(obj.layer)
-                state.need_redraw = True
+                self.clear_layer(obj.layer)
 
             if isinstance(obj, SlipRemoveObject):
                 # remove an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer].pop(obj.key)
-                state.need_redraw = True
+                self.remove_object(obj.key)
 
             if isinstance(obj, SlipHideObject):
                 # hide an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer][obj.key].set_hidden(obj.hide)
+                for object in self.objects_with_key(obj.key):
+                    object.set_hidden(obj.hide)
+                state.static_version += 1
                 state.need_redraw = True
 
         if obj is None:
@@ -306,10 +361,13 @@ class MPSlipMapPanel(wx.Panel):
         self.state = state
         self.img = None
         self.map_img = None
+        self.static_img = None
+        self.static_key = None
+        self.last_frame_time = 0
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)
         self.Bind(wx.EVT_SET_FOCUS, self.on_focus)
-        self.redraw_timer.Start(200)
+        self.start_redraw_timer()
         self.mouse_pos = None
         self.mouse_down = None
         self.click_pos = None
@@ -363,11 +421,21 @@ class MPSlipMapPanel(wx.Panel):
         '''called when the panel gets focus'''
         self.imagePanel.SetFocus()
 
+    def frame_interval(self):
+        '''minimum time between redraws of the overlays'''
+        return 1.0 / max(self.state.max_fps, 0.1)
+
+    def start_redraw_timer(self):
+        '''(re)start the redraw timer at the maximum frame rate'''
+        self.redraw_timer.Start(int(1000 * self.frame_interval()))
+
     def current_view(self):
-        '''return a tuple representing the current view'''
+        '''return a tuple representing the current view. The tile mosaic
+        is only rebuilt when this changes'''
         state = self.state
         return (state.lat, state.lon, state.width, state.height,
-                state.ground_width, state.mt.tiles_pending())
+                state.ground_width, state.mt.tiles_pending(),
+                state.brightness, state.mt.get_service())
 
     def coordinates(self, x, y):
         '''return coordinates of a pixel in the map'''
@@ -466,11 +534,15 @@ class MPSlipMapPanel(wx.Panel):
         (lat,lon) = (latlon[0], latlon[1])
         return state.mt.coord_to_pixel(state.lat, state.lon, state.width, state.ground_width, lat, lon)
 
-    def draw_objects(self, objects, bounds, img):
-        '''draw objects on the image'''
+    def draw_objects(self, objects, bounds, img, dynamic=None):
+        '''draw objects on the image. If dynamic is True or False only
+        draw the dynamic or static objects'''
+        state = self.state
         keys = sorted(objects.keys())
         for k in keys:
             obj = objects[k]
+            if dynamic is not None and ((obj.layer, k) in state.dynamic_keys) != dynamic:
+                continue
             if not self.state.legend and isinstance(obj, SlipFlightModeLegend):
                 continue
             bounds2 = obj.bounds()
@@ -478,40 +550,63 @@ class MPSlipMapPanel(wx.Panel):
                 obj.draw(img, self.pixmapper, bounds)
 
     def redraw_map(self):
-        '''redraw the map with current settings'''
+        '''redraw the map with current settings. The map is drawn in three
+        stages, each cached until something it depends on changes: the
+        tile mosaic, the static overlay (grid and objects which don't
+        move) and the dynamic objects, which are drawn each frame'''
         state = self.state
 
-        view_same = (self.last_view is not None and self.map_img is not None and self.last_view == self.current_view())
+        view = self.current_view()
+        view_same = (self.last_view is not None and self.map_img is not None and self.last_view == view)
 
         if view_same and not state.need_redraw:
             return
 
-        # get the new map
-        self.map_img = state.mt.area_to_image(state.lat, state.lon,
-                                              state.width, state.height, state.ground_width)
-        if state.brightness != 0: # valid state.brightness range is [-255, 255]
-            brightness = np.uint8(np.abs(state.brightness))
-            if state.brightness > 0:
-                self.map_img = np.where((255 - self.map_img) < brightness, 255, self.map_img + brightness)
-            else:
-                self.map_img = np.where((255 + self.map_img) < brightness, 0, self.map_img - brightness)
-            
+        now = time.time()
+        if view_same and now - self.last_frame_time < self.frame_interval():
+            # only objects have changed, leave it for the redraw timer
+            return
+        self.last_frame_time = now
+
+        if not view_same:
+            # get the new map
+            self.map_img = state.mt.area_to_image(state.lat, state.lon,
+                                                  state.width, state.height, state.ground_width)
+            if state.brightness != 0: # valid state.brightness range is [-255, 255]
+                brightness = np.uint8(np.abs(state.brightness))
+                if state.brightness > 0:
+                    self.map_img = np.where((255 - self.map_img) < brightness, 255, self.map_img + brightness)
+                else:
+                    self.map_img = np.where((255 + self.map_img) < brightness, 0, self.map_img - brightness)
+            self.static_img = None
+
         # find display bounding box
         (lat2,lon2) = self.coordinates(state.width-1, state.height-1)
         bounds = (lat2, state.lon, state.lat-lat2, lon2-state.lon)
 
-        # get the image
-        img = self.map_img.copy()
-
-        # possibly draw a grid
-        if state.grid:
-            SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(img, self.pixmapper, bounds)
-
-        # draw layer objects
         keys = state.layers.keys()
         keys = sorted(list(keys))
+
+        static_key = (state.static_version, state.grid, state.legend)
+        if self.static_img is None or self.static_key != static_key:
+            img = self.map_img.copy()
+
+            # possibly draw a grid
+            if state.grid:
+                SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(img, self.pixmapper, bounds)
+
+            # draw static layer objects
+            for k in keys:
+                self.draw_objects(state.layers[k], bounds, img, dynamic=False)
+            self.static_img = img
+            self.static_key = static_key
+
+        # get the image
+        img = self.static_img.copy()
+
+        # draw dynamic layer objects
         for k in keys:
-            self.draw_objects(state.layers[k], bounds, img)
+            self.draw_objects(state.layers[k], bounds, img, dynamic=True)
 
         # draw information objects
         for key in state.info:
@@ -524,7 +619,7 @@ class MPSlipMapPanel(wx.Panel):
 
         self.mainSizer.Fit(self)
         self.Refresh()
-        self.last_view = self.current_view()
+        self.last_view = view
         self.SetFocus()
         state.need_redraw = False
 
@@ -656,6 +751,8 @@ class MPSlipMapPanel(wx.Panel):
                 if (isinstance(state.layers[l][key], SlipThumbnail)
                     and not isinstance(state.layers[l][key], SlipIcon)):
                     state.layers[l].pop(key)
+                    index_remove(state, l, key)
+        state.static_version += 1
 
     def on_key_down(self, event):
         '''handle keyboard input'''
@@ -508,6 +508,11 @@ class SlipPosition:
         self.label = label
         self.colour = colour
 
+class SlipPositionBatch:
+    '''a list of SlipPosition objects, sent as one message'''
+    def __init__(self, positions):
+        self.positions = positions
+
 class SlipCenter:
     '''an object to move the view center'''
     def __init__(self, latlon):
@@ -534,6 +539,11 @@ class SlipBrightness:
     def __init__(self, brightness):
         self.brightness = brightness
 
+class SlipFrameRate:
+    '''an object to change the maximum map redraw rate'''
+    def __init__(self, max_fps):
+        self.max_fps = max_fps
+
 class SlipClearLayer:
     '''remove all objects in a layer'''
     def __init__(self, layer):
@@ -9,9 +9,11 @@ May 2012
 released under GNU GPL v3 or later
 '''
 
+import base64
 import collections
 import errno
 import hashlib
+import heapq
 import sys
 import math
 import threading
@@ -22,13 +24,13 @@ import cv2
 import numpy as np
 
 if sys.version_info.major < 3:
-    from urllib2 import Request as url_request
-    from urllib2 import urlopen as url_open
-    from urllib2 import URLError as url_error
+    import httplib as http_client
+    from urlparse import urlsplit, urljoin
+    from urllib import getproxies, proxy_bypass, unquote
 else:
-    from urllib.request import Request as url_request
-    from urllib.request import urlopen as url_open
-    from urllib.error import URLError as url_error
+    import http.client as http_client
+    from urllib.parse import urlsplit, urljoin, unquote
+    from urllib.request import getproxies, proxy_bypass
 
 from MAVProxy.modules.lib import mp_util
 
@@ -162,11 +164,146 @@ class TileInfoScaled(TileInfo):
 
 
 
+class TileCache:
+    '''LRU cache of tile images with a memory budget in bytes. This
+    is used from both the map and downloader threads'''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        try:
+            self.cache = collections.OrderedDict()
+        except AttributeError:
+            # OrderedDicts in python 2.6 come from the ordereddict module
+            # which is a 3rd party package, not in python2.6 distribution
+            import ordereddict
+            self.cache = ordereddict.OrderedDict()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def get(self, key):
+        '''return a cached image, marking it as recently used, or None'''
+        with self.lock:
+            entry = self.cache.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.cache[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, img, size=None):
+        '''add an image to the cache, evicting the least recently used
+        images if over budget. Shared images should be added with size 0'''
+        if size is None:
+            size = img.nbytes
+        with self.lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self.cache[key] = (img, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes and len(self.cache) > 1:
+                (k, (oimg, osize)) = self.cache.popitem(False)
+                self.nbytes -= osize
+
+    def put_missing(self, key, img, size=None):
+        '''add an image to the cache unless the key is already present'''
+        if key not in self.cache:
+            self.put(key, img, size)
+
+    def stats_string(self):
+        return "%u tiles %.1f/%.1f MB hits=%u misses=%u" % (
+            len(self.cache), self.nbytes/(1024.0*1024), self.max_bytes/(1024.0*1024),
+            self.hits, self.misses)
+
+
+class TileConnections:
+    '''keep-alive HTTP connections for one download thread, one per
+    host. The http_proxy and https_proxy environment variables are
+    honoured as they are by urllib'''
+    def __init__(self, timeout=20):
+        self.timeout = timeout
+        self.conns = {}
+        self.proxies = getproxies()
+
+    def close(self):
+        for (conn, proxy_headers) in self.conns.values():
+            conn.close()
+        self.conns = {}
+
+    def connect(self, scheme, netloc):
+        '''make a connection to a host, returning (connection,
+        proxy_headers). proxy_headers is None unless requests go to an
+        http proxy, which needs the full URL in the request'''
+        proxy = self.proxies.get(scheme, None)
+        if proxy is not None and proxy_bypass(urlsplit('//' + netloc).hostname or netloc):
+            proxy = None
+        if proxy is None:
+            if scheme == 'https':
+                return (http_client.HTTPSConnection(netloc, timeout=self.timeout), None)
+            return (http_client.HTTPConnection(netloc, timeout=self.timeout), None)
+        if proxy.find('://') == -1:
+            proxy = 'http://' + proxy
+        p = urlsplit(proxy)
+        proxy_headers = {}
+        if p.username is not None:
+            auth = '%s:%s' % (unquote(p.username), unquote(p.password or ''))
+            proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(auth.encode('utf-8')).decode('ascii')
+        port = p.port or 80
+        if scheme == 'https':
+            # tunnel through the proxy with CONNECT
+            conn = http_client.HTTPSConnection(p.hostname, port, timeout=self.timeout)
+            conn.set_tunnel(netloc, headers=proxy_headers)
+            return (conn, None)
+        return (http_client.HTTPConnection(p.hostname, port, timeout=self.timeout), proxy_headers)
+
+    def fetch(self, url, headers, redirects=3):
+        '''fetch a URL, returning (status, content_type, body)'''
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        key = (parts.scheme, parts.netloc)
+        for attempt in range(2):
+            if key not in self.conns:
+                self.conns[key] = self.connect(parts.scheme, parts.netloc)
+            (conn, proxy_headers) = self.conns[key]
+            try:
+                if proxy_headers is None:
+                    conn.request('GET', path, headers=headers)
+                else:
+                    h = dict(headers)
+                    h.update(proxy_headers)
+                    conn.request('GET', '%s://%s%s' % (parts.scheme, parts.netloc, path), headers=h)
+                resp = conn.getresponse()
+                body = resp.read()
+                break
+            except Exception:
+                # the server may have closed an idle connection, retry
+                # once on a new connection
+                conn.close()
+                self.conns.pop(key, None)
+                if attempt == 1:
+                    raise
+        location = resp.getheader('location', None)
+        if resp.status in [301, 302, 303, 307, 308] and location is not None and redirects > 0:
+            return self.fetch(urljoin(url, location), headers, redirects-1)
+        return (resp.status, resp.getheader('content-type', ''), body)
+
+
 class MPTile:
     '''map tile object'''
     def __init__(self, cache_path=None, download=True, cache_size=500,
              service="MicrosoftSat", tile_delay=0.3, debug=False,
-             max_zoom=19, refresh_age=30*24*60*60):
+             max_zoom=19, refresh_age=30*24*60*60, cache_bytes=None,
+             download_threads=2):
 
         if cache_path is None:
             try:
@@ -187,22 +324,38 @@ class MPTile:
         self.service = service
         self.debug = debug
         self.refresh_age = refresh_age
+        self.download_threads = download_threads
 
         if service not in TILE_SERVICES:
             raise TileException('unknown tile service %s' % service)
 
-        # _download_pending is a dictionary of TileInfo objects
+        # _download_pending is a dictionary of TileInfo objects. The
+        # download queue is a heap of (priority, key) with _queued
+        # holding the current priority of each queued key
         self._download_pending = {}
-        self._download_thread = None
+        self._download_lock = threading.Condition()
+        self._download_queue = []
+        self._queued = {}
+        self._download_active = set()
+        self._download_workers = 0
+        # time each host may next be sent a request, shared by the
+        # download threads so tile_delay limits the overall rate
+        self._host_lock = threading.Lock()
+        self._host_next = {}
+        self._view_centre = None
+        self._view_keys = set()
+        self._view_time = 0
         self._loading = mp_icon('loading.jpg')
         self._unavailable = mp_icon('unavailable.jpg')
-        try:
-            self._tile_cache = collections.OrderedDict()
-        except AttributeError:
-            # OrderedDicts in python 2.6 come from the ordereddict module
-            # which is a 3rd party package, not in python2.6 distribution
-            import ordereddict
-            self._tile_cache = ordereddict.OrderedDict()
+        # the cache holds decoded tiles plus scaled and low resolution
+        # tiles derived from them. By default the budget is the same
+        # memory as cache_size full tiles
+        if cache_bytes is None:
+            cache_bytes = cache_size * TILES_WIDTH * TILES_HEIGHT * 3
+        self._tile_cache = TileCache(cache_bytes)
+        # bumped whenever a tile is downloaded, so cached low resolution
+        # fill-ins are rebuilt from any better tiles now available
+        self._lowres_generation = 0
 
     def set_service(self, service):
         '''set tile service'''
@@ -247,79 +400,168 @@ class MPTile:
         '''return number of tiles pending download'''
         return len(self._download_pending)
 
-    def downloader(self):
-        '''the download thread'''
-        while self.tiles_pending() > 0:
-            time.sleep(self.tile_delay)
-
-            keys = sorted(self._download_pending.keys())
-
-            # work out which one to download next, choosing by request_time
-            tile_info = self._download_pending[keys[0]]
-            for key in keys:
-                if self._download_pending[key].request_time > tile_info.request_time:
-                    tile_info = self._download_pending[key]
+    def download_priority(self, tile):
+        '''priority for downloading a tile, lowest first. Tiles requested
+        for the current view come first, nearest the view centre first,
+        then any others, most recently requested first'''
+        if self._view_centre is not None and tile.request_time >= self._view_time:
+            (lat, lon) = self._view_centre
+            return (0, tile.distance(lat, lon))
+        return (1, -tile.request_time)
+
+    def _queue_tile(self, tile):
+        '''add a pending tile to the download queue, with the lock held'''
+        key = tile.key()
+        priority = self.download_priority(tile)
+        if self._queued.get(key, None) == priority:
+            return
+        self._queued[key] = priority
+        heapq.heappush(self._download_queue, (priority, key))
 
-            url = tile_info.url(self.service)
-            path = self.tile_to_path(tile_info)
-            key = tile_info.key()
+    def queue_download(self, tile):
+        '''request download of a tile, or refresh an existing request'''
+        key = tile.key()
+        with self._download_lock:
+            pending = self._download_pending.get(key, None)
+            if pending is None:
+                self._download_pending[key] = tile
+                pending = tile
+            pending.refresh_time()
+            if key not in self._download_active:
+                self._queue_tile(pending)
+                self._download_lock.notify()
+        self.start_download_thread()
 
-            try:
-                if self.debug:
-                    print("Downloading %s [%u left]" % (url, len(keys)))
-                req = url_request(url)
-                if url.find('google') != -1:
-                    req.add_header('Referer', 'https://maps.google.com/')
-                resp = url_open(req)
-                headers = resp.info()
-            except url_error as e:
-                #print('Error loading %s' % url)
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("Failed %s: %s" % (url, str(e)))
+    def set_view(self, lat, lon, keys):
+        '''set the centre and the tile keys of the current view. Pending
+        downloads of tiles which have left the view are cancelled'''
+        keys = set(keys)
+        with self._download_lock:
+            if self._view_centre == (lat, lon) and self._view_keys == keys:
+                return
+            self._view_centre = (lat, lon)
+            self._view_keys = keys
+            self._view_time = time.time()
+            for key in list(self._download_pending.keys()):
+                if key not in keys and key not in self._download_active:
+                    if self.debug:
+                        print("Cancelled download of %s" % str(key))
+                    self._download_pending.pop(key)
+            # re-prioritise what is left for the new view centre
+            self._download_queue = []
+            self._queued = {}
+            for (key, tile) in self._download_pending.items():
+                if key not in self._download_active:
+                    self._queue_tile(tile)
+
+    def _next_download(self):
+        '''pop the best tile to download from the queue, with the lock held'''
+        while len(self._download_queue) > 0:
+            (priority, key) = heapq.heappop(self._download_queue)
+            if self._queued.get(key, None) != priority:
+                # stale entry, the tile was re-queued with a new priority
                 continue
-            if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-                if not key in self._tile_cache:
-                    self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                if self.debug:
-                    print("non-image response %s" % url)
+            self._queued.pop(key)
+            tile = self._download_pending.get(key, None)
+            if tile is None or key in self._download_active:
                 continue
-            else:
-                img = resp.read()
+            self._download_active.add(key)
+            return tile
+        return None
 
-            # see if its a blank/unavailable tile
-            md5 = hashlib.md5(img).hexdigest()
-            if md5 in BLANK_TILES:
+    def downloader(self):
+        '''a download thread. Several of these run at once, each with
+        its own keep-alive connections'''
+        conns = TileConnections()
+        while True:
+            with self._download_lock:
+                tile = self._next_download()
+                if tile is None:
+                    self._download_lock.wait(5)
+                    tile = self._next_download()
+                if tile is None:
+                    self._download_workers -= 1
+                    break
+            key = tile.key()
+            try:
+                self.download_tile(tile, conns)
+            except Exception as e:
                 if self.debug:
-                    print("blank tile %s" % url)
-                    if not key in self._tile_cache:
-                        self._tile_cache[key] = self._unavailable
-                self._download_pending.pop(key)
-                continue
+                    print("Failed %s: %s" % (str(key), str(e)))
+                self._tile_cache.put_missing(key, self._unavailable, 0)
+            with self._download_lock:
+                self._download_active.discard(key)
+                self._download_pending.pop(key, None)
+                self._queued.pop(key, None)
+        conns.close()
+
+    def _wait_for_host(self, url):
+        '''wait until a request can be sent to the host of url, keeping
+        requests to each host at least tile_delay apart'''
+        if self.tile_delay <= 0:
+            return
+        host = urlsplit(url).netloc
+        with self._host_lock:
+            now = time.time()
+            t = max(now, self._host_next.get(host, 0))
+            self._host_next[host] = t + self.tile_delay
+        if t > now:
+            time.sleep(t - now)
+
+    def download_tile(self, tile_info, conns):
+        '''download one tile into the tile directory'''
+        url = tile_info.url(self.service)
+        path = self.tile_to_path(tile_info)
+        key = tile_info.key()
+
+        if self.debug:
+            print("Downloading %s [%u left]" % (url, self.tiles_pending()))
+        headers = { 'User-Agent' : 'MAVProxy' }
+        if url.find('google') != -1:
+            headers['Referer'] = 'https://maps.google.com/'
+        self._wait_for_host(url)
+        (status, content_type, img) = conns.fetch(url, headers)
+        if status != 200:
+            self._tile_cache.put_missing(key, self._unavailable, 0)
+            if self.debug:
+                print("Failed %s: HTTP status %u" % (url, status))
+            return
+        if content_type.find('image') == -1:
+            self._tile_cache.put_missing(key, self._unavailable, 0)
+            if self.debug:
+                print("non-image response %s" % url)
+            return
 
-            mp_util.mkdir_p(os.path.dirname(path))
-            h = open(path+'.tmp','wb')
-            h.write(img)
-            h.close()
-            try:
-                os.unlink(path)
-            except Exception:
-                pass
-            os.rename(path+'.tmp', path)
-            self._download_pending.pop(key)
-        self._download_thread = None
+        # see if its a blank/unavailable tile
+        md5 = hashlib.md5(img).hexdigest()
+        if md5 in BLANK_TILES:
+            if self.debug:
+                print("blank tile %s" % url)
+            self._tile_cache.put_missing(key, self._unavailable, 0)
+            return
+
+        mp_util.mkdir_p(os.path.dirname(path))
+        h = open(path+'.tmp','wb')
+        h.write(img)
+        h.close()
+        try:
+            os.unlink(path)
+        except Exception:
+            pass
+        os.rename(path+'.tmp', path)
+        self._lowres_generation += 1
 
     def start_download_thread(self):
-        '''start the downloader'''
-        if self._download_thread:
-            return
-        t = threading.Thread(target=self.downloader)
-        t.daemon = True
-        self._download_thread = t
-        t.start()
+        '''start download threads, up to download_threads'''
+        with self._download_lock:
+            n = min(self.download_threads, len(self._download_pending)) - self._download_workers
+            if n <= 0:
+                return
+            self._download_workers += n
+        for i in range(n):
+            t = threading.Thread(target=self.downloader, name='tile_download')
+            t.daemon = True
+            t.start()
 
     def load_tile_lowres(self, tile):
         '''load a lower resolution tile from cache to fill in a
@@ -327,6 +569,11 @@ class MPTile:
         if tile.zoom == self.min_zoom:
             return None
 
+        lowres_key = ('lowres', tile.key(), self._lowres_generation)
+        scaled = self._tile_cache.get(lowres_key)
+        if scaled is not None:
+            return scaled
+
         # find the equivalent lower res tile
         (lat,lon) = tile.coord()
 
@@ -344,19 +591,16 @@ class MPTile:
 
             # see if its in the tile cache
             key = tile_info.key()
-            if key in self._tile_cache:
-                img = self._tile_cache[key]
-                if np.array_equal(img, np.array(self._unavailable)):
-                    continue
-            else:
+            img = self._tile_cache.get(key)
+            if img is self._unavailable:
+                continue
+            if img is None:
                 path = self.tile_to_path(tile_info)
                 img = cv2.imread(path)
                 if img is None:
                     continue
                 # add it to the tile cache
-                self._tile_cache[key] = img
-                while len(self._tile_cache) > self.cache_size:
-                    self._tile_cache.popitem(0)
+                self._tile_cache.put(key, img)
 
             # copy out the quadrant we want
             availx = min(TILES_WIDTH - tile_info.offsetx, width2)
@@ -368,6 +612,7 @@ class MPTile:
             # and scale it
             scaled = cv2.resize(roi, (TILES_HEIGHT,TILES_WIDTH))
             #cv.Rectangle(scaled, (0,0), (255,255), (0,255,0), 1)
+            self._tile_cache.put(lowres_key, scaled)
             return scaled
         return None
 
@@ -376,9 +621,9 @@ class MPTile:
 
         # see if its in the tile cache
         key = tile.key()
-        if key in self._tile_cache:
-            img = self._tile_cache[key]
-            if np.array_equal(img, self._unavailable):
+        img = self._tile_cache.get(key)
+        if img is not None:
+            if img is self._unavailable:
                 img = self.load_tile_lowres(tile)
                 if img is None:
                     img = self._unavailable
@@ -390,16 +635,10 @@ class MPTile:
         if ret is not None:
             # if it is an old tile, then try to refresh
             if os.path.getmtime(path) + self.refresh_age < time.time():
-                try:
-                        self._download_pending[key].refresh_time()
-                except Exception:
-                        self._download_pending[key] = tile
-                self.start_download_thread()
-                    
+                self.queue_download(tile)
+
             # add it to the tile cache
-            self._tile_cache[key] = ret
-            while len(self._tile_cache) > self.cache_size:
-                self._tile_cache.popitem(0)
+            self._tile_cache.put(key, ret)
             return ret
 
         if not self.download:
@@ -408,11 +647,7 @@ class MPTile:
                 img = self._unavailable
             return img
 
-        try:
-            self._download_pending[key].refresh_time()
-        except Exception:
-            self._download_pending[key] = tile
-        self.start_download_thread()
+        self.queue_download(tile)
 
         img = self.load_tile_lowres(tile)
         if img is None:
@@ -424,8 +659,16 @@ class MPTile:
         '''return a scaled tile'''
         width = int(TILES_WIDTH / tile.scale)
         height = int(TILES_HEIGHT / tile.scale)
+        scaled_key = ('scaled', tile.key(), width, height)
+        scaled_tile = self._tile_cache.get(scaled_key)
+        if scaled_tile is not None:
+            return scaled_tile
         full_tile = self.load_tile(tile)
         scaled_tile = cv2.resize(full_tile, (height, width))
+        # only keep scaled copies of real tiles, not of placeholders
+        # which will be replaced when the download completes
+        if full_tile is not self._unavailable and full_tile is self._tile_cache.get(tile.key()):
+            self._tile_cache.put(scaled_key, scaled_tile)
         return scaled_tile
 
 
@@ -527,10 +770,13 @@ class MPTile:
 
         tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
 
-        # order the display by distance from the middle, so the download happens
-        # close to the middle of the image first
+        # downloads are prioritised by distance from the middle, and
+        # cancelled for tiles no longer in view
+        (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+        self.set_view(midlat, midlon, [t.key() for t in tlist])
+
+        # order the display by distance from the middle
         if ordered:
-            (midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
             tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
 
         for t in tlist:
@@ -580,6 +826,8 @@ if __name__ == "__main__":
     parser.add_option("--zoom", default=None, type='int', help="zoom level")
     parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
     parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
+    parser.add_option("--threads", type='int', default=2, help="number of download threads")
+    parser.add_option("--url", default=None, help="custom tile URL template, eg. http://localhost:8000/${ZOOM}/${X}/${Y}.png")
     parser.add_option("--boundary", default=None, help="region boundary")
     parser.add_option("--debug", action='store_true', default=False, help="show debug info")
     (opts, args) = parser.parse_args()
@@ -597,8 +845,13 @@ if __name__ == "__main__":
                    mp_util.gps_distance(lat, lon, lat-bounds[2], lon))
         print(lat, lon, ground_width)
 
+    if opts.url is not None:
+        TILE_SERVICES['Custom'] = opts.url
+        opts.service = 'Custom'
+
     mt = MPTile(debug=opts.debug, service=opts.service,
-            tile_delay=opts.delay, max_zoom=opts.max_zoom)
+            tile_delay=opts.delay, max_zoom=opts.max_zoom,
+            download_threads=opts.threads)
     if opts.zoom is None:
         zooms = range(mt.min_zoom, mt.max_zoom+1)
     else:
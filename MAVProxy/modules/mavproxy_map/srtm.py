@@ -21,6 +21,9 @@ import os
 import zipfile
 import array
 import math
+import mmap
+import collections
+import numpy
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 import tempfile
@@ -63,13 +66,43 @@ class InvalidTileError(Exception):
     def __str__(self):
         return "SRTM tile for %d, %d is invalid!" % (self.lat, self.lon)
 
+class SRTMTileCache():
+    """LRU cache of open tiles, keyed by (lat, lon). Evicted tiles are
+        unmapped once nothing else references them."""
+    def __init__(self, max_tiles=16):
+        self.max_tiles = max_tiles
+        self.tiles = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+    def __getitem__(self, key):
+        tile = self.tiles.pop(key)
+        self.tiles[key] = tile
+        return tile
+
+    def __setitem__(self, key, tile):
+        self.tiles.pop(key, None)
+        self.tiles[key] = tile
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(False)
+
+    def get(self, key, default=None):
+        if key not in self.tiles:
+            return default
+        return self[key]
+
 class SRTMDownloader():
     """Automatically download SRTM tiles."""
     def __init__(self, server="firmware.ardupilot.org",
                  directory="/SRTM/",
                  cachedir=None,
                  offline=0,
-                 debug=False):
+                 debug=False,
+                 max_tiles=16):
 
         if cachedir is None:
             try:
@@ -95,6 +128,7 @@ class SRTMDownloader():
                 r"([NS])(\d{2})([EW])(\d{3})\.hgt\.zip")
         self.filelist_file = os.path.join(self.cachedir, "filelist_python")
         self.min_filelist_len = 14500
+        self.tiles = SRTMTileCache(max_tiles)
 
     def loadFileList(self):
         """Load a previously created file list or create a new one if none is
@@ -272,12 +306,16 @@ class SRTMDownloader():
         elif mypid in childTileDownload and childTileDownload[mypid].is_alive():
             '''print("Still Getting Tile")'''
             return 0
-        # TODO: Currently we create a new tile object each time.
-        # Caching is required for improved performance.
+        key = (int(lat), int(lon))
+        tile = self.tiles.get(key)
+        if tile is not None:
+            return tile
         try:
-            return SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
+            tile = SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
         except InvalidTileError:
             return 0
+        self.tiles[key] = tile
+        return tile
 
     def downloadTile(self, continent, filename):
         #Use HTTP
@@ -300,6 +338,47 @@ class SRTMDownloader():
             pass
 
 
+def rawTilePath(f):
+    """Path of the decompressed, native endian copy of a zipped tile."""
+    if f.endswith('.zip'):
+        f = f[:-4]
+    return "%s.%s.raw" % (f, sys.byteorder)
+
+def decompressTile(f, lat, lon):
+    """Unzip a tile into a native endian raw file next to the zip file,
+        returning the raw file path. The file is written under a temporary
+        name then renamed, so other processes never see a partial tile."""
+    try:
+        zipf = zipfile.ZipFile(f, 'r')
+    except Exception:
+        raise InvalidTileError(lat, lon)
+    names = zipf.namelist()
+    if len(names) != 1:
+        raise InvalidTileError(lat, lon)
+    data = zipf.read(names[0])
+    zipf.close()
+    size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
+    # Currently only SRTM1/3 is supported
+    if size not in (1201, 3601) or len(data) != size * size * 2:
+        raise InvalidTileError(lat, lon)
+    samples = array.array('h', data)
+    if sys.byteorder == 'little':
+        samples.byteswap()
+    raw = rawTilePath(f)
+    tmpname = "%s.%u.tmp" % (raw, os.getpid())
+    with open(tmpname, 'wb') as output:
+        output.write(samples.tostring() if sys.version_info.major < 3 else samples.tobytes())
+    try:
+        os.rename(tmpname, raw)
+    except OSError:
+        # windows can't rename over an existing file
+        try:
+            os.unlink(raw)
+        except OSError:
+            pass
+        os.rename(tmpname, raw)
+    return raw
+
 class SRTMTile:
     """Base class for all SRTM tiles.
         Each SRTM tile is size x size pixels big and contains
@@ -307,24 +386,29 @@ class SRTMTile:
         This means there is a 1 pixel overlap between tiles. This makes it
         easier for as to interpolate the value, because for every point we
         only have to look at a single tile.
+
+        The zipped tile is decompressed once into a raw file in the cache
+        directory, which is memory mapped read-only, so all processes
+        share the same pages.
         """
     def __init__(self, f, lat, lon):
+        raw = rawTilePath(f)
         try:
-            zipf = zipfile.ZipFile(f, 'r')
-        except Exception:
-            raise InvalidTileError(lat, lon)
-        names = zipf.namelist()
-        if len(names) != 1:
+            fresh = os.path.getmtime(raw) >= os.path.getmtime(f)
+        except OSError:
+            fresh = False
+        if not fresh:
+            decompressTile(f, lat, lon)
+        try:
+            with open(raw, 'rb') as rawfile:
+                self.mm = mmap.mmap(rawfile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
             raise InvalidTileError(lat, lon)
-        data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
+        self.size = int(math.sqrt(len(self.mm)/2)) # 2 bytes per sample
         # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
+        if self.size not in (1201, 3601) or len(self.mm) != self.size * self.size * 2:
             raise InvalidTileError(lat, lon)
+        self.data = numpy.frombuffer(self.mm, dtype=numpy.int16)
         self.lat = lat
         self.lon = lon
 
@@ -368,7 +452,7 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print(offset)
-        value = self.data[offset]
+        value = int(self.data[offset])
         if value == -32768:
             return -1 # -32768 is a special value for areas with no data
         return value
@@ -403,6 +487,37 @@ class SRTMTile:
         #        value00, value10, value1, value01, value11, value2, value))
         return value
 
+    def getPixelArray(self, x, y):
+        """Get pixel values for integer arrays of x and y, handling voids
+            like getPixelValue."""
+        value = self.data[x + self.size * (self.size - y - 1)].astype(numpy.float64)
+        value[value == -32768] = -1
+        return value
+
+    def getAltitudeArray(self, lat, lon):
+        """Get the altitudes of arrays of lat and lon, all inside this tile,
+            with the same interpolation as getAltitudeFromLatLon.
+        """
+        lat = numpy.asarray(lat, dtype=numpy.float64) - self.lat
+        lon = numpy.asarray(lon, dtype=numpy.float64) - self.lon
+        bad = (lat < 0.0) | (lat >= 1.0) | (lon < 0.0) | (lon >= 1.0)
+        if numpy.any(bad):
+            i = numpy.argmax(bad)
+            raise WrongTileError(self.lat, self.lon, self.lat+lat.flat[i], self.lon+lon.flat[i])
+        x = lon * (self.size - 1)
+        y = lat * (self.size - 1)
+        x_int = x.astype(numpy.intp)
+        x_frac = x - x_int
+        y_int = y.astype(numpy.intp)
+        y_frac = y - y_int
+        value00 = self.getPixelArray(x_int, y_int)
+        value10 = self.getPixelArray(x_int+1, y_int)
+        value01 = self.getPixelArray(x_int, y_int+1)
+        value11 = self.getPixelArray(x_int+1, y_int+1)
+        value1 = value10 * x_frac + value00 * (1 - x_frac)
+        value2 = value11 * x_frac + value01 * (1 - x_frac)
+        return value2 * y_frac + value1 * (1 - y_frac)
+
 class SRTMOceanTile(SRTMTile):
     '''a tile for areas of zero altitude'''
     def __init__(self, lat, lon):
@@ -412,6 +527,9 @@ class SRTMOceanTile(SRTMTile):
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeArray(self, lat, lon):
+        return numpy.zeros(numpy.shape(lat))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
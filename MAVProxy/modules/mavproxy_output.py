@@ -45,12 +45,20 @@ class OutputModule(mp_module.MPModule):
         print("%u outputs" % len(self.mpstate.mav_outputs))
         for i in range(len(self.mpstate.mav_outputs)):
             conn = self.mpstate.mav_outputs[i]
-            print("%u: %s" % (i, conn.address))
+            print("%u: %s%s" % (i, conn.address, self.queue_string(conn)))
         if len(self.mpstate.sysid_outputs) > 0:
             print("%u sysid outputs" % len(self.mpstate.sysid_outputs))
             for sysid in self.mpstate.sysid_outputs:
                 conn = self.mpstate.sysid_outputs[sysid]
-                print("%u: %s" % (sysid, conn.address))
+                print("%u: %s%s" % (sysid, conn.address, self.queue_string(conn)))
+
+    def queue_string(self, conn):
+        '''return forwarding queue statistics for an output'''
+        q = self.mpstate.fanout.stats(conn)
+        if q is None:
+            return ""
+        return " (queued %u max %u, %u packets in %u writes, %u dropped, %u errors)" % (
+            q.depth(), q.high_water, q.packets, q.writes, q.drops, q.errors)
 
     def cmd_output_add(self, args):
         '''add new output'''
@@ -63,6 +71,7 @@ class OutputModule(mp_module.MPModule):
             print("Failed to connect to %s" % device)
             return
         self.mpstate.mav_outputs.append(conn)
+        self.mpstate.reactor.invalidate()
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
@@ -84,8 +93,10 @@ class OutputModule(mp_module.MPModule):
         except Exception:
             pass
         if sysid in self.mpstate.sysid_outputs:
+            self.mpstate.fanout.remove(self.mpstate.sysid_outputs[sysid])
             self.mpstate.sysid_outputs[sysid].close()
         self.mpstate.sysid_outputs[sysid] = conn
+        self.mpstate.reactor.invalidate()
 
     def cmd_output_remove(self, args):
         '''remove an output'''
@@ -98,8 +109,10 @@ class OutputModule(mp_module.MPModule):
                     mp_util.child_fd_list_add(conn.port.fileno())
                 except Exception:
                     pass
+                self.mpstate.fanout.remove(conn)
                 conn.close()
                 self.mpstate.mav_outputs.pop(i)
+                self.mpstate.reactor.invalidate()
                 return
 
     def idle_task(self):
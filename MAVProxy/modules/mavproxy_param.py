@@ -1,30 +1,141 @@
 #!/usr/bin/env python
 '''param command handling'''
 
-import time, os, fnmatch, time, struct
+import time, os, fnmatch, time, struct, json, zlib
 from pymavlink import mavutil, mavparm
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import multiproc
 
+# parameter holding a CRC32 of all parameters (PX4 parameter cache protocol)
+PARAM_HASH = '_HASH_CHECK'
+
+def param_hash_crc(crc, buf):
+    '''NuttX style crc32part(), a CRC32 without the initial and final inversion'''
+    return (~zlib.crc32(buf, ~crc & 0xFFFFFFFF)) & 0xFFFFFFFF
+
+class ParamCache(object):
+    '''parameters from an earlier connection, kept in ~/.mavproxy/param_cache
+    and keyed by system ID, component ID and firmware identity'''
+    def __init__(self, sysid, identity):
+        self.sysid = sysid
+        self.identity = identity
+        self.count = 0
+        self.params = {}
+
+    @staticmethod
+    def prefix(sysid):
+        return "%u_%u_" % (sysid[0], sysid[1])
+
+    @staticmethod
+    def exists(sysid):
+        '''see if there is any cache for this system and component'''
+        path = mp_util.dot_mavproxy('param_cache')
+        if not os.path.isdir(path):
+            return False
+        prefix = ParamCache.prefix(sysid)
+        for f in os.listdir(path):
+            if f.startswith(prefix):
+                return True
+        return False
+
+    def filename(self):
+        return mp_util.dot_mavproxy(os.path.join('param_cache', "%s%s.json" % (self.prefix(self.sysid), self.identity)))
+
+    def load(self):
+        '''load the cache, returning False if there isn't one'''
+        try:
+            f = open(self.filename(), 'r')
+            c = json.load(f)
+            f.close()
+        except Exception:
+            return False
+        if c.get('identity', None) != self.identity:
+            return False
+        self.count = c['count']
+        self.params = {}
+        for (idx, name, ptype, value) in c['params']:
+            self.params[idx] = (str(name), ptype, value)
+        return len(self.params) == self.count
+
+    def save(self, count, params):
+        '''save a complete set of parameters'''
+        self.count = count
+        self.params = dict(params)
+        path = self.filename()
+        mp_util.mkdir_p(os.path.dirname(path))
+        plist = [ [idx, name, ptype, value] for (idx, (name, ptype, value)) in sorted(self.params.items()) ]
+        try:
+            f = open(path + '.tmp', 'w')
+            json.dump({ 'identity' : self.identity, 'count' : count, 'params' : plist }, f)
+            f.close()
+            if os.path.exists(path):
+                os.unlink(path)
+            os.rename(path + '.tmp', path)
+        except Exception as e:
+            print("Failed to save parameter cache %s: %s" % (path, e))
+
+    def hash(self):
+        '''compute the PX4 style _HASH_CHECK value for the cached parameters'''
+        crc = 0
+        for idx in sorted(self.params.keys()):
+            (name, ptype, value) = self.params[idx]
+            if name == PARAM_HASH:
+                continue
+            crc = param_hash_crc(crc, name.encode('ascii'))
+            if ptype == mavutil.mavlink.MAV_PARAM_TYPE_REAL32:
+                v = struct.pack('<f', value)
+            elif ptype == mavutil.mavlink.MAV_PARAM_TYPE_UINT32:
+                v = struct.pack('<I', int(value) & 0xFFFFFFFF)
+            else:
+                v = struct.pack('<i', int(value))
+            crc = param_hash_crc(crc, v)
+        return crc
+
 class ParamState:
     '''this class is separated to make it possible to use the parameter
        functions on a secondary connection'''
-    def __init__(self, mav_param, logdir, vehicle_name, parm_file):
+    def __init__(self, mav_param, logdir, vehicle_name, parm_file, sysid=None):
         self.mav_param_set = set()
         self.mav_param_count = 0
         self.param_period = mavutil.periodic_event(1)
         self.fetch_one = dict()
+        # index -> (name, type, value) of all parameters received
+        self.param_by_index = {}
+        # system and component ID used to key the parameter cache, None to disable the cache
+        self.sysid = sysid
+        self.cache = None
+        self.cache_checked = sysid is None
+        self.cache_dirty = False
+        self.cache_save_time = 0
+        self.identity = None
+        self.identity_time = None
+        self.hash_value = None
+        self.vehicle_type_by_sysid = {}
+        self.reset_sync()
         self.mav_param = mav_param
         self.logdir = logdir
         self.vehicle_name = vehicle_name
         self.parm_file = parm_file
-        self.fetch_set = None
         self.xml_filepath = None
         self.new_sysid_timestamp = time.time()
         self.autopilot_type_by_sysid = {}
         self.param_types = {}
 
+    def reset_sync(self):
+        '''start a new parameter sync'''
+        self.sync_start = None
+        self.sync_time = None
+        self.last_value_time = 0
+        self.value_interval = None
+        self.fetch_missing = None
+        self.fetch_outstanding = {}
+        self.fetch_window = 10
+        self.fetch_rtt = None
+        self.fetch_requests = 0
+        self.fetch_retries = 0
+        self.cache_verified = False
+
     def handle_px4_param_value(self, m):
         '''special handling for the px4 style of PARAM_VALUE'''
         if m.param_type == mavutil.mavlink.MAV_PARAM_TYPE_REAL32:
@@ -66,18 +177,44 @@ class ParamState:
     def handle_mavlink_packet(self, master, m):
         '''handle an incoming mavlink packet'''
         if m.get_type() == 'PARAM_VALUE':
-            value = self.handle_px4_param_value(m)
             param_id = "%.16s" % m.param_id
+            if param_id == PARAM_HASH:
+                # the hash is sent with the bits of a uint32 in the float
+                self.hash_value, = struct.unpack('<I', struct.pack('<f', m.param_value))
+                return
+            value = self.handle_px4_param_value(m)
+            now = time.time()
+            if self.last_value_time != 0:
+                dt = now - self.last_value_time
+                if self.value_interval is None:
+                    self.value_interval = dt
+                else:
+                    self.value_interval = 0.9 * self.value_interval + 0.1 * min(dt, 1.0)
+            self.last_value_time = now
             # Note: the xml specifies param_index is a uint16, so -1 in that field will show as 65535
             # We accept both -1 and 65535 as 'unknown index' to future proof us against someday having that
             # xml fixed.
-            if self.fetch_set is not None:
-                self.fetch_set.discard(m.param_index)
-            if m.param_index != -1 and m.param_index != 65535 and m.param_index not in self.mav_param_set:
+            valid_index = m.param_index != -1 and m.param_index != 65535
+            if valid_index and m.param_index in self.fetch_outstanding:
+                rtt = now - self.fetch_outstanding.pop(m.param_index)
+                if self.fetch_rtt is None:
+                    self.fetch_rtt = rtt
+                else:
+                    self.fetch_rtt = 0.875 * self.fetch_rtt + 0.125 * rtt
+                self.fetch_window = min(self.fetch_window + 1, 64)
+            if valid_index and m.param_index not in self.mav_param_set:
                 added_new_parameter = True
                 self.mav_param_set.add(m.param_index)
             else:
                 added_new_parameter = False
+            if valid_index:
+                if self.fetch_missing is not None:
+                    self.fetch_missing.discard(m.param_index)
+                old = self.param_by_index.get(m.param_index, None)
+                self.param_by_index[m.param_index] = (str(param_id), m.param_type, value)
+                if self.sync_time is not None and (old is None or old[2] != value):
+                    # changed after the sync completed, eg. a param set
+                    self.cache_dirty = True
             if m.param_count != -1:
                 self.mav_param_count = m.param_count
             self.mav_param[str(param_id)] = value
@@ -88,35 +225,195 @@ class ParamState:
                 else:
                     print("%s = %s" % (param_id, str(value)))
             if added_new_parameter and len(self.mav_param_set) == m.param_count:
-                print("Received %u parameters" % m.param_count)
-                if self.logdir is not None:
-                    self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
-                self.fetch_set = None
-            if self.fetch_set is not None and len(self.fetch_set) == 0:
-                self.fetch_check(master, force=True)
+                self.sync_complete()
+            elif self.fetch_missing is not None:
+                self.fetch_send(master)
         elif m.get_type() == 'HEARTBEAT':
             if m.get_srcComponent() == 1:
                 # remember autopilot types so we can handle PX4 parameters
                 self.autopilot_type_by_sysid[m.get_srcSystem()] = m.autopilot
+                self.vehicle_type_by_sysid[m.get_srcSystem()] = m.type
+        elif m.get_type() == 'AUTOPILOT_VERSION':
+            if self.identity is None:
+                custom = ''.join(['%02x' % c for c in bytearray(m.flight_custom_version)])
+                self.identity = "%08x_%s_%x" % (m.flight_sw_version, custom, m.uid)
+
+    def sync_complete(self):
+        '''all parameters have been received'''
+        if self.sync_start is not None:
+            self.sync_time = time.time() - self.sync_start
+        else:
+            self.sync_time = 0
+        if self.cache_verified:
+            print("Loaded %u parameters from cache" % self.mav_param_count)
+        elif self.cache is not None and len(self.cache.params) > 0:
+            changed = 0
+            for (idx, p) in self.param_by_index.items():
+                if self.cache.params.get(idx, None) != p:
+                    changed += 1
+            print("Received %u parameters (%u changed since cached) in %.1fs" % (self.mav_param_count, changed, self.sync_time))
+        else:
+            print("Received %u parameters in %.1fs" % (self.mav_param_count, self.sync_time))
+        if self.logdir is not None:
+            self.mav_param.save(os.path.join(self.logdir, self.parm_file), '*', verbose=True)
+        self.fetch_missing = None
+        self.fetch_outstanding = {}
+        self.cache_dirty = not self.cache_verified
+        self.cache_save()
+
+    def cache_save(self):
+        '''save the parameter cache if we have a complete set'''
+        if self.sysid is None or not self.cache_dirty or self.sync_time is None:
+            return
+        if len(self.param_by_index) != self.mav_param_count:
+            return
+        if self.cache is None:
+            self.cache = ParamCache(self.sysid, self.fallback_identity())
+        self.cache.save(self.mav_param_count, self.param_by_index)
+        self.cache_dirty = False
+        self.cache_save_time = time.time()
+
+    def fallback_identity(self):
+        '''identity to use when the vehicle doesn't send AUTOPILOT_VERSION'''
+        if self.identity is not None:
+            return self.identity
+        return "ap%u_type%u" % (self.autopilot_type_by_sysid.get(self.sysid[0], 0),
+                                self.vehicle_type_by_sysid.get(self.sysid[0], 0))
+
+    def hash_supported(self):
+        '''return True if the autopilot answers a _HASH_CHECK request.
+        Only PX4 does, so we don't hold back the fetch for others'''
+        return self.autopilot_type_by_sysid.get(self.sysid[0], -1) == mavutil.mavlink.MAV_AUTOPILOT_PX4
+
+    def cache_check(self, master, now):
+        '''load and verify the parameter cache. Returns True while the
+        full parameter fetch should be held back'''
+        if self.cache_checked:
+            return False
+        hold = self.hash_supported()
+        if self.identity_time is None:
+            self.identity_time = now
+            if not ParamCache.exists(self.sysid):
+                # nothing to verify, only ask for the identity to save the cache under
+                self.cache_checked = True
+            elif hold:
+                master.param_fetch_one(PARAM_HASH)
+            master.mav.command_long_send(master.target_system, master.target_component,
+                                         mavutil.mavlink.MAV_CMD_REQUEST_AUTOPILOT_CAPABILITIES,
+                                         0, 1, 0, 0, 0, 0, 0, 0)
+            return hold and not self.cache_checked
+        if self.identity is None and now - self.identity_time < 1.0:
+            return hold
+        if self.cache is None:
+            self.cache = ParamCache(self.sysid, self.fallback_identity())
+            if not self.cache.load():
+                self.cache_checked = True
+                return False
+            # make the cached values available straight away, they are
+            # replaced as the vehicle sends its own values
+            received = set([p[0] for p in self.param_by_index.values()])
+            for (name, ptype, value) in self.cache.params.values():
+                if name not in received:
+                    self.mav_param[name] = value
+        if self.hash_value is None and hold and now - self.identity_time < 1.5:
+            return True
+        self.cache_checked = True
+        if self.hash_value is not None and self.hash_value == self.cache.hash():
+            self.cache_verified = True
+            self.param_by_index = dict(self.cache.params)
+            self.mav_param_set = set(self.cache.params.keys())
+            self.mav_param_count = self.cache.count
+            self.sync_complete()
+        return False
+
+    def stream_timeout(self):
+        '''time without PARAM_VALUE after which the parameter list stream is taken to have stopped'''
+        if self.value_interval is None:
+            return 1.0
+        return min(1.0, max(0.2, 8 * self.value_interval))
+
+    def fetch_timeout(self):
+        '''time to wait for a single parameter request'''
+        if self.fetch_rtt is None:
+            return 1.0
+        return min(2.0, max(0.2, 3 * self.fetch_rtt))
+
+    def fetch_send(self, master):
+        '''keep up to fetch_window parameter requests outstanding'''
+        if master is None:
+            return
+        now = time.time()
+        while len(self.fetch_outstanding) < self.fetch_window and len(self.fetch_missing) > 0:
+            idx = min(self.fetch_missing)
+            self.fetch_missing.discard(idx)
+            if idx in self.mav_param_set:
+                continue
+            master.param_fetch_one(idx)
+            self.fetch_outstanding[idx] = now
+            self.fetch_requests += 1
 
     def fetch_check(self, master, force=False):
-        '''check for missing parameters periodically'''
-        if self.param_period.trigger() or force:
-            if master is None:
-                return
-            if len(self.mav_param_set) == 0:
+        '''check for missing parameters'''
+        if master is None:
+            return
+        now = time.time()
+        if self.sync_start is None:
+            self.sync_start = now
+        if self.cache_check(master, now):
+            return
+        if self.sync_time is not None and len(self.mav_param_set) == self.mav_param_count:
+            if self.cache_dirty and now - self.cache_save_time > 5:
+                self.cache_save()
+            return
+        if len(self.mav_param_set) == 0:
+            if self.param_period.trigger() or force:
                 master.param_fetch_all()
-            elif self.mav_param_count != 0 and len(self.mav_param_set) != self.mav_param_count:
-                if master.time_since('PARAM_VALUE') >= 1 or force:
-                    diff = set(range(self.mav_param_count)).difference(self.mav_param_set)
-                    count = 0
-                    while len(diff) > 0 and count < 10:
-                        idx = diff.pop()
-                        master.param_fetch_one(idx)
-                        if self.fetch_set is None:
-                            self.fetch_set = set()
-                        self.fetch_set.add(idx)
-                        count += 1
+            return
+        if self.mav_param_count == 0 or len(self.mav_param_set) == self.mav_param_count:
+            return
+        if self.fetch_missing is None:
+            # wait for the parameter list stream to stop, then fill in the gaps
+            if now - self.last_value_time < self.stream_timeout() and not force:
+                return
+            self.fetch_missing = set(range(self.mav_param_count)).difference(self.mav_param_set)
+        timed_out = [ idx for (idx, t) in self.fetch_outstanding.items() if now - t > self.fetch_timeout() ]
+        if len(timed_out) > 0:
+            for idx in timed_out:
+                self.fetch_outstanding.pop(idx)
+                self.fetch_missing.add(idx)
+            self.fetch_retries += len(timed_out)
+            self.fetch_window = max(self.fetch_window // 2, 2)
+        if len(self.fetch_missing) == 0 and len(self.fetch_outstanding) == 0:
+            # the count may have changed while fetching
+            self.fetch_missing = set(range(self.mav_param_count)).difference(self.mav_param_set)
+        self.fetch_send(master)
+
+    def sync_status(self):
+        '''show parameter sync status'''
+        print("Have %u/%u params" % (len(self.mav_param_set), self.mav_param_count))
+        if self.sync_time is not None:
+            print("Sync completed in %.1fs" % self.sync_time)
+        elif self.sync_start is not None:
+            print("Syncing for %.1fs" % (time.time() - self.sync_start))
+        if self.fetch_missing is not None or self.fetch_requests > 0:
+            if self.fetch_rtt is None:
+                rtt = "?"
+            else:
+                rtt = "%.0fms" % (self.fetch_rtt * 1000)
+            print("Fetched %u by index (%u retries), window %u rtt %s" % (
+                self.fetch_requests, self.fetch_retries, self.fetch_window, rtt))
+        if self.sysid is None:
+            return
+        if self.cache_verified:
+            print("Cache: verified (%s)" % self.cache.identity)
+        elif self.sync_time is not None and self.cache is not None:
+            print("Cache: updated from vehicle (%s)" % self.cache.identity)
+        elif self.cache is not None and len(self.cache.params) > 0:
+            print("Cache: loaded %u params, not verified by the vehicle (%s)" % (len(self.cache.params), self.cache.identity))
+        elif not self.cache_checked:
+            print("Cache: checking")
+        else:
+            print("Cache: none")
 
     def param_help_download(self):
         '''download XML files for parameters'''
@@ -240,6 +537,7 @@ class ParamState:
             if len(args) == 1:
                 master.param_fetch_all()
                 self.mav_param_set = set()
+                self.reset_sync()
                 print("Requested parameter list")
             else:
                 found = False
@@ -350,7 +648,7 @@ class ParamState:
                 pattern = "*"
             self.mav_param.show(pattern)
         elif args[0] == "status":
-            print("Have %u/%u params" % (len(self.mav_param_set), self.mav_param_count))
+            self.sync_status()
         else:
             print(usage)
 
@@ -387,7 +685,7 @@ class ParamModule(mp_module.MPModule):
         if sysid not in [(0,0),(1,1),(1,0)]:
 
             fname = 'mav_%u_%u.parm' % (sysid[0], sysid[1])
-        self.pstate[sysid] = ParamState(self.mpstate.mav_param_by_sysid[sysid], self.logdir, self.vehicle_name, fname)
+        self.pstate[sysid] = ParamState(self.mpstate.mav_param_by_sysid[sysid], self.logdir, self.vehicle_name, fname, sysid)
         if self.continue_mode and self.logdir is not None:
             parmfile = os.path.join(self.logdir, fname)
             if os.path.exists(parmfile):
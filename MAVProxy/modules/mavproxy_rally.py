@@ -7,6 +7,7 @@ from pymavlink import mavutil
 import time, os, platform
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_transfer
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
@@ -303,16 +304,30 @@ class RallyModule(mp_module.MPModule):
             return None
         return p
 
+    def fetch_rally_points(self, count):
+        '''fetch count rally points, keeping several requests in flight'''
+        def request(i):
+            self.master.mav.rally_fetch_point_send(self.target_system,
+                                                   self.target_component, i)
+        transfer = mp_transfer.ItemTransfer(count, request,
+                                            window=self.settings.wp_window,
+                                            window_max=self.settings.wp_window_max,
+                                            timeout=1.0)
+        points = mp_transfer.fetch_blocking(self.master, transfer, 'RALLY_POINT', timeout=1)
+        if points is None:
+            self.console.error("Failed to fetch rally points (%s)" % transfer.status_string())
+        return points
+
     def list_rally_points(self):
         self.rallyloader.clear()
         rally_count = self.mav_param.get('RALLY_TOTAL',0)
         if rally_count == 0:
             print("No rally points")
             return
-        for i in range(int(rally_count)):
-            p = self.fetch_rally_point(i)
-            if p is None:
-                return
+        points = self.fetch_rally_points(int(rally_count))
+        if points is None:
+            return
+        for p in points:
             self.rallyloader.append_rally_point(p)
 
         for i in range(self.rallyloader.rally_count()):
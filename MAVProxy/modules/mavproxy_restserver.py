@@ -8,31 +8,124 @@ April 2018
 
 import time
 import json
+import math
 import socket
+import threading
 from threading import Thread
 
-from flask import Flask
+from flask import Flask, Response
+from flask import request as flask_request
 from werkzeug.serving import make_server
 from MAVProxy.modules.lib import mp_module
 
-def mavlink_to_json(msg):
-    '''Translate mavlink python messages in json string'''
-    ret = '\"%s\": {' % msg._type
+def json_value(v):
+    '''convert a mavlink field value to a JSON compatible value'''
+    if isinstance(v, float):
+        if math.isnan(v) or math.isinf(v):
+            return None
+        return v
+    if isinstance(v, (bytes, bytearray)):
+        return v.decode('utf-8', 'replace').rstrip('\0')
+    if isinstance(v, (list, tuple)):
+        return [json_value(x) for x in v]
+    return v
+
+def json_dumps(obj):
+    '''json.dumps, falling back to str() for values JSON can't encode'''
+    return json.dumps(obj, default=str)
+
+def mavlink_to_dict(msg):
+    '''Translate mavlink python messages in a dictionary of typed values'''
+    ret = {}
     for fieldname in msg._fieldnames:
-        data = getattr(msg, fieldname)
-        ret += '\"%s\" : \"%s\", ' % (fieldname, data)
-    ret = ret[0:-2] + '}'
+        ret[fieldname] = json_value(getattr(msg, fieldname))
     return ret
 
+def mavlink_to_json(msg):
+    '''Translate mavlink python messages in json string'''
+    return json_dumps(mavlink_to_dict(msg))
+
 def mpstatus_to_json(status):
     '''Translate MPStatus in json string'''
-    msg_keys = list(status.msgs.keys())
-    data = '{'
-    for key in msg_keys[:-1]:
-        data += mavlink_to_json(status.msgs[key]) + ','
-    data += mavlink_to_json(status.msgs[msg_keys[-1]])
-    data += '}'
-    return data
+    ret = {}
+    for (mtype, msg) in list(status.msgs.items()):
+        ret[mtype] = mavlink_to_dict(msg)
+    return json_dumps(ret)
+
+
+class MessageCache():
+    '''JSON for the latest message of each type. update() is called from
+    the main thread and only notes which types have changed, each with a
+    new sequence number. The JSON for a type is built the first time it
+    is requested after a change'''
+    def __init__(self):
+        self.cond = threading.Condition()
+        # mtype -> [msg, dict, json, seq]
+        self.entries = {}
+        self.seq = 0
+        self.full_json = None
+        self.full_seq = -1
+
+    def update(self, msgs):
+        '''check for new messages in a MPStatus msgs dictionary'''
+        changed = False
+        with self.cond:
+            for (mtype, msg) in list(msgs.items()):
+                e = self.entries.get(mtype, None)
+                if e is not None and e[0] is msg:
+                    continue
+                self.seq += 1
+                self.entries[mtype] = [msg, None, None, self.seq]
+                changed = True
+            if changed:
+                self.cond.notify_all()
+
+    def _entry(self, mtype):
+        '''return the entry for a type with the dict and json filled in'''
+        e = self.entries[mtype]
+        if e[1] is None:
+            e[1] = mavlink_to_dict(e[0])
+            e[2] = json_dumps(e[1])
+        return e
+
+    def get(self, mtype):
+        '''return (dict, seq) for a message type, or (None, 0)'''
+        with self.cond:
+            if not mtype in self.entries:
+                return (None, 0)
+            e = self._entry(mtype)
+            return (e[1], e[3])
+
+    def full(self):
+        '''return (json, seq) for all message types'''
+        with self.cond:
+            if self.full_seq != self.seq:
+                parts = []
+                for mtype in sorted(self.entries.keys()):
+                    parts.append('"%s": %s' % (mtype, self._entry(mtype)[2]))
+                self.full_json = '{' + ', '.join(parts) + '}'
+                self.full_seq = self.seq
+            return (self.full_json, self.seq)
+
+    def delta(self, since, types=None):
+        '''return (json, seq) for the message types which have changed
+        since sequence number since'''
+        with self.cond:
+            parts = []
+            for mtype in sorted(self.entries.keys()):
+                if types is not None and not mtype in types:
+                    continue
+                if self.entries[mtype][3] > since:
+                    parts.append('"%s": %s' % (mtype, self._entry(mtype)[2]))
+            return ('{' + ', '.join(parts) + '}', self.seq)
+
+    def wait(self, since, timeout):
+        '''wait for a change after sequence number since'''
+        with self.cond:
+            if self.seq <= since:
+                self.cond.wait(timeout)
+            return self.seq
+
 
 class RestServer():
     '''Rest Server'''
@@ -51,10 +144,16 @@ class RestServer():
         # Save status
         self.status = None
         self.server = None
+        self.cache = MessageCache()
+
+        # maximum rate of events on a stream, in Hz
+        self.stream_rate = 10
 
     def update_dict(self, mpstate):
         '''We don't have time to waste'''
         self.status = mpstate.status
+        if self.running():
+            self.cache.update(self.status.msgs)
 
     def set_ip_port(self, ip, port):
         '''set ip and port'''
@@ -84,42 +183,89 @@ class RestServer():
         if self.server:
             self.server.shutdown()
             self.server = None
+        # wake up any streams so they finish
+        with self.cache.cond:
+            self.cache.cond.notify_all()
 
     def run(self):
         '''Start app'''
         self.server = make_server(self.address, self.port, self.app, threaded=True)
         self.server.serve_forever()
 
+    def json_response(self, data, seq, status=200):
+        '''return a JSON response, with the sequence number in a header'''
+        return Response(data, status=status, mimetype='application/json',
+                        headers={'X-MAVProxy-Seq' : str(seq)})
+
     def request(self, arg=None):
-        '''Deal with requests'''
+        '''Deal with requests. With ?since=SEQ only the message types which
+        have changed since SEQ (from the X-MAVProxy-Seq header or a
+        previous delta) are returned'''
         if not self.status:
             return '{"result": "No message"}'
 
-        try:
-            status_dict = json.loads(mpstatus_to_json(self.status))
-        except Exception as e:
-            print(e)
-            return
+        since = flask_request.args.get('since', None, type=int)
 
         # If no key, send the entire json
         if not arg:
-            return json.dumps(status_dict)
+            if since is not None:
+                (data, seq) = self.cache.delta(since)
+                return self.json_response('{"seq": %u, "messages": %s}' % (seq, data), seq)
+            (data, seq) = self.cache.full()
+            return self.json_response(data, seq)
 
         # Get item from path
-        new_dict = status_dict
         args = arg.split('/')
-        for key in args:
-            if key in new_dict:
+        (new_dict, seq) = self.cache.get(args[0])
+        if new_dict is None:
+            (data, seq) = self.cache.full()
+            return '{"key": "%s", "last_dict": %s}' % (args[0], data)
+        if since is not None and seq <= since:
+            return self.json_response('', seq, status=304)
+        for key in args[1:]:
+            if isinstance(new_dict, dict) and key in new_dict:
                 new_dict = new_dict[key]
             else:
-                return '{"key": "%s", "last_dict": %s}' % (key, json.dumps(new_dict))
+                return '{"key": "%s", "last_dict": %s}' % (key, json_dumps(new_dict))
+
+        return self.json_response(json_dumps(new_dict), seq)
+
+    def stream(self):
+        '''stream changed messages as Server-Sent Events. Each event holds
+        the message types which changed since the last one, and has the
+        sequence number as its id, so a client can resume with
+        Last-Event-ID. ?types=A,B limits the message types sent'''
+        types = flask_request.args.get('types', None)
+        if types is not None:
+            types = set(types.split(','))
+        since = flask_request.headers.get('Last-Event-ID', None)
+        if since is None:
+            since = flask_request.args.get('since', 0)
+        try:
+            since = int(since)
+        except ValueError:
+            since = 0
+
+        def generate(since):
+            while self.running():
+                seq = self.cache.wait(since, 15)
+                if seq <= since:
+                    yield ': keepalive\n\n'
+                    continue
+                (data, seq) = self.cache.delta(since, types)
+                since = seq
+                if data != '{}':
+                    yield 'id: %u\ndata: %s\n\n' % (seq, data)
+                time.sleep(1.0 / self.stream_rate)
 
-        return json.dumps(new_dict)
+        return Response(generate(since), mimetype='text/event-stream',
+                        headers={'Cache-Control' : 'no-cache'})
 
     def add_endpoint(self):
         '''Set endpoits'''
         self.app.add_url_rule('/rest/mavlink/<path:arg>', 'rest', self.request)
         self.app.add_url_rule('/rest/mavlink/', 'rest', self.request)
+        self.app.add_url_rule('/rest/stream', 'stream', self.stream)
 
 class ServerModule(mp_module.MPModule):
     ''' Server Module '''
@@ -2,16 +2,73 @@
   MAVProxy terrain handling module
 """
 
-import time
+import time, math
+import collections
+import numpy
 
+from pymavlink import mavutil
 from MAVProxy.modules.mavproxy_map import mp_elevation
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
 
+# approximate size on the wire of a TERRAIN_DATA message
+TERRAIN_DATA_BYTES = 55
+
+# mission prefetch limits. Longer legs only fetch the tiles at each end
+PREFETCH_MAX_LEG = 1.0
+PREFETCH_MAX_TILES = 100
+
+# frames in which mission item x/y are a latitude/longitude
+GLOBAL_FRAMES = [mavutil.mavlink.MAV_FRAME_GLOBAL,
+                 mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT,
+                 mavutil.mavlink.MAV_FRAME_GLOBAL_TERRAIN_ALT,
+                 mavutil.mavlink.MAV_FRAME_GLOBAL_INT,
+                 mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT_INT,
+                 mavutil.mavlink.MAV_FRAME_GLOBAL_TERRAIN_ALT_INT]
+
+def gps_offset_array(lat, lon, east, north):
+    '''numpy version of mp_util.gps_offset, for arrays of positions and offsets'''
+    bearing = numpy.arctan2(east, north)
+    dr = numpy.sqrt(numpy.square(east) + numpy.square(north)) / mp_util.radius_of_earth
+    lat1 = numpy.radians(lat)
+    lon1 = numpy.radians(lon)
+    lat2 = numpy.arcsin(numpy.sin(lat1)*numpy.cos(dr) +
+                        numpy.cos(lat1)*numpy.sin(dr)*numpy.cos(bearing))
+    lon2 = lon1 + numpy.arctan2(numpy.sin(bearing)*numpy.sin(dr)*numpy.cos(lat1),
+                                numpy.cos(dr)-numpy.sin(lat1)*numpy.sin(lat2))
+    return (numpy.degrees(lat2), ((numpy.degrees(lon2) + 180.0) % 360.0) - 180.0)
+
+class TerrainGrid(object):
+    '''the 8x7 blocks of 4x4 terrain heights for one TERRAIN_REQUEST grid'''
+    def __init__(self, lat, lon, grid_spacing, elevation_model):
+        self.lat = lat
+        self.lon = lon
+        self.grid_spacing = grid_spacing
+        self.compute_time = time.time()
+        bits = numpy.arange(56)
+        bit_spacing = grid_spacing * 4
+        (blat, blon) = gps_offset_array(lat * 1.0e-7, lon * 1.0e-7,
+                                        bit_spacing * (bits % 8), bit_spacing * (bits // 8))
+        i = numpy.arange(16)
+        east = numpy.tile(grid_spacing * (i % 4), 56)
+        north = numpy.tile(grid_spacing * (i // 4), 56)
+        (lats, lons) = gps_offset_array(numpy.repeat(blat, 16), numpy.repeat(blon, 16), east, north)
+        alts = elevation_model.GetElevationArray(lats, lons).reshape((56, 16))
+        self.lats = lats.reshape((56, 16))
+        self.lons = lons.reshape((56, 16))
+        self.blocks = []
+        for bit in range(56):
+            if numpy.any(numpy.isnan(alts[bit])):
+                self.blocks.append(None)
+            else:
+                self.blocks.append([int(a) for a in alts[bit]])
+        self.complete = None not in self.blocks
+
 class TerrainModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(TerrainModule, self).__init__(mpstate, "terrain", "terrain handling", public=False)
+        self.subscribe(['TERRAIN_REQUEST', 'TERRAIN_REPORT'])
 
         self.ElevationModel = mp_elevation.ElevationModel()
         self.current_request = None
@@ -21,11 +78,22 @@ class TerrainModule(mp_module.MPModule):
         self.blocks_sent = 0
         self.check_lat = 0
         self.check_lon = 0
+        self.grids = collections.OrderedDict()
+        self.grid = None
+        self.grids_computed = 0
+        self.send_credit = 0
+        self.mission_change = None
+        self.prefetch_tiles = set()
+        self.last_prefetch = 0
         self.add_command('terrain', self.cmd_terrain, "terrain control",
                          ["<status|check>",
                           'set (TERRAINSETTING)'])
         self.terrain_settings = mp_settings.MPSettings(
-            [ ('debug', int, 0) ]
+            [ ('debug', int, 0),
+              ('rate', float, 50),
+              ('link_share', float, 0.5),
+              ('cache_grids', int, 64),
+              ('prefetch', int, 1) ]
             )
         self.add_completion_function('(TERRAINSETTING)', self.terrain_settings.completion)
 
@@ -36,9 +104,13 @@ class TerrainModule(mp_module.MPModule):
             print(usage)
             return
         if args[0] == "status":
-            print("blocks_sent: %u requests_received: %u" % (
+            print("blocks_sent: %u requests_received: %u grids_computed: %u cached: %u rate: %.1f/s prefetch_pending: %u" % (
                 self.blocks_sent,
-                self.requests_received))
+                self.requests_received,
+                self.grids_computed,
+                len(self.grids),
+                self.send_rate(),
+                len(self.prefetch_tiles)))
         elif args[0] == "set":
             self.terrain_settings.command(args[1:])
         elif args[0] == "check":
@@ -72,6 +144,7 @@ class TerrainModule(mp_module.MPModule):
             self.current_request = msg
             self.sent_mask = 0
             self.requests_received += 1
+            self.grid = self.get_grid(msg.lat, msg.lon, msg.grid_spacing)
         elif type == 'TERRAIN_REPORT':
             if (msg.lat == self.check_lat and
                 msg.lon == self.check_lon and
@@ -80,27 +153,31 @@ class TerrainModule(mp_module.MPModule):
                 self.check_lat = 0
                 self.check_lon = 0
 
+    def get_grid(self, lat, lon, grid_spacing):
+        '''get the heights for a whole request grid, from the cache if possible.
+        Incomplete grids (missing SRTM tiles) are recomputed at most once a second'''
+        key = (lat, lon, grid_spacing)
+        grid = self.grids.pop(key, None)
+        if grid is None or (not grid.complete and time.time() - grid.compute_time > 1.0):
+            grid = TerrainGrid(lat, lon, grid_spacing, self.ElevationModel)
+            self.grids_computed += 1
+        self.grids[key] = grid
+        while len(self.grids) > max(self.terrain_settings.cache_grids, 1):
+            self.grids.popitem(False)
+        return grid
+
     def send_terrain_data_bit(self, bit):
         '''send some terrain data'''
-        lat = self.current_request.lat * 1.0e-7
-        lon = self.current_request.lon * 1.0e-7
-        bit_spacing = self.current_request.grid_spacing * 4
-        (lat, lon) = mp_util.gps_offset(lat, lon,
-                                        east=bit_spacing * (bit % 8),
-                                        north=bit_spacing * (bit // 8))
-        data = []
-        for i in range(4*4):
-            y = i % 4
-            x = i // 4
-            (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=self.current_request.grid_spacing * y,
-                                             north=self.current_request.grid_spacing * x)
-            alt = self.ElevationModel.GetElevation(lat2, lon2)
-            if alt is None:
-                if self.terrain_settings.debug:
-                    print("no alt ", lat2, lon2)
-                return
-            data.append(int(alt))
+        grid = self.grid
+        data = grid.blocks[bit]
+        if data is None:
+            grid = self.get_grid(grid.lat, grid.lon, grid.grid_spacing)
+            self.grid = grid
+            data = grid.blocks[bit]
+        if data is None:
+            if self.terrain_settings.debug:
+                print("no alt ", grid.lats[bit][0], grid.lons[bit][0])
+            return False
         self.master.mav.terrain_data_send(self.current_request.lat,
                                           self.current_request.lon,
                                           self.current_request.grid_spacing,
@@ -119,25 +196,85 @@ class TerrainModule(mp_module.MPModule):
                                              north=28*self.current_request.grid_spacing)
             print("--lat=%f --lon=%f %.1f" % (
                 lat2, lon2, self.ElevationModel.GetElevation(lat2, lon2)))
+        return True
 
+    def send_rate(self):
+        '''the TERRAIN_DATA send rate in blocks per second. On serial links this
+        is limited to link_share of the link bandwidth'''
+        rate = self.terrain_settings.rate
+        baud = getattr(self.master, 'baud', None)
+        if baud and self.terrain_settings.link_share > 0:
+            rate = min(rate, self.terrain_settings.link_share * baud / (10.0 * TERRAIN_DATA_BYTES))
+        return max(rate, 0.1)
 
     def send_terrain_data(self):
-        '''send some terrain data'''
+        '''send as much terrain data as the rate budget allows'''
+        now = time.time()
+        rate = self.send_rate()
+        # allow a burst of up to half a second of budget, so a whole
+        # request can go out together on fast links
+        self.send_credit = min(self.send_credit + (now - self.last_send_time) * rate, max(rate * 0.5, 1))
+        self.last_send_time = now
         for bit in range(56):
-            if self.current_request.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
-                self.send_terrain_data_bit(bit)
+            if self.send_credit < 1:
                 return
+            if self.current_request.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
+                if not self.send_terrain_data_bit(bit):
+                    return
+                self.send_credit -= 1
         # no bits to send
         self.current_request = None
         self.sent_mask = 0
 
+    def prefetch_mission(self):
+        '''load (downloading if needed) the SRTM tiles along the mission, so
+        terrain requests along the route can be answered straight away'''
+        try:
+            wploader = self.module('wp').wploader
+        except Exception:
+            return
+        if wploader.last_change != self.mission_change:
+            self.mission_change = wploader.last_change
+            # the route as runs of consecutive positions. Only NAV
+            # commands in global frames are positions, any other item
+            # ends the run so no leg is drawn across it
+            routes = [[]]
+            for i in range(wploader.count()):
+                w = wploader.wp(i)
+                if (w.command < mavutil.mavlink.MAV_CMD_NAV_LAST and w.frame in GLOBAL_FRAMES and
+                    (w.x != 0 or w.y != 0) and abs(w.x) <= 90 and abs(w.y) <= 180):
+                    routes[-1].append((w.x, w.y))
+                elif len(routes[-1]) > 0:
+                    routes.append([])
+            # tiles in route order, so the cap keeps the start of the mission
+            tiles = collections.OrderedDict()
+            for points in routes:
+                for i in range(len(points)):
+                    (lat1, lon1) = points[i]
+                    (lat2, lon2) = points[min(i+1, len(points)-1)]
+                    dist = max(abs(lat2-lat1), abs(lon2-lon1))
+                    if dist > PREFETCH_MAX_LEG:
+                        tiles[(math.floor(lat1), math.floor(lon1))] = True
+                        tiles[(math.floor(lat2), math.floor(lon2))] = True
+                        continue
+                    # sample legs every 0.1 degrees so no tile is skipped
+                    n = int(dist / 0.1) + 1
+                    for j in range(n+1):
+                        f = j / float(n)
+                        tiles[(math.floor(lat1 + f*(lat2-lat1)), math.floor(lon1 + f*(lon2-lon1)))] = True
+            self.prefetch_tiles = set(list(tiles.keys())[:PREFETCH_MAX_TILES])
+        for (lat, lon) in list(self.prefetch_tiles):
+            if self.ElevationModel.GetTile(lat, lon) is not None:
+                self.prefetch_tiles.discard((lat, lon))
+
     def idle_task(self):
         '''called when idle'''
+        now = time.time()
+        if self.terrain_settings.prefetch and now - self.last_prefetch > 1.0:
+            self.last_prefetch = now
+            self.prefetch_mission()
         if self.current_request is None:
             return
-        if time.time() - self.last_send_time < 0.2:
-            # limit to 5 per second
-            return
         self.send_terrain_data()
 
 def init(mpstate):
@@ -5,6 +5,7 @@ import time, os, fnmatch, copy, platform
 from pymavlink import mavutil, mavwp
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_transfer
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
 
@@ -12,14 +13,14 @@ class WPModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(WPModule, self).__init__(mpstate, "wp", "waypoint handling", public = True)
         self.wp_op = None
-        self.wp_requested = {}
-        self.wp_received = {}
+        self.wp_transfer = None
+        self.wp_upload = None
+        self.wp_int = False
         self.wp_save_filename = None
         self.wploader_by_sysid = {}
         self.loading_waypoints = False
         self.loading_waypoint_lasttime = time.time()
         self.last_waypoint = 0
-        self.wp_period = mavutil.periodic_event(0.5)
         self.undo_wp = None
         self.undo_type = None
         self.undo_wp_idx = -1
@@ -63,36 +64,63 @@ class WPModule(mp_module.MPModule):
             self.wploader_by_sysid[self.target_system] = mavwp.MAVWPLoader()
         return self.wploader_by_sysid[self.target_system]
 
-    def missing_wps_to_request(self):
-        ret = []
-        tnow = time.time()
-        next_seq = self.wploader.count()
-        for i in range(5):
-            seq = next_seq+i
-            if seq+1 > self.wploader.expected_count:
-                continue
-            if seq in self.wp_requested and tnow - self.wp_requested[seq] < 2:
-                continue
-            ret.append(seq)
-        return ret
-
-    def send_wp_requests(self, wps=None):
-        '''send some more WP requests'''
-        if wps is None:
-            wps = self.missing_wps_to_request()
-        tnow = time.time()
-        for seq in wps:
-            #print("REQUESTING %u/%u (%u)" % (seq, self.wploader.expected_count, i))
-            self.wp_requested[seq] = tnow
+    def wp_request(self, seq):
+        '''request one mission item'''
+        if self.wp_int:
+            self.master.mav.mission_request_int_send(self.target_system, self.target_component, seq)
+        else:
             self.master.waypoint_request_send(seq)
 
+    def start_wp_transfer(self, count):
+        '''start fetching count mission items'''
+        self.wp_int = self.settings.wp_int
+        self.wp_transfer = mp_transfer.ItemTransfer(count, self.wp_request,
+                                                    window=self.settings.wp_window,
+                                                    window_max=self.settings.wp_window_max)
+        self.wp_transfer.check()
+
     def wp_status(self):
         '''show status of wp download'''
+        if self.wp_transfer is not None:
+            print("Downloading %s" % self.wp_transfer.status_string())
+            return
+        if self.wp_upload is not None and self.loading_waypoints:
+            print("Uploading %s" % self.wp_upload.status_string())
+            return
         try:
-            print("Have %u of %u waypoints" % (self.wploader.count()+len(self.wp_received), self.wploader.expected_count))
+            print("Have %u of %u waypoints" % (self.wploader.count(), self.wploader.expected_count))
         except Exception:
-            print("Have %u waypoints" % (self.wploader.count()+len(self.wp_received)))
-
+            print("Have %u waypoints" % self.wploader.count())
+
+    def mission_item_scale(self, command):
+        '''scale from MISSION_ITEM x/y to MISSION_ITEM_INT x/y. Positions
+        are degrees * 1e7 in any frame, while the camera commands carry
+        their param5 and param6 unscaled, as in ArduPilot's conversion'''
+        if command in [mavutil.mavlink.MAV_CMD_DO_DIGICAM_CONTROL,
+                       mavutil.mavlink.MAV_CMD_DO_DIGICAM_CONFIGURE]:
+            return 1
+        return 1.0e7
+
+    def mission_item_float(self, m):
+        '''convert a MISSION_ITEM_INT to the MISSION_ITEM the wploader holds'''
+        scale = 1.0 / self.mission_item_scale(m.command)
+        w = mavutil.mavlink.MAVLink_mission_item_message(m.target_system, m.target_component,
+                                                         m.seq, m.frame, m.command,
+                                                         m.current, m.autocontinue,
+                                                         m.param1, m.param2, m.param3, m.param4,
+                                                         m.x*scale, m.y*scale, m.z)
+        w._header = m._header
+        w._timestamp = m._timestamp
+        return w
+
+    def mission_item_int(self, w):
+        '''convert a MISSION_ITEM to a MISSION_ITEM_INT for sending'''
+        scale = self.mission_item_scale(w.command)
+        return mavutil.mavlink.MAVLink_mission_item_int_message(w.target_system, w.target_component,
+                                                                w.seq, w.frame, w.command,
+                                                                w.current, w.autocontinue,
+                                                                w.param1, w.param2, w.param3, w.param4,
+                                                                int(round(w.x*scale)), int(round(w.y*scale)), w.z)
 
     def wp_slope(self):
         '''show slope of waypoints'''
@@ -127,24 +155,25 @@ class WPModule(mp_module.MPModule):
                 self.console.writeln("Requesting %u waypoints t=%s now=%s" % (m.count,
                                                                                  time.asctime(time.localtime(m._timestamp)),
                                                                                  time.asctime()))
-                self.send_wp_requests()
+                self.start_wp_transfer(m.count)
 
-        elif mtype in ['WAYPOINT', 'MISSION_ITEM'] and self.wp_op is not None:
-            if m.seq < self.wploader.count():
-                #print("DUPLICATE %u" % m.seq)
+        elif mtype in ['WAYPOINT', 'MISSION_ITEM', 'MISSION_ITEM_INT'] and self.wp_op is not None:
+            if self.wp_transfer is None:
                 return
-            if m.seq+1 > self.wploader.expected_count:
-                self.console.writeln("Unexpected waypoint number %u - expected %u" % (m.seq, self.wploader.count()))
-            self.wp_received[m.seq] = m
-            next_seq = self.wploader.count()
-            while next_seq in self.wp_received:
-                m = self.wp_received.pop(next_seq)
-                self.wploader.add(m)
-                next_seq += 1
-            if self.wploader.count() != self.wploader.expected_count:
-                #print("m.seq=%u expected_count=%u" % (m.seq, self.wploader.expected_count))
-                self.send_wp_requests()
+            if m.seq >= self.wp_transfer.count:
+                self.console.writeln("Unexpected waypoint number %u - expected %u" % (m.seq, self.wp_transfer.count))
                 return
+            if mtype == 'MISSION_ITEM_INT':
+                m = self.mission_item_float(m)
+            self.wp_transfer.received(m.seq, m)
+            if not self.wp_transfer.complete():
+                self.wp_transfer.check()
+                return
+            for w in self.wp_transfer.items:
+                self.wploader.add(w)
+            self.console.writeln("Received %u waypoints in %.1fs (%u retries)" % (
+                self.wploader.count(), time.time() - self.wp_transfer.start_time, self.wp_transfer.retries))
+            self.wp_transfer = None
             if self.wp_op == 'list':
                 for i in range(self.wploader.count()):
                     w = self.wploader.wp(i)
@@ -163,10 +192,8 @@ class WPModule(mp_module.MPModule):
             elif self.wp_op == "save":
                 self.save_waypoints(self.wp_save_filename)
             self.wp_op = None
-            self.wp_requested = {}
-            self.wp_received = {}
 
-        elif mtype in ["WAYPOINT_REQUEST", "MISSION_REQUEST"]:
+        elif mtype in ["WAYPOINT_REQUEST", "MISSION_REQUEST", "MISSION_REQUEST_INT"]:
             self.process_waypoint_request(m, self.master)
 
         elif mtype in ["WAYPOINT_CURRENT", "MISSION_CURRENT"]:
@@ -189,12 +216,14 @@ class WPModule(mp_module.MPModule):
 
     def idle_task(self):
         '''handle missing waypoints'''
-        if self.wp_period.trigger():
+        if self.wp_transfer is not None and self.master is not None:
             # cope with packet loss fetching mission
-            if self.master is not None and self.master.time_since('MISSION_ITEM') >= 2 and self.wploader.count() < getattr(self.wploader,'expected_count',0):
-                wps = self.missing_wps_to_request();
-                print("re-requesting WPs %s" % str(wps))
-                self.send_wp_requests(wps)
+            self.wp_transfer.check()
+            if (self.wp_int and self.wp_transfer.received_count == 0 and
+                self.wp_transfer.retries >= 3):
+                # the vehicle may not support MISSION_REQUEST_INT
+                self.console.writeln("No reply to MISSION_REQUEST_INT, using MISSION_REQUEST")
+                self.wp_int = False
         if self.module('console') is not None and not self.menu_added_console:
             self.menu_added_console = True
             self.module('console').add_menu(self.menu)
@@ -219,12 +248,19 @@ class WPModule(mp_module.MPModule):
         wp = self.wploader.wp(m.seq)
         wp.target_system = self.target_system
         wp.target_component = self.target_component
-        self.master.mav.send(self.wploader.wp(m.seq))
+        if m.get_type() == "MISSION_REQUEST_INT":
+            self.master.mav.send(self.mission_item_int(wp))
+        else:
+            self.master.mav.send(wp)
         self.loading_waypoint_lasttime = time.time()
-        self.console.writeln("Sent waypoint %u : %s" % (m.seq, self.wploader.wp(m.seq)))
+        if self.wp_upload is None or self.wp_upload.count != self.wploader.count():
+            self.wp_upload = mp_transfer.ItemUpload(self.wploader.count())
+        self.wp_upload.item_sent(m.seq)
         if m.seq == self.wploader.count() - 1:
             self.loading_waypoints = False
-            self.console.writeln("Sent all %u waypoints" % self.wploader.count())
+            self.console.writeln("Sent all %u waypoints in %.1fs (%u resent)" % (
+                self.wploader.count(), time.time() - self.wp_upload.start_time, self.wp_upload.resends))
+            self.wp_upload = None
 
     def send_all_waypoints(self):
         '''send all waypoints to vehicle'''
@@ -233,6 +269,7 @@ class WPModule(mp_module.MPModule):
             return
         self.loading_waypoints = True
         self.loading_waypoint_lasttime = time.time()
+        self.wp_upload = mp_transfer.ItemUpload(self.wploader.count())
         self.master.waypoint_count_send(self.wploader.count())
 
     def load_waypoints(self, filename):
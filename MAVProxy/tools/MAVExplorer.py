@@ -24,6 +24,8 @@ from pymavlink import mavutil
 from MAVProxy.modules.lib.mp_settings import MPSettings, MPSetting
 from MAVProxy.modules.lib import wxsettings
 from MAVProxy.modules.lib.graphdefinition import GraphDefinition
+from MAVProxy.modules.lib import mp_logindex
+from MAVProxy.modules.lib import mp_expression
 from lxml import objectify
 import pkg_resources
 from builtins import input
@@ -62,6 +64,7 @@ class MEState(object):
             )
 
         self.mlog = None
+        self.index = None
         self.filename = None
         self.command_map = command_map
         self.completions = {
@@ -202,7 +205,7 @@ def expression_ok(expression, msgs=None):
         try:
             if f.endswith(':2'):
                 f = f[:-2]
-            if mavutil.evaluate_expression(f, msgs) is None:
+            if mp_expression.evaluate_expression(f, msgs) is None:
                 expression_ok = False
         except Exception:
             expression_ok = False
@@ -326,7 +329,8 @@ def cmd_map(args):
     options.show_flightmode_legend = mestate.settings.show_flightmode
     if len(args) > 0:
         options.types = ','.join(args)
-    [path, wp, fen, used_flightmodes, mav_type] = mavflightview.mavflightview_mav(mestate.mlog, options, mestate.flightmode_selections)
+    [path, wp, fen, used_flightmodes, mav_type] = mavflightview.mavflightview_mav(mestate.mlog, options, mestate.flightmode_selections,
+                                                                                  index=mestate.index)
     child = multiproc.Process(target=mavflightview.mavflightview_show, args=[path, wp, fen, used_flightmodes, mav_type, options])
     child.start()
     mestate.mlog.rewind()
@@ -462,8 +466,15 @@ def cmd_messages(args):
         wildcard = '*'
     mestate.mlog.rewind()
     types = set(['MSG','STATUSTEXT'])
+    reader = None
+    if mestate.index is not None:
+        reader = mp_logindex.IndexedReader(mestate.mlog, mestate.index, types,
+                                           state_types=mp_logindex.log_types(mestate.settings.condition))
     while True:
-        m = mestate.mlog.recv_match(type=types, condition=mestate.settings.condition)
+        if reader is not None:
+            m = reader.recv_match(condition=mestate.settings.condition)
+        else:
+            m = mestate.mlog.recv_match(type=types, condition=mestate.settings.condition)
         if m is None:
             break
         if m.get_type() == 'MSG':
@@ -523,6 +534,14 @@ def loadfile(args):
     t1 = time.time()
     mestate.console.write("\ndone (%u messages in %.1fs)\n" % (mestate.mlog._count, t1-t0))
 
+    # load or build the message index, used to seek straight to the
+    # messages needed for graphs and maps
+    mestate.index = mp_logindex.load_index(mlog, args)
+    if mestate.index is None and mp_logindex.supported(mlog):
+        mestate.console.write("Indexing %s...\n" % args)
+        mestate.index = mp_logindex.get_index(mlog, args, progress_callback=progress_bar)
+        mestate.console.write("\ndone (%.1fs)\n" % (time.time()-t1))
+
     global flightmodes
     flightmodes = mlog.flightmode_list()
 
@@ -11,6 +11,7 @@ from pymavlink import mavutil, mavwp, mavextra
 from MAVProxy.modules.mavproxy_map import mp_slipmap, mp_tile
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import mp_logindex
 import functools
 
 import cv2
@@ -223,8 +224,8 @@ def colour_for_flightmode(mav_type, fmode, instance=0):
     colour = (r,g,b)
     return colour
 
-def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
-    '''create a map for a log file'''
+def mavflightview_mav(mlog, options=None, flightmode_selections=[], index=None):
+    '''create a map for a log file, using an optional mp_logindex.LogIndex'''
     wp = mavwp.MAVWPLoader()
     if options.mission is not None:
         wp.load(options.mission)
@@ -260,9 +261,18 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
     last_timestamps = {}
     used_flightmodes = {}
 
+    reader = None
+    if index is not None:
+        state_types = set(mp_logindex.STATE_TYPES)
+        state_types.update(mp_logindex.log_types(options.condition))
+        reader = mp_logindex.IndexedReader(mlog, index, types, state_types=state_types)
+
     while True:
         try:
-            m = mlog.recv_match(type=types)
+            if reader is not None:
+                m = reader.recv_match()
+            else:
+                m = mlog.recv_match(type=types)
             if m is None:
                 break
         except Exception: